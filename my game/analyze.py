@@ -0,0 +1,168 @@
+# Offline analysis of how playthroughs end. Run from this folder, e.g.:
+#   python analyze.py
+#   python analyze.py --weights weights.json --bad-sanity 9 --check 100000
+# Instead of walking all 4^20 playthroughs, this runs a dynamic program over the
+# ending counters, merging every path that reaches the same counter values.
+#
+# weights.json maps levels to relative choice weights, e.g. {"1": {"a": 3, "b": 1}}.
+# Levels and options left out weigh 1, so no file means uniform random play.
+from collections import defaultdict
+import argparse
+import json
+import math
+import random
+import sys
+
+from app import FALLBACK_ENDINGS, SEED_BITS, GameLogic, game_logic
+
+ENDINGS = ('good', 'bad', 'neutral', 'secret')
+DEAD_END = 'dead_end' # A level without options stops the run before any ending, as in play_game
+
+
+def _stats(key):
+    keys_taken, sanity_lost, mirror_interactions, secret_progress = key
+    return {'keys_taken': keys_taken, 'sanity_lost': sanity_lost,
+            'mirror_interactions': mirror_interactions, 'secret_progress': secret_progress}
+
+
+def _level_choices(logic, weights, level):
+    # [(choice weight, effect)] for every option on the level
+    level_weights = (weights or {}).get(level, {})
+    return [(level_weights.get(key, 1), logic.choice_effect(level, key))
+            for key in logic.levels[level].options]
+
+
+def counter_distribution(logic=game_logic, weights=None):
+    # ((keys_taken, sanity_lost, mirror_interactions, secret_progress) -> weight of the
+    # playthroughs that reach an ending there, weight of those stopped by a dead end).
+    # With the default weights those are path counts. Every level is on every path, so
+    # a level without options stops all of them.
+    states = {(0, 0, 0, 0): 1}
+    for level in range(1, logic.total_levels + 1):
+        choices = _level_choices(logic, weights, level)
+        if not choices:
+            return {}, sum(states.values())
+        next_states = defaultdict(int)
+        for (keys, sanity, mirrors, secret), mass in states.items():
+            for weight, (d_keys, d_sanity, d_mirrors, secret_bit) in choices:
+                next_states[(min(keys + d_keys, logic.keys_cap),
+                             min(sanity + d_sanity, logic.sanity_cap),
+                             min(mirrors + d_mirrors, logic.mirror_cap),
+                             secret | secret_bit)] += mass * weight
+        states = next_states
+    return states, 0
+
+
+def ending_counts(logic=game_logic, weights=None):
+    # Ending -> weight of playthroughs; 'random' counts paths left to the fallback
+    states, dead_ends = counter_distribution(logic, weights)
+    counts = defaultdict(int)
+    for key, mass in states.items():
+        counts[logic.fixed_ending(_stats(key)) or 'random'] += mass
+    if dead_ends:
+        counts[DEAD_END] += dead_ends
+    return dict(counts)
+
+
+def ending_probabilities(logic=game_logic, weights=None):
+    # Exact probability of each ending, with the fallback split evenly (it hashes a random seed)
+    counts = ending_counts(logic, weights)
+    total = sum(counts.values())
+    probabilities = {ending: counts.get(ending, 0) / total for ending in ENDINGS + (DEAD_END,)}
+    for ending in FALLBACK_ENDINGS:
+        probabilities[ending] += counts.get('random', 0) / total / len(FALLBACK_ENDINGS)
+    return probabilities
+
+
+def counter_histogram(index, logic=game_logic, weights=None):
+    # Probability of each final value of one counter, uncapped, where the run stops
+    # (index 0 is keys_taken, 1 is sanity_lost, 2 is mirror_interactions)
+    values = {0: 1}
+    for level in range(1, logic.total_levels + 1):
+        choices = _level_choices(logic, weights, level)
+        if not choices:
+            break
+        next_values = defaultdict(int)
+        for value, mass in values.items():
+            for weight, effect in choices:
+                next_values[value + effect[index]] += mass * weight
+        values = next_values
+    total = sum(values.values())
+    return {value: mass / total for value, mass in sorted(values.items())}
+
+
+def sample_endings(runs, logic=game_logic, weights=None, seed=0):
+    # Monte Carlo reference: play random paths through the real ending code
+    rng = random.Random(seed)
+    counts = dict.fromkeys(ENDINGS + (DEAD_END,), 0)
+    for _ in range(runs):
+        stats = logic.new_ending_stats()
+        past_choices = []
+        for level in range(1, logic.total_levels + 1):
+            keys = list(logic.levels[level].options)
+            if not keys:
+                counts[DEAD_END] += 1
+                break
+            level_weights = (weights or {}).get(level, {})
+            choice = rng.choices(keys, [level_weights.get(key, 1) for key in keys])[0]
+            logic.record_choice(stats, level, choice)
+            past_choices.append({'level': level, 'choice': choice})
+        else:
+            counts[logic.ending_from_stats(stats, rng.getrandbits(SEED_BITS), past_choices)] += 1
+    return {ending: count / runs for ending, count in counts.items()}
+
+
+def load_weights(path):
+    with open(path) as f:
+        raw = json.load(f)
+    return {int(level): dict(options) for level, options in raw.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exact ending probabilities over every playthrough")
+    parser.add_argument('--weights', help="JSON file of per-level choice weights")
+    parser.add_argument('--check', type=int, metavar='RUNS', default=0,
+                        help="cross-check against a Monte Carlo sample of this many runs")
+    parser.add_argument('--seed', type=int, default=0)
+    for name, value in GameLogic.ENDING_THRESHOLDS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=int, default=value,
+                            help=f"ending threshold (default {value})")
+    args = parser.parse_args()
+
+    thresholds = {name: getattr(args, name) for name in GameLogic.ENDING_THRESHOLDS}
+    logic = game_logic if thresholds == GameLogic.ENDING_THRESHOLDS else GameLogic(thresholds)
+    weights = load_weights(args.weights) if args.weights else None
+
+    counts = ending_counts(logic, weights)
+    probabilities = ending_probabilities(logic, weights)
+    total = sum(counts.values())
+    print("Ending probabilities:")
+    for ending in ENDINGS:
+        print(f"{ending:>10}: {probabilities[ending]:10.6%}  (forced {counts.get(ending, 0) / total:10.6%})")
+    print(f"{'fallback':>10}: {counts.get('random', 0) / total:10.6%}  (split evenly between good/bad/neutral)")
+    print(f"{DEAD_END:>10}: {probabilities[DEAD_END]:10.6%}  (stopped on a level without options)")
+
+    for index, name in enumerate(('keys_taken', 'sanity_lost', 'mirror_interactions')):
+        histogram = counter_histogram(index, logic, weights)
+        mean = sum(value * p for value, p in histogram.items())
+        print(f"\n{name} (mean {mean:.3f}):")
+        for value, p in histogram.items():
+            print(f"{value:>10}: {p:10.6%}")
+
+    if args.check:
+        sampled = sample_endings(args.check, logic, weights, args.seed)
+        print(f"\nMonte Carlo check over {args.check} runs:")
+        failed = False
+        for ending in ENDINGS + (DEAD_END,):
+            p = probabilities[ending]
+            # Allow 4 standard errors, plus a little slack for endings that never happen
+            tolerance = 4 * math.sqrt(p * (1 - p) / args.check) + 1 / args.check
+            ok = abs(sampled[ending] - p) <= tolerance
+            failed |= not ok
+            print(f"{ending:>10}: exact {p:10.6%}, sampled {sampled[ending]:10.6%}  {'ok' if ok else 'MISMATCH'}")
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
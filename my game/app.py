@@ -1,16 +1,233 @@
-from flask import Flask, render_template, request, session, redirect, url_for
+from flask import (Blueprint, Flask, abort, current_app, g, jsonify, render_template, request,
+                   send_from_directory, session, redirect, url_for)
+from flask.sessions import SecureCookieSessionInterface
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
+from collections import OrderedDict
+from contextlib import nullcontext
+from dataclasses import dataclass
+from functools import lru_cache, wraps
+from types import MappingProxyType
+from typing import Mapping, Optional
+from weakref import WeakKeyDictionary
+import gzip
+import hashlib
+import json
+import mimetypes
 import os
-import random
+import secrets
+import sys
+import threading
 
-app = Flask(__name__)
-# Generate a strong secret key for session management
-app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24))
+try:
+    import brotli
+except ImportError: # Optional, game over pages are then only gzipped
+    brotli = None
+
+from metrics import Metrics, catalog_lines, current_timer, phase, telemetry_lines
+from ratelimit import create_limiter, limit_clients, too_many_requests
+from scenario_pack import PackError, PackReloader, StoryCatalog
+from session_store import create_store
+from story_check import ERROR, check_story
+from telemetry import Telemetry, create_sink
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def config_from_env():
+    return {
+        # Signs the session cookie. It must be set and be the same for every worker,
+        # otherwise a player's cookie is rejected by any process that didn't issue it.
+        'SECRET_KEY': os.environ.get('SECRET_KEY'),
+        # Store game state as a single packed integer instead of lists of dicts
+        'COMPACT_SESSION': os.environ.get('COMPACT_SESSION', '0') == '1',
+        # Where game state lives: 'cookie' (default), 'memory' or 'sqlite'. With a server-side
+        # store the cookie only holds an opaque run ID. 'memory' is per process, so it
+        # needs a single worker (threads are fine).
+        'SESSION_STORE': os.environ.get('SESSION_STORE', 'cookie'),
+        'SESSION_TTL': float(os.environ.get('SESSION_TTL', 3600)), # Seconds before an idle run expires
+        'SESSION_MAX_RUNS': int(os.environ.get('SESSION_MAX_RUNS', 10000)), # Memory store only
+        'SESSION_DB': os.environ.get('SESSION_DB', 'game_sessions.db'), # SQLite store only
+        # Serve pre-rendered scenario pages with ETags instead of rendering game.html per request
+        'PAGE_CACHE': os.environ.get('PAGE_CACHE', '1') == '1',
+        # Serve a story from a scenario pack (compiled, or a JSON/TOML source) instead of the
+        # built-in one; see scenario_pack.py. Replacing the file swaps the story in running
+        # workers, checked at most every SCENARIO_RELOAD seconds (0 turns that off).
+        'SCENARIO_PACK': os.environ.get('SCENARIO_PACK'),
+        'SCENARIO_RELOAD': float(os.environ.get('SCENARIO_RELOAD', 2)),
+        # Also serve every pack in this directory at /s/<story_id>/ (story_id is the file
+        # name without extension), keeping at most STORY_CACHE_SIZE of them loaded at a time.
+        # Each story a player has a run in adds to the cookie, so many stories want a store.
+        'STORY_DIR': os.environ.get('STORY_DIR'),
+        'STORY_CACHE_SIZE': int(os.environ.get('STORY_CACHE_SIZE', 32)),
+        # Record every choice and ending, 'sqlite:<path>' or 'csv:<directory>'; off by default.
+        # Events are buffered (up to TELEMETRY_BUFFER) and written every TELEMETRY_FLUSH seconds.
+        'TELEMETRY': os.environ.get('TELEMETRY'),
+        'TELEMETRY_BUFFER': int(os.environ.get('TELEMETRY_BUFFER', 65536)),
+        'TELEMETRY_FLUSH': float(os.environ.get('TELEMETRY_FLUSH', 1)),
+        # Time every request and its phases, served in Prometheus format at /metrics; off by
+        # default. With METRICS_PROFILE_DIR also dump cProfile stats for a sample of requests.
+        'METRICS': os.environ.get('METRICS', '0') == '1',
+        'METRICS_PROFILE_DIR': os.environ.get('METRICS_PROFILE_DIR'),
+        'METRICS_PROFILE_RATE': float(os.environ.get('METRICS_PROFILE_RATE', 0.01)),
+        # Compile the templates and render the story's pages while the app is created, not on
+        # the first request. With gunicorn's preload_app that happens once, before the fork.
+        'WARM_START': os.environ.get('WARM_START', '1') == '1',
+        # Keep compiled templates in this directory, for servers that import the app in
+        # every worker (uvicorn --workers) rather than once before forking
+        'TEMPLATE_CACHE': os.environ.get('TEMPLATE_CACHE'),
+        # Limit requests to the game routes, 'memory' (per worker) or 'sqlite' (shared by the
+        # workers through RATE_LIMIT_DB); off by default. Each client IP may send RATE_LIMIT_BURST
+        # at once, refilled at RATE_LIMIT_RATE per second, and each run RATE_LIMIT_RUN_BURST
+        # choices at RATE_LIMIT_RUN_RATE. Over the limit they get a 429 with Retry-After.
+        # Clients are told apart by their address, so behind reverse proxies set TRUSTED_PROXIES.
+        'RATE_LIMIT': os.environ.get('RATE_LIMIT'),
+        'RATE_LIMIT_RATE': float(os.environ.get('RATE_LIMIT_RATE', 10)),
+        'RATE_LIMIT_BURST': int(os.environ.get('RATE_LIMIT_BURST', 60)),
+        'RATE_LIMIT_RUN_RATE': float(os.environ.get('RATE_LIMIT_RUN_RATE', 2)),
+        'RATE_LIMIT_RUN_BURST': int(os.environ.get('RATE_LIMIT_RUN_BURST', 10)),
+        'RATE_LIMIT_DB': os.environ.get('RATE_LIMIT_DB', 'rate_limits.db'),
+        # How many reverse proxies in front of the app append to X-Forwarded-For. The client
+        # address is then taken from that header (werkzeug's ProxyFix), otherwise every player
+        # would be the proxy's address to the rate limits. Leave it 0 without a proxy: the
+        # header is the client's own to forge.
+        'TRUSTED_PROXIES': int(os.environ.get('TRUSTED_PROXIES', 0)),
+    }
+
+DEFAULT_DELAYED_MESSAGE = "A forgotten shadow stirs within you..."
+DEAD_END_MESSAGE = "Your path ends here." # For a level without options or a description
+UNDEFINED_PATH_MESSAGE = "An unknown error occurred or you've reached an undefined path."
+# Where a run ends up when its counters don't force an ending
+FALLBACK_ENDINGS = ('good', 'bad', 'neutral')
+SEED_BITS = 48 # Size of a run's seed, see new_state
+
+@lru_cache(maxsize=4096)
+def fallback_ending(seed, record):
+    # A pure function of the run's seed and its choices (see GameLogic.choice_record),
+    # so the same run always ends the same way and can be replayed
+    digest = hashlib.blake2b(b'%d:%d' % (seed, record), digest_size=8).digest()
+    return FALLBACK_ENDINGS[int.from_bytes(digest, 'big') % len(FALLBACK_ENDINGS)]
+
+# --- Compiled scenario records ---
+# The scenario literals below are compiled once at startup into these frozen
+# records. Request handlers only ever read them, so nothing is rebuilt per call.
+@dataclass(frozen=True, slots=True)
+class Consequence:
+    immediate: str
+    delayed_reveal_level: Optional[int]
+    is_wrong: bool
+    delayed_message: Optional[str] # None when there is no delayed reveal
+
+@dataclass(frozen=True, slots=True)
+class Option:
+    key: str
+    text: str
+    consequence: Consequence
+
+@dataclass(frozen=True, slots=True)
+class Level:
+    number: int
+    description: str
+    options: Mapping[str, Option] # Read-only, in display order
+    endings: Mapping[str, str]    # Only the final level has endings
 
 # --- Game Logic Class (as provided by you, with minor adjustments) ---
 class GameLogic:
-    def __init__(self):
-        self.scenarios = self._build_scenarios()
-        self.total_levels = max(self.scenarios.keys()) # Dynamically get total levels
+    # Choices that feed the ending in the built-in story, see determine_ending.
+    # Scenario packs carry their own in 'rules'.
+    SECRET_PATH = ((1, 'b'), (3, 'd'), (6, 'c'), (12, 'd'), (19, 'a'))
+    KEY_CHOICES = ((1, 'a'), (7, 'a'), (14, 'a'))
+    MIRROR_LEVELS = (3, 12, 19)
+    # Thresholds used by ending_rule; GameLogic(thresholds={...}) overrides them for balancing
+    ENDING_THRESHOLDS = {'bad_sanity': 8, 'good_keys': 2, 'good_max_sanity': 4, 'neutral_mirrors': 3}
+
+    def __init__(self, thresholds=None, content=None):
+        # content is a story loaded by scenario_pack.py, None means the built-in one below
+        if content is None:
+            content = self.builtin_content()
+        rules = content.get('rules', {})
+        self.secret_path = tuple((level, sys.intern(choice)) for level, choice in rules.get('secret_path', ()))
+        self.key_choices = tuple((level, sys.intern(choice)) for level, choice in rules.get('key_choices', ()))
+        self.mirror_levels = tuple(rules.get('mirror_levels', ()))
+        self.thresholds = {**self.ENDING_THRESHOLDS, **rules.get('ending_thresholds', {}), **(thresholds or {})}
+        # Counters beyond these values never change the ending
+        self.keys_cap = self.thresholds['good_keys']
+        self.sanity_cap = max(self.thresholds['bad_sanity'], self.thresholds['good_max_sanity'])
+        self.mirror_cap = self.thresholds['neutral_mirrors']
+        messages = content['delayed_messages']
+        # (source_level, choice) -> message, with interned keys for cheap lookups
+        self._delayed_messages = {
+            (level, sys.intern(choice)): text
+            for level, by_choice in messages.items()
+            for choice, text in by_choice.items()
+        }
+        self.levels = self._compile_levels(content['scenarios'])
+        self.total_levels = max(self.levels.keys()) # Dynamically get total levels, packs included
+        self._endings = self.levels[self.total_levels].endings
+        # Option positions for the compact state codec (2 bits per choice, so at most 4 options)
+        self._options_in_order = {n: tuple(level.options.values()) for n, level in self.levels.items()}
+        self._option_index = {
+            (n, option.key): index
+            for n, options in self._options_in_order.items()
+            for index, option in enumerate(options)
+        }
+        assert all(len(options) <= 4 for options in self._options_in_order.values())
+        # (level, choice) -> (keys taken, is wrong, mirror interaction, secret path bit)
+        self._choice_effects = {
+            (n, option.key): (
+                int((n, option.key) in self.key_choices),
+                int(option.consequence.is_wrong),
+                int(n in self.mirror_levels),
+                sum(1 << i for i, step in enumerate(self.secret_path) if step == (n, option.key)),
+            )
+            for n, options in self._options_in_order.items()
+            for option in options
+        }
+        # A story without a secret path never reaches the secret ending
+        self._secret_complete = (1 << len(self.secret_path)) - 1 if self.secret_path else -1
+        # Every clamped (keys_taken, sanity_lost, mirror_interactions) -> ending, None for the fallback
+        self._ending_table = {
+            (keys, sanity, mirrors): self.ending_rule(keys, sanity, mirrors)
+            for keys in range(self.keys_cap + 1)
+            for sanity in range(self.sanity_cap + 1)
+            for mirrors in range(self.mirror_cap + 1)
+        }
+
+    def builtin_content(self):
+        # The story shipped with the game, in the shape scenario_pack.py loads packs into
+        return {
+            'scenarios': self._build_scenarios(),
+            'delayed_messages': self._build_delayed_messages(),
+            'rules': {
+                'secret_path': self.SECRET_PATH,
+                'key_choices': self.KEY_CHOICES,
+                'mirror_levels': self.MIRROR_LEVELS,
+            },
+        }
+
+    def _compile_levels(self, scenarios):
+        levels = {}
+        for number, data in scenarios.items():
+            options = {}
+            for key, text in data.get('options', {}).items():
+                key = sys.intern(key)
+                info = data['consequences'][key]
+                reveal_level = info.get('delayed_reveal_level')
+                consequence = Consequence(
+                    immediate=info.get('immediate', ""),
+                    delayed_reveal_level=reveal_level,
+                    is_wrong=info.get('is_wrong', False),
+                    delayed_message=(self.get_delayed_message(number, key)
+                                     if reveal_level is not None else None),
+                )
+                options[key] = Option(key=key, text=text, consequence=consequence)
+            levels[number] = Level(
+                number=number,
+                description=data.get('description', ""),
+                options=MappingProxyType(options),
+                endings=MappingProxyType(dict(data.get('ending', {}))),
+            )
+        return MappingProxyType(levels)
 
     def _build_scenarios(self):
         return {
@@ -365,38 +582,93 @@ class GameLogic:
     def check_secret_ending(self, past_choices):
         # A specific sequence of choices leads to the secret ending
         # (Level, Choice) pairs that must be present in the player's history
-        secret_path = [(1, 'b'), (3, 'd'), (6, 'c'), (12, 'd'), (19, 'a')]
         # Convert past_choices to a set for efficient lookup
         choices_made = {(c['level'], c['choice']) for c in past_choices}
-        return all(step in choices_made for step in secret_path)
-
-    def determine_ending(self, past_choices):
-        if self.check_secret_ending(past_choices):
-            return 'secret'
-
-        # Analyze choices for ending conditions
-        stats = {
-            'keys_taken': sum(1 for c in past_choices if (c['level'], c['choice']) in [(1,'a'), (7,'a'), (14,'a')]),
-            'sanity_lost': sum(1 for c in past_choices if c.get('is_wrong', False)), # Count 'wrong' choices
-            'mirror_interactions': sum(1 for c in past_choices if c['level'] in [3,12,19])
-        }
+        return bool(self.secret_path) and all(step in choices_made for step in self.secret_path)
 
+    def ending_rule(self, keys_taken, sanity_lost, mirror_interactions):
+        # The ending for a run's counters, straight from the thresholds (ending_table holds
+        # its results for every clamped combination, this is what it was built from)
+        t = self.thresholds
         # Prioritize bad ending if too many wrong choices
-        if stats['sanity_lost'] >= 8: # Increased threshold for bad ending to make it less common
+        if sanity_lost >= t['bad_sanity']: # Increased threshold for bad ending to make it less common
             return 'bad'
-        elif stats['keys_taken'] >= 2 and stats['sanity_lost'] < 4: # Require fewer wrong choices for good ending
+        elif keys_taken >= t['good_keys'] and sanity_lost < t['good_max_sanity']: # Require fewer wrong choices for good ending
             return 'good'
-        elif stats['mirror_interactions'] >= 3:
+        elif mirror_interactions >= t['neutral_mirrors']:
             return 'neutral'
-        else: # Default to a random ending if no specific conditions are met
-            return random.choice(['good', 'bad', 'neutral'])
+        else: # None means the fallback ending, since no specific conditions are met
+            return None
+
+    # --- Incremental ending counters ---
+    # play_game folds each choice into these as it is made, so the ending is a table
+    # lookup at the end instead of a rescan of the whole history.
+    def new_ending_stats(self):
+        return {'keys_taken': 0, 'sanity_lost': 0, 'mirror_interactions': 0, 'secret_progress': 0}
+
+    def choice_effect(self, level, choice):
+        # (keys taken, is wrong, mirror interaction, secret path bit) for one choice
+        return self._choice_effects[(level, choice)]
+
+    def has_option(self, level, choice):
+        return (level, choice) in self._choice_effects
+
+    def record_choice(self, stats, level, choice):
+        keys_taken, is_wrong, mirror, secret_bit = self._choice_effects[(level, choice)]
+        stats['keys_taken'] += keys_taken
+        stats['sanity_lost'] += is_wrong
+        stats['mirror_interactions'] += mirror
+        stats['secret_progress'] |= secret_bit
+
+    def fixed_ending(self, stats):
+        # The ending the counters force, or None when it is left to chance
+        if stats['secret_progress'] == self._secret_complete:
+            return 'secret'
+        return self._ending_table[(min(stats['keys_taken'], self.keys_cap),
+                                   min(stats['sanity_lost'], self.sanity_cap),
+                                   min(stats['mirror_interactions'], self.mirror_cap))]
+
+    def ending_from_stats(self, stats, seed=0, past_choices=()):
+        # Falls back to an ending drawn from the run's seed and choices if no specific conditions are met
+        return self.fixed_ending(stats) or fallback_ending(seed, self.choice_record(past_choices))
+
+    def determine_ending(self, past_choices, seed=0):
+        # Same result as play_game's running counters, computed from a full history
+        stats = self.new_ending_stats()
+        for c in past_choices:
+            stats['keys_taken'] += (c['level'], c['choice']) in self.key_choices
+            stats['sanity_lost'] += bool(c.get('is_wrong', False)) # Count 'wrong' choices
+            stats['mirror_interactions'] += c['level'] in self.mirror_levels
+        if self.check_secret_ending(past_choices):
+            stats['secret_progress'] = self._secret_complete
+        return self.ending_from_stats(stats, seed, past_choices)
 
     def get_ending(self, ending_type):
-        return self.scenarios[20]['ending'].get(ending_type, "An unexpected end.")
+        return self._endings.get(ending_type, "An unexpected end.")
 
-    def get_delayed_message(self, source_level, choice):
+    # --- Read-only views of the compiled tables, for tools (simulate.py, story_check.py) ---
+    def options_in_order(self, level):
+        # The level's options in display order (their compact codec positions), () if none
+        return self._options_in_order.get(level, ())
+
+    @property
+    def ending_table(self):
+        # Clamped (keys_taken, sanity_lost, mirror_interactions) -> ending, None for the fallback
+        return MappingProxyType(self._ending_table)
+
+    @property
+    def secret_complete(self):
+        # The secret_progress value of a run that took the whole secret path
+        return self._secret_complete
+
+    @property
+    def delayed_messages(self):
+        # (source_level, choice) -> the story's own delayed message, defaults left out
+        return MappingProxyType(self._delayed_messages)
+
+    def _build_delayed_messages(self):
         # Specific messages for choices that have 'delayed_reveal_level' set
-        messages = {
+        return {
             1: {
                 'a': "A cold sensation runs down your arm from where the key rests. It feels... alive.",
                 'c': "The torchlight seems to dim around you, casting longer, more unsettling shadows.",
@@ -485,106 +757,862 @@ class GameLogic:
                 'd': "The ghost of breath on your neck, a constant chill, a reminder of the unseen presence that lingers right behind you."
             }
         }
-        return messages.get(source_level, {}).get(choice, "A forgotten shadow stirs within you...")
 
+    def get_delayed_message(self, source_level, choice):
+        return self._delayed_messages.get((source_level, choice), DEFAULT_DELAYED_MESSAGE)
 
     def get_scenario(self, level):
-        return self.scenarios.get(level, {})
+        return self.levels.get(level)
+
+    # Pending delayed consequences are bucketed by reveal level:
+    # {'<reveal_level>': [[source_level, choice], ...]}, in the order they were chosen.
+    # Keys are strings so the map survives the JSON session round trip unchanged.
+    def schedule_delayed(self, pending, level, choice):
+        reveal_level = self.levels[level].options[choice].consequence.delayed_reveal_level
+        if reveal_level is not None:
+            pending.setdefault(str(reveal_level), []).append([level, choice])
+            return True
+        return False
+
+    def reveal_delayed(self, pending, level):
+        # Only touches the bucket that is due, so the cost is proportional to what gets shown
+        due = pending.pop(str(level), None)
+        if not due:
+            return []
+        return [self.get_delayed_message(source_level, choice) for source_level, choice in due]
+
+    # --- Compact state codec ---
+    # The whole run packs into [code, seed]. code is one integer: the choice record (2 bits
+    # per choice, its position among the level's options, behind a leading 1 bit), then
+    # one bit saying whether the current level's delayed messages were already shown.
+    # is_wrong and the pending reveals are derived from the scenario table on decode, so
+    # they are never stored. A bare code (from before runs had seeds) decodes with a fresh
+    # random seed, which load_state saves straight away so the run keeps it.
+    def choice_record(self, past_choices):
+        packed = 1
+        for past in past_choices:
+            packed = (packed << 2) | self._option_index[(past['level'], past['choice'])]
+        return packed
+
+    def choices_from_record(self, record):
+        # The choice keys, level by level, back out of a choice record
+        count = (record.bit_length() - 1) // 2
+        return [self._options_in_order[level][(record >> (2 * (count - level))) & 3].key
+                for level in range(1, count + 1)]
+
+    def encode_state(self, state):
+        current_level = state.get('current_level', 1)
+        packed = self.choice_record(state.get('past_choices', []))
+        revealed = str(current_level) not in state.get('delayed_consequences_pending', {})
+        return [(packed << 1) | revealed, state.get('seed', 0)]
+
+    def decode_state(self, code):
+        code, seed = code if isinstance(code, list) else (code, secrets.randbits(SEED_BITS))
+        revealed = code & 1
+        packed = code >> 1
+        count = (packed.bit_length() - 1) // 2
+        current_level = count + 1
+        past_choices = []
+        pending = {}
+        stats = self.new_ending_stats()
+        for level in range(1, current_level):
+            index = (packed >> (2 * (count - level))) & 3
+            option = self._options_in_order[level][index]
+            past_choices.append({
+                'level': level,
+                'choice': option.key,
+                'is_wrong': option.consequence.is_wrong
+            })
+            self.record_choice(stats, level, option.key)
+            # Only reveals that can still fire are rebuilt
+            reveal_level = option.consequence.delayed_reveal_level
+            if reveal_level is not None and (reveal_level > current_level or
+                                             (reveal_level == current_level and not revealed)):
+                pending.setdefault(str(reveal_level), []).append([level, option.key])
+        return {
+            'current_level': current_level,
+            'past_choices': past_choices,
+            'delayed_consequences_pending': pending,
+            'ending_stats': stats,
+            'seed': seed
+        }
 
 game_logic = GameLogic()
 
+def build_story(content, source='<story>'):
+    # GameLogic for loaded content. Content story_check.py finds errors in is refused
+    # the same way as a pack that doesn't load, with a PackError.
+    logic = GameLogic(content=content)
+    errors = [finding.message for finding in check_story(logic, FALLBACK_ENDINGS) if finding.severity == ERROR]
+    if errors:
+        raise PackError(source, errors)
+    return logic
+
+def install_game_logic(logic):
+    # Every route reads the module-level game_logic, so rebinding it swaps the story
+    # for all of them at once. Cached level pages are keyed by the GameLogic they were
+    # rendered from, so pages of the old story are never served for the new one.
+    global game_logic
+    game_logic = logic
+
 # --- Flask Routes ---
+bp = Blueprint('game', __name__)
+# The same views again under /s/<story_id>/, for the stories in STORY_DIR
+stories_bp = Blueprint('story', __name__, url_prefix='/s/<story_id>')
+
+@stories_bp.url_value_preprocessor
+def load_story(endpoint, values):
+    story_id = values.pop('story_id')
+    catalog = current_app.extensions.get('story_catalog')
+    with phase('scenario_lookup'):
+        logic = catalog.get(story_id) if catalog is not None else None
+    if logic is None:
+        abort(404)
+    g.story_id, g.game_logic = story_id, logic
+
+@stories_bp.url_defaults
+def add_story_id(endpoint, values):
+    values.setdefault('story_id', g.story_id)
+
+def current_story():
+    # (story ID, GameLogic) for this request; the ID is None outside /s/<story_id>/
+    return g.get('story_id'), g.get('game_logic', game_logic)
+
+# Session keys of a run in the main story. Runs in other stories get their own keys
+# (see _session_key), so one cookie can hold a run in several stories at once.
+RUN_KEYS = ('current_level', 'past_choices', 'delayed_consequences_pending', 'ending_stats',
+            'seed', 'state', 'run_id')
+
+def _session_key(kind, story_id):
+    # kind is 'run' (the whole state, cookie mode), 'state' (compact) or 'run_id' (stores)
+    return kind if story_id is None else f'{kind}:{story_id}'
+
+def new_state(logic):
+    return {
+        'current_level': 1,
+        'past_choices': [], # Store {'level': X, 'choice': 'y', 'is_wrong': True/False}
+        'delayed_consequences_pending': {}, # Stores {'Z': [[X, 'y'], ...]} keyed by reveal level
+        'ending_stats': logic.new_ending_stats(), # Running counters for the ending
+        # Decides the ending when the counters don't, and names the run in telemetry.
+        # Not a secret: together with the choices it replays the run (see replay.py).
+        'seed': secrets.randbits(SEED_BITS)
+    }
+
+def load_state():
+    # The route works on a plain dict shaped like new_state(), or None when there is no
+    # run: never started, expired, its cookie or stored state is gone, or it no longer fits
+    story_id, logic = current_story()
+    session_store = current_app.extensions['session_store']
+    compact = current_app.config['COMPACT_SESSION']
+    with phase('session_decode'):
+        if session_store is not None:
+            run_id = session.get(_session_key('run_id', story_id))
+            data = session_store.get(run_id) if run_id else None
+        elif compact:
+            data = session.get(_session_key('state', story_id))
+        elif story_id is None:
+            data = session if 'current_level' in session or 'past_choices' in session else None
+        else:
+            data = session.get(_session_key('run', story_id))
+        if data is None:
+            return None
+        legacy = is_legacy_run(data, compact)
+        try:
+            state = logic.decode_state(data) if compact else data
+            if legacy:
+                upgrade_state(logic, state)
+            fits = run_fits(logic, state)
+        except (IndexError, KeyError, TypeError, ValueError):
+            fits = False # Doesn't even decode against this story
+    if not fits:
+        # Started in a story swapped out since (SCENARIO_RELOAD) that lacks levels or options
+        # the run went through: it starts over rather than failing later, on a reveal or ending
+        end_run()
+        return None
+    if legacy:
+        save_state(state) # Saved at once, so the run keeps its new seed
+    return state
+
+def run_fits(logic, state):
+    # Whether every choice the run made or is waiting to see revealed is still in the story
+    if not 1 <= state['current_level'] <= logic.total_levels + 1:
+        return False
+    made = [(past['level'], past['choice']) for past in state['past_choices']]
+    made.extend(tuple(entry) for entries in state['delayed_consequences_pending'].values() for entry in entries)
+    return all(logic.has_option(level, choice) for level, choice in made)
+
+def is_legacy_run(data, compact):
+    # A run saved in an older format: a bare compact code, or a state without 'seed' or
+    # 'ending_stats', or with its pending reveals still in one list
+    if compact:
+        return not isinstance(data, list)
+    return 'current_level' in data and ('seed' not in data or 'ending_stats' not in data
+                                        or not isinstance(data.get('delayed_consequences_pending', {}), dict))
+
+def upgrade_state(logic, state):
+    # Brings a legacy run up to date in place. It gets a seed of its own, so legacy runs
+    # neither share the fallback ending nor ChoiceLedger entries; its pending reveals
+    # ({'source_level', 'choice', 'reveal_level'} in a list) are bucketed by level; and its
+    # ending counters are recomputed from the choices made.
+    state.setdefault('seed', secrets.randbits(SEED_BITS))
+    pending = state.get('delayed_consequences_pending', {})
+    if not isinstance(pending, dict):
+        buckets = {}
+        for entry in pending:
+            buckets.setdefault(str(entry['reveal_level']), []).append([entry['source_level'], entry['choice']])
+        state['delayed_consequences_pending'] = buckets
+    if 'ending_stats' not in state:
+        stats = logic.new_ending_stats()
+        for made in state.get('past_choices', []):
+            logic.record_choice(stats, made['level'], made['choice'])
+        state['ending_stats'] = stats
+    state.setdefault('past_choices', [])
+
+def save_state(state):
+    story_id, logic = current_story()
+    session_store = current_app.extensions['session_store']
+    with phase('session_encode'):
+        data = logic.encode_state(state) if current_app.config['COMPACT_SESSION'] else state
+        if session_store is not None:
+            key = _session_key('run_id', story_id)
+            if key not in session:
+                session[key] = secrets.token_urlsafe(16)
+            session_store.put(session[key], data)
+        elif current_app.config['COMPACT_SESSION']:
+            session[_session_key('state', story_id)] = data
+        elif story_id is not None:
+            session[_session_key('run', story_id)] = data
+        elif state is not session:
+            session.update(state)
+
+def end_run():
+    # Forget the run both in the cookie and in the server-side store
+    story_id, _ = current_story()
+    session_store = current_app.extensions['session_store']
+    run_key = _session_key('run_id', story_id)
+    if session_store is not None and run_key in session:
+        with phase('session_encode'):
+            session_store.delete(session[run_key])
+    # Only this story's keys, runs in other stories share the cookie
+    keys = RUN_KEYS if story_id is None else [_session_key(kind, story_id) for kind in ('run', 'state', 'run_id')]
+    for key in keys:
+        session.pop(key, None)
 
-@app.route('/')
+# --- Static assets ---
+# build_assets.py writes content-hashed copies of static/css and static/js to static/dist.
+# Templates link them through asset_url(); until they are built the plain files are used.
+STATIC_DIR = os.path.join(HERE, 'static')
+ASSET_DIR = os.path.join(STATIC_DIR, 'dist')
+_asset_manifest = None # logical name -> {'file': fingerprinted name, 'encodings': [...]}
+_asset_files = None    # fingerprinted name -> available precompressed encodings
+
+def _load_asset_manifest():
+    global _asset_manifest, _asset_files
+    try:
+        with open(os.path.join(ASSET_DIR, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+    _asset_files = {entry['file']: entry['encodings'] for entry in manifest.values()}
+    _asset_manifest = manifest
+
+@bp.app_template_global()
+def asset_url(filename):
+    if _asset_manifest is None:
+        _load_asset_manifest()
+    entry = _asset_manifest.get(filename)
+    if entry is None:
+        return url_for('static', filename=filename)
+    return url_for('game.asset', filename=entry['file'])
+
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    if _asset_files is None:
+        _load_asset_manifest()
+    if filename not in _asset_files:
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding in _asset_files[filename]: # Best compression first
+        if request.accept_encodings[encoding]:
+            suffix = '.br' if encoding == 'br' else '.gz'
+            response = send_from_directory(ASSET_DIR, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(ASSET_DIR, filename, mimetype=mimetype)
+    # The name changes whenever the content does, so browsers can keep it forever
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.vary.add('Accept-Encoding')
+    return response
+
+# Self-hosted fonts as (family, weight, file under static/). Pages never load fonts
+# from another origin. The OFL-licensed TTFs (and their OFL.txt) go in static/fonts/,
+# and build_assets.py subsets them to the glyphs the game actually uses. A font whose
+# file isn't there is taken from the machine when installed (local(), by the file's
+# PostScript name), else the stylesheets fall back to their generic families.
+FONTS = (
+    ('Creepster', 400, 'fonts/Creepster-Regular.ttf'),
+    ('Roboto Mono', 400, 'fonts/RobotoMono-Regular.ttf'),
+    ('Roboto Mono', 700, 'fonts/RobotoMono-Bold.ttf'),
+)
+_fonts = None
+
+def missing_fonts():
+    # The FONTS files that are neither built nor under static/
+    if _asset_manifest is None:
+        _load_asset_manifest()
+    return [filename for _, _, filename in FONTS
+            if filename not in _asset_manifest and not os.path.exists(os.path.join(STATIC_DIR, filename))]
+
+@bp.app_template_global()
+def self_hosted_fonts():
+    # Every font in FONTS, with the URL of its file when it is shipped
+    global _fonts
+    if _fonts is None:
+        missing = missing_fonts()
+        _fonts = [
+            {'family': family, 'weight': weight,
+             'local': os.path.splitext(os.path.basename(filename))[0],
+             'url': None if filename in missing else asset_url(filename)}
+            for family, weight, filename in FONTS
+        ]
+    return _fonts
+
+# --- Page caching ---
+# Each level's page is rendered once with a marker where the delayed messages go,
+# and split around it. A request then only renders the (small) delayed messages
+# fragment, and whole pages are kept per (story, level, messages) since there are few combinations.
+# The caches hang off the GameLogic weakly, so a story's pages go away with the story
+# when a new pack is swapped in or the story catalog evicts it. Pages link to the routes,
+# so they are kept per script root too (the app may be mounted under a prefix).
+DELAYED_MARKER = '<!--delayed-messages-->'
+MAX_PAGES_PER_STORY = 1024
+MAX_GAME_OVER_PAGES_PER_STORY = 64
+
+class PageCache:
+    # Bounded LRU of rendered pages: the least recently served one goes first once it is full
+    def __init__(self, max_pages=MAX_PAGES_PER_STORY):
+        self.max_pages = max_pages
+        self._pages = OrderedDict() # key -> page, least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        # The page for key, from render() on a miss. Two threads missing together both
+        # render it, which is harmless: the pages are the same.
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+                return page
+        page = render()
+        with self._lock:
+            self._pages[key] = page
+            while len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def __len__(self):
+        return len(self._pages)
+
+_level_pages = WeakKeyDictionary()     # GameLogic -> {script root: {level: (html before the delayed messages, html after)}}
+_full_pages = WeakKeyDictionary()      # GameLogic -> PageCache of (script root, level, messages) -> (body, etag)
+_game_over_pages = WeakKeyDictionary() # GameLogic -> PageCache of (message, is_ending, restart URL) -> page
+
+def _story_pages(caches, logic, max_pages):
+    pages = caches.get(logic)
+    if pages is None:
+        pages = caches.setdefault(logic, PageCache(max_pages))
+    return pages
+
+def _render_level(logic, level, delayed_block):
+    scenario = logic.get_scenario(level)
+    return render_template('game.html',
+                           scenario=scenario.description,
+                           options=scenario.options,
+                           level_number=level,
+                           total_levels=logic.total_levels,
+                           delayed_block=delayed_block,
+                           immediate_message="") # Pass immediate_message if you implement it
+
+def _prerender_levels(logic):
+    # Done on the first request for each story and script root, or by warm_up before that
+    by_root = _level_pages.get(logic)
+    if by_root is None:
+        by_root = _level_pages.setdefault(logic, {})
+    pages = by_root.get(request.script_root)
+    if pages is None:
+        pages = {}
+        for level, scenario in logic.levels.items():
+            if scenario.options:
+                head, tail = _render_level(logic, level, Markup(DELAYED_MARKER)).split(DELAYED_MARKER)
+                pages[level] = (head, tail)
+        by_root[request.script_root] = pages
+    return pages
+
+def _render_delayed(delayed_messages):
+    if not delayed_messages:
+        return Markup("")
+    return Markup(render_template('_delayed_messages.html', delayed_messages=delayed_messages))
+
+def _level_page(logic, level, delayed_messages):
+    def render():
+        head, tail = _prerender_levels(logic)[level]
+        body = ''.join((head, _render_delayed(delayed_messages), tail)).encode('utf-8')
+        return body, hashlib.sha1(body).hexdigest()
+    pages = _story_pages(_full_pages, logic, MAX_PAGES_PER_STORY)
+    return pages.get((request.script_root, level, delayed_messages), render)
+
+# Game over pages are few (a story's endings, its dead ends and the undefined path page)
+# and every run ends on one, so they are also kept compressed, once, at the highest
+# levels: a request only picks the variant the browser accepts.
+def _game_over_page(logic, message, is_ending, restart_url):
+    # (body, etag, ((encoding, compressed body, etag), ...) smallest first)
+    def render():
+        body = render_template('game_over.html', message=message, is_ending=is_ending,
+                               restart_url=restart_url).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        encoded = []
+        if brotli is not None:
+            encoded.append(('br', brotli.compress(body, quality=11)))
+        encoded.append(('gzip', gzip.compress(body, compresslevel=9, mtime=0)))
+        return body, etag, tuple((encoding, data, f'{etag}-{encoding}') for encoding, data in encoded)
+    pages = _story_pages(_game_over_pages, logic, MAX_GAME_OVER_PAGES_PER_STORY)
+    return pages.get((message, is_ending, restart_url), render)
+
+def _game_over_messages(logic):
+    # Every (message, is_ending) a run of this story can end on, as play_game picks them
+    for ending in logic.levels[logic.total_levels].endings.values() if logic.total_levels in logic.levels else ():
+        yield ending, True
+    for scenario in logic.levels.values():
+        if not scenario.options:
+            yield scenario.description or DEAD_END_MESSAGE, True
+    yield UNDEFINED_PATH_MESSAGE, False
+
+def pick_encoding(page, accept_encodings):
+    # (body, etag, Content-Encoding or None) of a game over page, for an Accept-Encoding
+    # header parsed by werkzeug (a variant is only sent when its quality is above 0)
+    body, etag, encoded = page
+    for encoding, data, encoded_etag in encoded:
+        if accept_encodings[encoding]:
+            return data, encoded_etag, encoding
+    return body, etag, None
+
+def _cached_response(page):
+    body, etag = page
+    response = current_app.response_class(body, mimetype='text/html')
+    response.set_etag(etag)
+    # The page depends on the player's session, so browsers must revalidate every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+def render_game_over(message, is_ending=False):
+    _, logic = current_story()
+    restart_url = url_for('.index')
+    with phase('render'):
+        if current_app.config['PAGE_CACHE']:
+            body, etag, encoding = pick_encoding(_game_over_page(logic, message, is_ending, restart_url),
+                                                 request.accept_encodings)
+            response = _cached_response((body, etag))
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+        return render_template('game_over.html', message=message, is_ending=is_ending, restart_url=restart_url)
+
+def render_level(level, delayed_messages):
+    _, logic = current_story()
+    with phase('render'):
+        if current_app.config['PAGE_CACHE']:
+            return _cached_response(_level_page(logic, level, tuple(delayed_messages)))
+        return _render_level(logic, level, _render_delayed(delayed_messages))
+
+@bp.before_app_request
+def reload_scenario_pack():
+    reloader = current_app.extensions.get('scenario_pack')
+    if reloader is not None:
+        content = reloader.poll()
+        if content is not None:
+            try:
+                install_game_logic(build_story(content, reloader.path))
+            except PackError as exc:
+                current_app.logger.warning("Keeping the current story, new pack rejected: %s", exc)
+
+# --- Duplicate choices ---
+# Every form carries the level it was rendered for (the 'level' field), so a resubmitted
+# or double-clicked form can be told from a new choice without a per-player nonce, which
+# would rule out the shared page cache.
+# With a session store, the requests of one run also take turns from load_state to
+# save_state (run_lock), or a late duplicate could save over a choice made after it.
+# Both the ledger and the locks are per process: with several workers, duplicates sent
+# to different workers are only told apart by their level, as without them.
+MAX_LEDGER_CHOICES = 32768
+RUN_LOCK_STRIPES = 64
+
+class ChoiceLedger:
+    # The choice made on each level of the latest runs in this process, oldest first
+    def __init__(self, max_choices=MAX_LEDGER_CHOICES, lock_stripes=RUN_LOCK_STRIPES):
+        self.max_choices = max_choices
+        self._choices = OrderedDict() # (story ID, seed, level) -> option key
+        self._lock = threading.Lock()
+        # Runs share a lock when their keys hash alike, which only makes them wait on each other
+        self._run_locks = [threading.Lock() for _ in range(lock_stripes)]
+        self.duplicates = 0
+        self.stale = 0
+
+    def run_lock(self, story_id, run_id):
+        return self._run_locks[hash((story_id, run_id)) % len(self._run_locks)]
+
+    def resolve(self, story_id, state, level, token, choice):
+        # (option to apply, whether it is a new choice), or (None, False) for a form from
+        # another level: nothing changes and the player is shown where the run is now.
+        # A second submission for the level gets the first one's choice again, so it
+        # leads to the same state (and cookie) and isn't recorded twice.
+        if token is not None and str(token) != str(level):
+            self.stale += 1
+            return None, False
+        if 'seed' not in state:
+            return choice, True # No run to tell submissions apart by
+        key = (story_id, state['seed'], level)
+        with self._lock:
+            made = self._choices.get(key)
+            if made is None:
+                self._choices[key] = choice
+                if len(self._choices) > self.max_choices:
+                    self._choices.popitem(last=False)
+                return choice, True
+            self.duplicates += 1
+        return made, False
+
+def apply_choice(logic, state, level, choice):
+    # Records an already validated choice and advances the run; the caller saves the state
+    consequence_info = logic.get_scenario(level).options[choice].consequence
+
+    # Store the choice for ending determination and delayed consequences
+    state['past_choices'].append({
+        'level': level,
+        'choice': choice,
+        'is_wrong': consequence_info.is_wrong
+    })
+
+    logic.record_choice(state['ending_stats'], level, choice)
+
+    # Add to pending delayed consequences if applicable
+    logic.schedule_delayed(state['delayed_consequences_pending'], level, choice)
+
+    # Advance to the next level
+    state['current_level'] = level + 1
+    return consequence_info
+
+def ending_type_for(logic, state):
+    stats = state.get('ending_stats')
+    seed = state.get('seed', 0)
+    if stats:
+        return logic.ending_from_stats(stats, seed, state.get('past_choices', []))
+    return logic.determine_ending(state.get('past_choices', []), seed)
+
+def one_request_per_run(view):
+    # Runs the view holding its run's lock when the state lives in a session store. A
+    # cookie carries its own copy of the state, so there is nothing to serialize then.
+    @wraps(view)
+    def locked_view(*args, **kwargs):
+        lock = nullcontext()
+        if current_app.extensions['session_store'] is not None:
+            story_id, _ = current_story()
+            run_id = session.get(_session_key('run_id', story_id))
+            if run_id:
+                lock = current_app.extensions['choice_ledger'].run_lock(story_id, run_id)
+        with lock:
+            return view(*args, **kwargs)
+    return locked_view
+
+def limit_run(state, api=False):
+    # A 429 response when this run is making choices too fast, else None. Clients are
+    # limited before the app sees their requests (see create_app); runs without a seed
+    # (no session yet) only count against their client.
+    limiters = current_app.extensions['rate_limits']
+    if limiters is not None and 'seed' in state:
+        wait = limiters[1].hit('run:' + telemetry_run_id(state))
+        if wait:
+            headers, body = too_many_requests(wait, api)
+            return current_app.response_class(body, 429, headers)
+    return None
+
+def telemetry_run_id(state):
+    # Runs are named by their seed in telemetry, never by the run_id that unlocks the stored state
+    return f"{state.get('seed', 0):012x}"
+
+def record_event(state, level, choice=None, is_wrong=None, ending=None):
+    # A choice, or with ending set, how the run ended; nothing at all without TELEMETRY
+    telemetry = current_app.extensions['telemetry']
+    if telemetry is not None:
+        story_id, _ = current_story()
+        telemetry.record(telemetry_run_id(state), story_id, level, choice, is_wrong, ending)
+
+def reveal_messages(state, level):
+    _, logic = current_story()
+    pending = state.get('delayed_consequences_pending', {})
+    with phase('delayed_scan'):
+        messages = logic.reveal_delayed(pending, level)
+    if messages:
+        # Only rewrite the session when a bucket was actually revealed
+        state['delayed_consequences_pending'] = pending
+        save_state(state)
+    return messages
+
+@bp.route('/')
 def index():
     # Initialize game state in session
-    session.clear() # Clear any previous session data
-    session['current_level'] = 1
-    session['past_choices'] = [] # Store {'level': X, 'choice': 'y', 'is_wrong': True/False}
-    session['delayed_consequences_pending'] = [] # Stores {'source_level': X, 'choice': 'y', 'reveal_level': Z}
-    return redirect(url_for('play_game'))
+    end_run() # Clear any previous session data
+    save_state(new_state(current_story()[1]))
+    return redirect(url_for('.play_game'))
 
-@app.route('/play', methods=['GET', 'POST'])
+@bp.route('/play', methods=['GET', 'POST'])
+@one_request_per_run
 def play_game():
-    current_level_num = session.get('current_level', 1)
+    _, logic = current_story()
+    state = load_state()
+    if state is None:
+        if request.method == 'POST':
+            return redirect(url_for('.index')) # No run to make the choice in, start a new one
+        state = new_state(logic)
+    current_level_num = state.get('current_level', 1)
 
     # Check if we're at the final level (Level 20)
-    if current_level_num > game_logic.total_levels:
-        ending_type = game_logic.determine_ending(session.get('past_choices', []))
-        ending_text = game_logic.get_ending(ending_type)
-        session.clear() # Clear session after game ends
-        return render_template('game_over.html', message=ending_text, is_ending=True)
+    if current_level_num > logic.total_levels:
+        ending_type = ending_type_for(logic, state)
+        record_event(state, current_level_num, ending=ending_type)
+        end_run() # Clear session after game ends
+        return render_game_over(logic.get_ending(ending_type), is_ending=True)
 
-    current_scenario = game_logic.get_scenario(current_level_num)
+    with phase('scenario_lookup'):
+        current_scenario = logic.get_scenario(current_level_num)
 
     # Handle POST request (player made a choice)
     if request.method == 'POST':
+        limited = limit_run(state)
+        if limited is not None:
+            return limited
         chosen_option_key = request.form.get('choice')
-        if not chosen_option_key or chosen_option_key not in current_scenario.get('options', {}):
+        options = current_scenario.options if current_scenario else {}
+        if not chosen_option_key or chosen_option_key not in options:
             # Invalid choice, re-render current level with an error or just ignore
-            return redirect(url_for('play_game')) # Simply re-render current state
-
-        consequence_info = current_scenario['consequences'].get(chosen_option_key)
-
-        # Store the choice for ending determination and delayed consequences
-        session['past_choices'].append({
-            'level': current_level_num,
-            'choice': chosen_option_key,
-            'is_wrong': consequence_info.get('is_wrong', False)
-        })
-
-        # Add to pending delayed consequences if applicable
-        if consequence_info.get('delayed_reveal_level') is not None:
-            session['delayed_consequences_pending'].append({
-                'source_level': current_level_num,
-                'choice': chosen_option_key,
-                'reveal_level': consequence_info['delayed_reveal_level']
-            })
+            return redirect(url_for('.play_game')) # Simply re-render current state
 
-        # Advance to the next level
-        session['current_level'] = current_level_num + 1
-        return redirect(url_for('play_game'))
+        chosen_option_key, new = current_app.extensions['choice_ledger'].resolve(
+            current_story()[0], state, current_level_num, request.form.get('level'), chosen_option_key)
+        if chosen_option_key is None:
+            return redirect(url_for('.play_game')) # A form from an earlier level, show the current one
+        consequence_info = apply_choice(logic, state, current_level_num, chosen_option_key)
+        save_state(state)
+        if new:
+            record_event(state, current_level_num, chosen_option_key, consequence_info.is_wrong)
+        return redirect(url_for('.play_game'))
 
     # Handle GET request (display current scenario)
     if not current_scenario:
         # This shouldn't happen if levels are sequential, but as a fallback
-        session.clear()
-        return render_template('game_over.html', message="An unknown error occurred or you've reached an undefined path.")
+        record_event(state, current_level_num, ending='undefined_level')
+        end_run()
+        return render_game_over(UNDEFINED_PATH_MESSAGE)
 
     # Check for delayed messages to display at this level
-    messages_to_display = []
-    # Create a new list for pending consequences to avoid modifying during iteration
-    newly_pending = []
-    for dc in session.get('delayed_consequences_pending', []):
-        if dc['reveal_level'] == current_level_num:
-            message = game_logic.get_delayed_message(dc['source_level'], dc['choice'])
-            if message: # Ensure there's a message to display
-                messages_to_display.append(message)
-        else:
-            newly_pending.append(dc) # Keep it if not yet due
-
-    session['delayed_consequences_pending'] = newly_pending # Update the session with remaining pending
+    messages_to_display = reveal_messages(state, current_level_num)
 
-    # Immediate consequence message (if any)
-    immediate_message = ""
+    # Immediate consequence message (if any), currently always "" (see _render_level)
     # This assumes 'immediate' message is from the *previous* choice that led to this level.
     # To display it correctly, the immediate message would need to be passed from the POST to the GET.
     # For simplicity, we'll focus on delayed for now, or you can add a 'last_immediate_message' to session.
 
     # For a level with no options (like a "consequence" or "dead end" level within the main flow)
-    if not current_scenario.get('options'):
-        message = current_scenario.get('description', "Your path ends here.")
-        session.clear() # Game over if no options
-        return render_template('game_over.html', message=message, is_ending=True)
+    if not current_scenario.options:
+        message = current_scenario.description or DEAD_END_MESSAGE
+        record_event(state, current_level_num, ending='dead_end')
+        end_run() # Game over if no options
+        return render_game_over(message, is_ending=True)
 
-    return render_template('game.html',
-                           scenario=current_scenario['description'],
-                           options=current_scenario['options'],
-                           level_number=current_level_num,
-                           total_levels=game_logic.total_levels,
-                           delayed_messages=messages_to_display,
-                           immediate_message=immediate_message) # Pass immediate_message if you implement it
+    return render_level(current_level_num, messages_to_display)
+
+@bp.route('/api/choice', methods=['POST'])
+@one_request_per_run
+def api_choice():
+    # Same rules as a POST to /play, but answers with the next level as JSON in one
+    # round trip. game.js uses it when available; the plain form flow still works without JS.
+    _, logic = current_story()
+    state = load_state()
+    if state is None:
+        # Same as a stale page: game.js follows location, here to start a new run
+        return jsonify(stale=True, error="no run", location=url_for('.index')), 409
+    current_level_num = state.get('current_level', 1)
+    with phase('scenario_lookup'):
+        current_scenario = logic.get_scenario(current_level_num)
+    limited = limit_run(state, api=True)
+    if limited is not None:
+        return limited
+    payload = request.get_json(silent=True) or {}
+    chosen_option_key = request.form.get('choice') or payload.get('choice')
+    options = current_scenario.options if current_scenario else {}
+    if not chosen_option_key or chosen_option_key not in options:
+        return jsonify(error="invalid choice", level=current_level_num), 400
+
+    chosen_option_key, new = current_app.extensions['choice_ledger'].resolve(
+        current_story()[0], state, current_level_num, request.form.get('level') or payload.get('level'),
+        chosen_option_key)
+    if chosen_option_key is None:
+        # The page was behind the run, game.js loads the current level
+        return jsonify(stale=True, level=current_level_num, location=url_for('.play_game'))
+    consequence_info = apply_choice(logic, state, current_level_num, chosen_option_key)
+    save_state(state)
+    if new:
+        record_event(state, current_level_num, chosen_option_key, consequence_info.is_wrong)
+
+    next_level = state['current_level']
+    with phase('scenario_lookup'):
+        next_scenario = logic.get_scenario(next_level)
+    if not next_scenario or not next_scenario.options:
+        # Endings and dead ends keep their own page, so send the browser there
+        return jsonify(game_over=True, location=url_for('.play_game'))
+
+    messages_to_display = reveal_messages(state, next_level)
+    with phase('render'):
+        return jsonify(
+            game_over=False,
+            level=next_level,
+            total_levels=logic.total_levels,
+            scenario=next_scenario.description,
+            options=[{'key': option.key, 'text': option.text} for option in next_scenario.options.values()],
+            immediate=consequence_info.immediate,
+            delayed_messages=messages_to_display,
+            delayed_html=_render_delayed(messages_to_display),
+        )
+
+@bp.route('/metrics')
+def serve_metrics():
+    metrics = current_app.extensions['metrics']
+    if metrics is None:
+        abort(404)
+    return current_app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+stories_bp.add_url_rule('/', view_func=index)
+stories_bp.add_url_rule('/play', view_func=play_game, methods=['GET', 'POST'])
+stories_bp.add_url_rule('/api/choice', view_func=api_choice, methods=['POST'])
+
+class TimedSessionInterface(SecureCookieSessionInterface):
+    # Flask's signed cookie, with its decoding and encoding timed as session phases (METRICS=1)
+    def open_session(self, app, request):
+        with phase('session_decode'):
+            return super().open_session(app, request)
+
+    def save_session(self, app, session, response):
+        with phase('session_encode'):
+            return super().save_session(app, session, response)
+
+def _name_route():
+    # Requests are counted per endpoint, e.g. game.play_game, never per raw path
+    timer = current_timer()
+    if timer is not None:
+        timer.route = request.endpoint
+
+def warm_up(app):
+    # Everything the first request would otherwise pay for: compiling the templates
+    # (most of it) and, with the page cache, rendering (and compressing) the main
+    # story's level and game over pages. Pages link to the routes, so they are rendered
+    # under the SCRIPT_NAME the server will see; a different root still works, it just
+    # renders its own on first use.
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    if app.config['PAGE_CACHE']:
+        base_url = 'http://localhost' + os.environ.get('SCRIPT_NAME', '')
+        with app.test_request_context('/play', base_url=base_url):
+            for level in _prerender_levels(game_logic):
+                _level_page(game_logic, level, ())
+            restart_url = url_for('.index')
+            for message, is_ending in _game_over_messages(game_logic):
+                _game_over_page(game_logic, message, is_ending, restart_url)
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(config_from_env())
+    if config:
+        app.config.update(config)
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError("SECRET_KEY must be set, and be the same for every worker process")
+    if app.config['TEMPLATE_CACHE']:
+        # Jinja versions the cached bytecode itself, stale entries are just recompiled
+        os.makedirs(app.config['TEMPLATE_CACHE'], exist_ok=True)
+        app.jinja_options = {**app.jinja_options,
+                             'bytecode_cache': FileSystemBytecodeCache(app.config['TEMPLATE_CACHE'])}
+
+    options = {'ttl': app.config['SESSION_TTL']}
+    if app.config['SESSION_STORE'] == 'memory':
+        options['max_runs'] = app.config['SESSION_MAX_RUNS']
+    elif app.config['SESSION_STORE'] == 'sqlite':
+        options['path'] = app.config['SESSION_DB']
+    app.extensions['session_store'] = create_store(app.config['SESSION_STORE'], **options)
+
+    if app.config['SCENARIO_PACK']:
+        # A broken pack stops startup here (PackError); later ones are only logged
+        reloader = PackReloader(app.config['SCENARIO_PACK'], app.config['SCENARIO_RELOAD'])
+        install_game_logic(build_story(reloader.load(), reloader.path))
+        app.extensions['scenario_pack'] = reloader
+    # Every boot checks the story it serves, so an edit to the built-in one can't ship broken either
+    findings = check_story(game_logic, FALLBACK_ENDINGS)
+    errors = [finding.message for finding in findings if finding.severity == ERROR]
+    if errors:
+        raise PackError('<built-in story>', errors)
+    if findings:
+        app.logger.info("The story has %d content warnings, python story_check.py lists them", len(findings))
+
+    if app.config['STORY_DIR']:
+        app.extensions['story_catalog'] = StoryCatalog(
+            app.config['STORY_DIR'], build_story,
+            max_stories=app.config['STORY_CACHE_SIZE'], reload_interval=app.config['SCENARIO_RELOAD'])
+
+    telemetry = None
+    if app.config['TELEMETRY']:
+        telemetry = Telemetry(create_sink(app.config['TELEMETRY']), capacity=app.config['TELEMETRY_BUFFER'],
+                              interval=app.config['TELEMETRY_FLUSH'])
+    app.extensions['telemetry'] = telemetry
+    app.extensions['choice_ledger'] = ChoiceLedger()
+
+    limiters = None
+    if app.config['RATE_LIMIT']:
+        options = {'path': app.config['RATE_LIMIT_DB']} if app.config['RATE_LIMIT'] == 'sqlite' else {}
+        limiters = (
+            create_limiter(app.config['RATE_LIMIT'], app.config['RATE_LIMIT_RATE'],
+                           app.config['RATE_LIMIT_BURST'], **options),
+            create_limiter(app.config['RATE_LIMIT'], app.config['RATE_LIMIT_RUN_RATE'],
+                           app.config['RATE_LIMIT_RUN_BURST'], **options),
+        )
+        app.wsgi_app = limit_clients(app.wsgi_app, limiters[0])
+    app.extensions['rate_limits'] = limiters # (per client IP, per run)
+    if app.config['TRUSTED_PROXIES']:
+        # Outside limit_clients, so the limits see the client's address, not the proxy's
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
+    metrics = None
+    if app.config['METRICS']:
+        metrics = Metrics(app.config['METRICS_PROFILE_DIR'], app.config['METRICS_PROFILE_RATE'])
+        app.wsgi_app = metrics.wsgi_middleware(app.wsgi_app)
+        app.session_interface = TimedSessionInterface()
+        app.before_request(_name_route)
+        if 'story_catalog' in app.extensions:
+            metrics.add_collector(lambda: catalog_lines(app.extensions['story_catalog']))
+        if telemetry is not None:
+            metrics.add_collector(lambda: telemetry_lines(telemetry))
+    app.extensions['metrics'] = metrics
+
+    app.register_blueprint(bp)
+    app.register_blueprint(stories_bp) # Every story 404s without STORY_DIR
+    if app.config['WARM_START']:
+        warm_up(app)
+    return app
 
 if __name__ == '__main__':
-    # For production, use a more robust server like Gunicorn or Waitress
-    app.run(debug=True) # debug=True allows for automatic reloading on code changes
\ No newline at end of file
+    # Development server only. For production run wsgi.py under gunicorn (see gunicorn.conf.py).
+    # A single process can live with a throwaway key, so don't insist on SECRET_KEY here.
+    dev_app = create_app({'SECRET_KEY': os.environ.get('SECRET_KEY') or os.urandom(24)})
+    dev_app.run(debug=True) # debug=True allows for automatic reloading on code changes
\ No newline at end of file
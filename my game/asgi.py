@@ -0,0 +1,18 @@
+# ASGI entry point, for ASGI servers such as uvicorn:
+#   SECRET_KEY=... uvicorn asgi:app --workers 4
+# By default the game routes run natively on the event loop (async_app.py), with
+# async session stores, and only assets and static files go through Flask on a
+# pool of ASGI_THREADS threads (default 4). ASGI_MODE=wsgi puts every request
+# through that thread pool instead, i.e. plain Flask behind the a2wsgi adapter.
+import os
+
+if os.environ.get('ASGI_MODE', 'async') == 'wsgi':
+    from a2wsgi import WSGIMiddleware
+
+    from wsgi import app as wsgi_app
+
+    app = WSGIMiddleware(wsgi_app, workers=int(os.environ.get('ASGI_THREADS', 4)))
+else:
+    from async_app import create_async_app
+
+    app = create_async_app()
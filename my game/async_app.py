@@ -0,0 +1,462 @@
+# Asyncio-native front end (ASGI). Serves /, /play and /api/choice with the same
+# rules, templates, pages and session cookies as the Flask app in app.py, but a
+# request never holds a thread while it waits on the network or the session store,
+# so one worker can keep thousands of mostly idle players connected:
+#   SECRET_KEY=... uvicorn asgi:app --workers 4
+# GameLogic stays synchronous and shared. Everything else (assets, static files,
+# unknown paths) falls through to the Flask app on a small thread pool.
+from contextlib import nullcontext
+from urllib.parse import parse_qsl
+import asyncio
+import json
+import os
+import secrets
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from werkzeug.http import parse_accept_header
+
+from app import (DEAD_END_MESSAGE, RUN_KEYS, RUN_LOCK_STRIPES, UNDEFINED_PATH_MESSAGE, PageCache, _game_over_page,
+                 _level_page, _render_delayed, _render_level, apply_choice, build_story, create_app,
+                 ending_type_for, is_legacy_run, new_state, pick_encoding, run_fits, telemetry_run_id,
+                 upgrade_state)
+import app
+from metrics import phase
+from ratelimit import forwarded_client, too_many_requests
+from scenario_pack import PackError
+from session_store import create_async_store
+
+
+class Session(dict):
+    # A cookie session that remembers whether it needs to be sent back, like Flask's
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.modified = False
+
+    def __setitem__(self, key, value):
+        self.modified = True
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.modified = True
+        super().__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        self.modified = True
+        super().update(*args, **kwargs)
+
+    def clear(self):
+        self.modified = True
+        super().clear()
+
+    def pop(self, key, *default):
+        if key in self:
+            self.modified = True
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.modified = True
+        return super().setdefault(key, default)
+
+
+class Request:
+    def __init__(self, scope, body, trusted_proxies=0):
+        self.method = scope['method']
+        self.root_path = scope.get('root_path', '')
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope['headers']}
+        # The client's address, taken from X-Forwarded-For behind TRUSTED_PROXIES as app.py does
+        self.client = forwarded_client((scope.get('client') or ('',))[0], self.headers.get('x-forwarded-for'),
+                                       trusted_proxies)
+        self.body = body
+
+    def cookie(self, name):
+        for part in self.headers.get('cookie', '').split(';'):
+            key, _, value = part.strip().partition('=')
+            if key == name:
+                return value
+        return None
+
+    def form(self, name):
+        if not self.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+            return None
+        return dict(parse_qsl(self.body.decode('utf-8', 'replace'))).get(name)
+
+    def json(self):
+        # Like request.get_json(silent=True)
+        if not self.headers.get('content-type', '').startswith('application/json'):
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+class AsyncGameApp:
+    def __init__(self, config=None):
+        # The Flask app provides config, templates, url building and the cookie signer,
+        # so sessions stay interchangeable between the two front ends
+        self.flask_app = create_app(config)
+        self.config = self.flask_app.config
+        self.compact = self.config['COMPACT_SESSION']
+        self.cookie_name = self.config['SESSION_COOKIE_NAME']
+        self.signer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+        self.max_age = int(self.flask_app.permanent_session_lifetime.total_seconds())
+
+        options = {'ttl': self.config['SESSION_TTL']}
+        if self.config['SESSION_STORE'] == 'memory':
+            options['max_runs'] = self.config['SESSION_MAX_RUNS']
+        elif self.config['SESSION_STORE'] == 'sqlite':
+            options['path'] = self.config['SESSION_DB']
+        self.store = create_async_store(self.config['SESSION_STORE'], **options)
+        self.telemetry = self.flask_app.extensions['telemetry']
+        self.metrics = self.flask_app.extensions['metrics'] # Shared, so /metrics covers both front ends
+        self.limiters = self.flask_app.extensions['rate_limits']
+        self.ledger = self.flask_app.extensions['choice_ledger'] # Shared, duplicates may come in through either
+        # The ledger's run locks are threading locks, which would block the event loop
+        self._run_locks = [asyncio.Lock() for _ in range(RUN_LOCK_STRIPES)]
+
+        self.fallback = WSGIMiddleware(self.flask_app, workers=int(os.environ.get('ASGI_THREADS', 4)))
+        self.routes = {
+            ('GET', '/'): self.index,
+            ('GET', '/play'): self.play_game,
+            ('POST', '/play'): self.play_game,
+            ('POST', '/api/choice'): self.api_choice,
+        }
+        # Same route names as the Flask endpoints in the metrics
+        self.route_names = {self.index: 'game.index', self.play_game: 'game.play_game',
+                            self.api_choice: 'game.api_choice'}
+        self._pages = PageCache() # (page function, root path, args) -> page, filled on first use
+        self._pages_logic = app.game_logic # The story self._pages were rendered from
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = self.routes.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+        if handler is None:
+            return await self.fallback(scope, receive, send)
+        reloader = self.flask_app.extensions.get('scenario_pack')
+        if reloader is not None:
+            content = reloader.poll()
+            if content is not None:
+                try:
+                    app.install_game_logic(build_story(content, reloader.path))
+                except PackError as exc:
+                    self.flask_app.logger.warning("Keeping the current story, new pack rejected: %s", exc)
+
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        request = Request(scope, b''.join(chunks), self.config['TRUSTED_PROXIES'])
+        timer = None
+        if self.metrics is not None:
+            timer = self.metrics.start()
+            timer.route = self.route_names[handler]
+        status = 500
+        try:
+            limited = await self.limit_client(request, handler)
+            if limited is not None:
+                session = Session()
+                status, headers, body = limited
+            else:
+                session = self.load_session(request)
+                async with self.run_lock(session):
+                    status, headers, body = await handler(request, session)
+            if session.modified:
+                headers.append((b'set-cookie', self.session_cookie(session)))
+                headers.append((b'vary', b'Cookie'))
+        finally:
+            if timer is not None:
+                self.metrics.finish(timer, status)
+        headers.append((b'content-length', str(len(body)).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.store is not None:
+                    await self.store.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # --- Session cookie, signed exactly like Flask's ---
+    def load_session(self, request):
+        value = request.cookie(self.cookie_name)
+        if not value:
+            return Session()
+        with phase('session_decode'):
+            try:
+                return Session(self.signer.loads(value, max_age=self.max_age))
+            except BadSignature:
+                return Session()
+
+    def session_cookie(self, session):
+        if not session:
+            return (f"{self.cookie_name}=; Expires=Thu, 01 Jan 1970 00:00:00 GMT; Max-Age=0; "
+                    "HttpOnly; Path=/").encode('latin-1')
+        with phase('session_encode'):
+            return f"{self.cookie_name}={self.signer.dumps(dict(session))}; HttpOnly; Path=/".encode('latin-1')
+
+    def run_lock(self, session):
+        # One request at a time per stored run, as one_request_per_run in app.py does
+        if self.store is None or 'run_id' not in session:
+            return nullcontext()
+        return self._run_locks[hash(session['run_id']) % len(self._run_locks)]
+
+    # --- Run state, the async twins of load_state/save_state/end_run in app.py ---
+    async def load_state(self, session):
+        with phase('session_decode'):
+            if self.store is not None:
+                run_id = session.get('run_id')
+                data = await self.store.get(run_id) if run_id else None
+            elif self.compact:
+                data = session.get('state')
+            else:
+                data = session if 'current_level' in session or 'past_choices' in session else None
+            if data is None:
+                return None # No run, as in app.py
+            legacy = is_legacy_run(data, self.compact)
+            try:
+                state = app.game_logic.decode_state(data) if self.compact else data
+                if legacy:
+                    upgrade_state(app.game_logic, state)
+                fits = run_fits(app.game_logic, state)
+            except (IndexError, KeyError, TypeError, ValueError):
+                fits = False
+        if not fits: # From a story swapped out since, start over as app.py does
+            await self.end_run(session)
+            return None
+        if legacy:
+            await self.save_state(session, state)
+        return state
+
+    async def save_state(self, session, state):
+        with phase('session_encode'):
+            data = app.game_logic.encode_state(state) if self.compact else state
+            if self.store is not None:
+                if 'run_id' not in session:
+                    session['run_id'] = secrets.token_urlsafe(16)
+                await self.store.put(session['run_id'], data)
+            elif self.compact:
+                session['state'] = data
+            elif state is not session:
+                session.update(state)
+
+    async def end_run(self, session):
+        if self.store is not None and 'run_id' in session:
+            with phase('session_encode'):
+                await self.store.delete(session['run_id'])
+        for key in RUN_KEYS: # Runs in /s/<story_id>/ stories share the cookie
+            session.pop(key, None)
+
+    def record_event(self, state, level, choice=None, is_wrong=None, ending=None):
+        if self.telemetry is not None:
+            self.telemetry.record(telemetry_run_id(state), None, level, choice, is_wrong, ending)
+
+    async def reveal_messages(self, session, state, level):
+        pending = state.get('delayed_consequences_pending', {})
+        with phase('delayed_scan'):
+            messages = app.game_logic.reveal_delayed(pending, level)
+        if messages:
+            state['delayed_consequences_pending'] = pending
+            await self.save_state(session, state)
+        return messages
+
+    # --- Rate limits, as limit_clients in ratelimit.py and limit_run in app.py ---
+    async def _wait(self, limiter, key):
+        if limiter.blocking: # The shared SQLite buckets, kept off the event loop
+            return await asyncio.to_thread(limiter.hit, key)
+        return limiter.hit(key)
+
+    def too_many_requests(self, wait, api):
+        headers, body = too_many_requests(wait, api)
+        return 429, [(name.lower().encode(), value.encode()) for name, value in headers], body
+
+    async def limit_client(self, request, handler):
+        if self.limiters is None:
+            return None
+        wait = await self._wait(self.limiters[0], 'ip:' + request.client)
+        return self.too_many_requests(wait, handler == self.api_choice) if wait else None
+
+    async def limit_run(self, state, api=False):
+        if self.limiters is None or 'seed' not in state:
+            return None
+        wait = await self._wait(self.limiters[1], 'run:' + telemetry_run_id(state))
+        return self.too_many_requests(wait, api) if wait else None
+
+    # --- Rendering ---
+    def _context(self, request):
+        # A request for a game route, so templates can resolve url_for('.play_game')
+        return self.flask_app.test_request_context('/play', base_url='http://localhost' + request.root_path)
+
+    def _page(self, request, render, *args):
+        # Pages are built once through Flask's templates, then served from here. They link
+        # to the routes, so each mount point (root_path) gets its own.
+        if self._pages_logic is not app.game_logic: # A new scenario pack was swapped in
+            self._pages.clear()
+            self._pages_logic = app.game_logic
+
+        def build():
+            with self._context(request):
+                return render(*args)
+        return self._pages.get((render, request.root_path, args), build)
+
+    def html(self, request, render, *args):
+        with phase('render'):
+            return self._html(request, render, *args)
+
+    def _html(self, request, render, *args):
+        if self.config['PAGE_CACHE']:
+            page = self._page(request, render, *args)
+            headers = [(b'content-type', b'text/html; charset=utf-8')]
+            if render is _game_over_page: # Kept compressed too, see app.py
+                body, etag, encoding = pick_encoding(page, parse_accept_header(request.headers.get('accept-encoding')))
+                if encoding is not None:
+                    headers.append((b'content-encoding', encoding.encode()))
+                headers.append((b'vary', b'Accept-Encoding'))
+            else:
+                body, etag = page
+            headers += [(b'etag', f'"{etag}"'.encode()), (b'cache-control', b'private, no-cache')]
+            if f'"{etag}"' in request.headers.get('if-none-match', ''):
+                return 304, headers, b''
+            return 200, headers, body
+        with self._context(request):
+            if render is _level_page:
+                _, level, messages = args
+                body = _render_level(app.game_logic, level, _render_delayed(messages))
+            else:
+                _, message, is_ending, restart_url = args
+                body = self.flask_app.jinja_env.get_template('game_over.html').render(
+                    message=message, is_ending=is_ending, restart_url=restart_url)
+        return 200, [(b'content-type', b'text/html; charset=utf-8')], body.encode('utf-8')
+
+    def render_game_over(self, request, message, is_ending=False):
+        return self.html(request, _game_over_page, app.game_logic, message, is_ending, request.root_path + '/')
+
+    def render_level(self, request, level, messages):
+        return self.html(request, _level_page, app.game_logic, level, tuple(messages))
+
+    def redirect(self, request, path):
+        location = (request.root_path + path).encode('latin-1')
+        body = b'<!doctype html>\n<title>Redirecting...</title>\n'
+        return 302, [(b'location', location), (b'content-type', b'text/html; charset=utf-8')], body
+
+    def json(self, status, **payload):
+        with phase('render'):
+            body = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8') + b'\n'
+        return status, [(b'content-type', b'application/json')], body
+
+    # --- Routes, same flow as the views in app.py ---
+    async def index(self, request, session):
+        await self.end_run(session)
+        await self.save_state(session, new_state(app.game_logic))
+        return self.redirect(request, '/play')
+
+    async def play_game(self, request, session):
+        state = await self.load_state(session)
+        if state is None:
+            if request.method == 'POST':
+                return self.redirect(request, '/')
+            state = new_state(app.game_logic)
+        level = state.get('current_level', 1)
+
+        if level > app.game_logic.total_levels:
+            ending_type = ending_type_for(app.game_logic, state)
+            self.record_event(state, level, ending=ending_type)
+            await self.end_run(session)
+            return self.render_game_over(request, app.game_logic.get_ending(ending_type), is_ending=True)
+
+        with phase('scenario_lookup'):
+            scenario = app.game_logic.get_scenario(level)
+
+        if request.method == 'POST':
+            limited = await self.limit_run(state)
+            if limited is not None:
+                return limited
+            choice = request.form('choice')
+            options = scenario.options if scenario else {}
+            if not choice or choice not in options:
+                return self.redirect(request, '/play')
+            choice, new = self.ledger.resolve(None, state, level, request.form('level'), choice)
+            if choice is None:
+                return self.redirect(request, '/play')
+            consequence_info = apply_choice(app.game_logic, state, level, choice)
+            await self.save_state(session, state)
+            if new:
+                self.record_event(state, level, choice, consequence_info.is_wrong)
+            return self.redirect(request, '/play')
+
+        if not scenario:
+            self.record_event(state, level, ending='undefined_level')
+            await self.end_run(session)
+            return self.render_game_over(request, UNDEFINED_PATH_MESSAGE)
+
+        messages = await self.reveal_messages(session, state, level)
+
+        if not scenario.options:
+            message = scenario.description or DEAD_END_MESSAGE
+            self.record_event(state, level, ending='dead_end')
+            await self.end_run(session)
+            return self.render_game_over(request, message, is_ending=True)
+
+        return self.render_level(request, level, messages)
+
+    async def api_choice(self, request, session):
+        state = await self.load_state(session)
+        if state is None:
+            return self.json(409, stale=True, error="no run", location=request.root_path + '/')
+        level = state.get('current_level', 1)
+        with phase('scenario_lookup'):
+            scenario = app.game_logic.get_scenario(level)
+        limited = await self.limit_run(state, api=True)
+        if limited is not None:
+            return limited
+        payload = request.json() or {}
+        choice = request.form('choice') or payload.get('choice')
+        options = scenario.options if scenario else {}
+        if not choice or choice not in options:
+            return self.json(400, error="invalid choice", level=level)
+
+        choice, new = self.ledger.resolve(None, state, level, request.form('level') or payload.get('level'), choice)
+        if choice is None:
+            return self.json(200, stale=True, level=level, location=request.root_path + '/play')
+        consequence_info = apply_choice(app.game_logic, state, level, choice)
+        await self.save_state(session, state)
+        if new:
+            self.record_event(state, level, choice, consequence_info.is_wrong)
+
+        next_level = state['current_level']
+        with phase('scenario_lookup'):
+            next_scenario = app.game_logic.get_scenario(next_level)
+        if not next_scenario or not next_scenario.options:
+            return self.json(200, game_over=True, location=request.root_path + '/play')
+
+        messages = await self.reveal_messages(session, state, next_level)
+        if messages:
+            with self._context(request):
+                delayed_html = str(_render_delayed(messages))
+        else:
+            delayed_html = ""
+        return self.json(
+            200,
+            game_over=False,
+            level=next_level,
+            total_levels=app.game_logic.total_levels,
+            scenario=next_scenario.description,
+            options=[{'key': option.key, 'text': option.text} for option in next_scenario.options.values()],
+            immediate=consequence_info.immediate,
+            delayed_messages=messages,
+            delayed_html=delayed_html,
+        )
+
+
+def create_async_app(config=None):
+    return AsyncGameApp(config)
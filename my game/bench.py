@@ -0,0 +1,1085 @@
+# Micro-benchmarks for the game. Run from this folder, e.g.:
+#   python bench.py scenario
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode
+import argparse
+import asyncio
+import gc
+import gzip
+import http.client
+import logging
+import multiprocessing
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+from werkzeug.serving import make_server
+
+from app import DEFAULT_DELAYED_MESSAGE, create_app, game_logic, load_state, new_state, record_event
+from metrics import phase
+from scenario_pack import write_pack
+from telemetry import SQLiteSink, Telemetry
+
+BENCH_SECRET_KEY = 'bench-only-secret'
+
+
+def _app(**config):
+    return create_app({'SECRET_KEY': BENCH_SECRET_KEY, **config})
+
+
+def bench_scenario(args):
+    # Every (source_level, choice) pair that can be scheduled for a delayed reveal
+    pairs = [(level.number, option.key)
+             for level in game_logic.levels.values()
+             for option in level.options.values()
+             if option.consequence.delayed_reveal_level is not None]
+
+    def rebuild_per_call():
+        # What get_delayed_message used to do: build the whole table, then look up
+        for source_level, choice in pairs:
+            game_logic._build_delayed_messages().get(source_level, {}).get(choice, DEFAULT_DELAYED_MESSAGE)
+
+    def compiled_lookup():
+        for source_level, choice in pairs:
+            game_logic.get_delayed_message(source_level, choice)
+
+    for name, fn in (('rebuild per call', rebuild_per_call), ('compiled table', compiled_lookup)):
+        seconds = min(timeit.repeat(fn, number=args.number, repeat=5))
+        per_call = seconds / (args.number * len(pairs)) * 1e9
+        print(f"{name:>18}: {per_call:8.1f} ns per get_delayed_message")
+
+
+def _legacy_reveal(pending, level):
+    # The old linear scan over a list of {'source_level', 'choice', 'reveal_level'} dicts
+    messages, still_pending = [], []
+    for dc in pending:
+        if dc['reveal_level'] == level:
+            messages.append(game_logic.get_delayed_message(dc['source_level'], dc['choice']))
+        else:
+            still_pending.append(dc)
+    return messages, still_pending
+
+
+def _play_legacy(path):
+    pending, shown = [], []
+    for level, choice in enumerate(path, start=1):
+        messages, pending = _legacy_reveal(pending, level)
+        shown.append(messages)
+        reveal_level = game_logic.levels[level].options[choice].consequence.delayed_reveal_level
+        if reveal_level is not None:
+            pending.append({'source_level': level, 'choice': choice, 'reveal_level': reveal_level})
+    shown.append(_legacy_reveal(pending, len(path) + 1)[0])
+    return shown
+
+
+def _play_bucketed(path):
+    pending, shown = {}, []
+    for level, choice in enumerate(path, start=1):
+        shown.append(game_logic.reveal_delayed(pending, level))
+        game_logic.schedule_delayed(pending, level, choice)
+    shown.append(game_logic.reveal_delayed(pending, len(path) + 1))
+    return shown
+
+
+def bench_pending(args):
+    rng = random.Random(args.seed)
+    paths = [[rng.choice('abcd') for _ in range(game_logic.total_levels - 1)]
+             for _ in range(args.paths)]
+
+    # Both structures must reveal the same messages, in the same order, at every level
+    differing = [path for path in paths if _play_legacy(path) != _play_bucketed(path)]
+    if differing:
+        sys.exit(f"{len(differing)} of {len(paths)} playthroughs reveal different messages, "
+                 f"e.g. {''.join(differing[0])}")
+    print(f"{len(paths)} sampled playthroughs reveal identical messages")
+
+    for name, fn in (('linear scan', _play_legacy), ('reveal buckets', _play_bucketed)):
+        seconds = min(timeit.repeat(lambda: [fn(path) for path in paths], number=1, repeat=5))
+        print(f"{name:>18}: {seconds / len(paths) * 1e6:8.1f} us per playthrough")
+
+
+def _state_after(path):
+    # The verbose session state as play_game leaves it after the given choices
+    state = {'current_level': 1, 'past_choices': [], 'delayed_consequences_pending': {}}
+    for level, choice in enumerate(path, start=1):
+        game_logic.reveal_delayed(state['delayed_consequences_pending'], level)
+        state['past_choices'].append({
+            'level': level,
+            'choice': choice,
+            'is_wrong': game_logic.levels[level].options[choice].consequence.is_wrong
+        })
+        game_logic.schedule_delayed(state['delayed_consequences_pending'], level, choice)
+        state['current_level'] = level + 1
+    return state
+
+
+def bench_session(args):
+    app = _app()
+    serializer = app.session_interface.get_signing_serializer(app)
+    rng = random.Random(args.seed)
+    path = [rng.choice('abcd') for _ in range(game_logic.total_levels - 1)]
+    state = _state_after(path)
+
+    decoded = game_logic.decode_state(game_logic.encode_state(state))
+    if (decoded['past_choices'], decoded['current_level']) != (state['past_choices'], state['current_level']):
+        sys.exit(f"the compact state doesn't decode to the run it encodes ({''.join(path)})")
+
+    variants = (
+        ('verbose', lambda: dict(state), lambda data: data),
+        ('compact', lambda: {'state': game_logic.encode_state(state)},
+         lambda data: game_logic.decode_state(data['state'])),
+    )
+    for name, build, unpack in variants:
+        cookie = serializer.dumps(build())
+
+        def round_trip():
+            unpack(serializer.loads(serializer.dumps(build())))
+
+        seconds = min(timeit.repeat(round_trip, number=args.number, repeat=5))
+        print(f"{name:>8}: {len(cookie):5d} byte cookie at level {state['current_level']}, "
+              f"{seconds / args.number * 1e6:7.1f} us per encode+decode")
+
+
+def _playthrough(client, path):
+    # One full run through the test client: start, every choice, then the final page
+    start = time.perf_counter()
+    client.get('/', follow_redirects=True)
+    for choice in path:
+        client.post('/play', data={'choice': choice}, follow_redirects=True)
+    client.get('/play')
+    return time.perf_counter() - start
+
+
+def _percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_store(args):
+    rng = random.Random(args.seed)
+    paths = [[rng.choice('abcd') for _ in range(game_logic.total_levels - 1)]
+             for _ in range(args.runs)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in args.backends:
+            app = _app(SESSION_STORE=kind, SESSION_DB=os.path.join(tmp, 'sessions.db'))
+
+            def worker(chunk):
+                client = app.test_client()
+                return [_playthrough(client, path) for path in chunk]
+
+            chunks = [paths[i::args.concurrency] for i in range(args.concurrency)]
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                timings = [t for chunk in pool.map(worker, chunks) for t in chunk]
+            print(f"{kind:>7}: p50 {_percentile(timings, 0.50) * 1e3:7.2f} ms, "
+                  f"p99 {_percentile(timings, 0.99) * 1e3:7.2f} ms, "
+                  f"mean {statistics.mean(timings) * 1e3:7.2f} ms per 19-choice playthrough")
+            store = app.extensions['session_store']
+            if store is not None and hasattr(store, 'close'):
+                store.close()
+
+
+def _serve(wsgi_app):
+    # Threaded werkzeug server on a free local port, stopped by the caller
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, wsgi_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _hammer(port, path, headers, seconds, concurrency):
+    # Requests per second for repeated GETs of one URL
+    deadline = time.perf_counter() + seconds
+
+    def worker(_):
+        done = 0
+        while time.perf_counter() < deadline:
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', path, headers=headers)
+            conn.getresponse().read()
+            conn.close()
+            done += 1
+        return done
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        return sum(pool.map(worker, range(concurrency))) / seconds
+
+
+def _session_cookie_at(app, level):
+    # A session cookie parked on the given level, with its delayed messages already shown
+    client = app.test_client()
+    client.get('/', follow_redirects=True)
+    for _ in range(level - 1):
+        client.post('/play', data={'choice': 'a'}, follow_redirects=True)
+    cookie = client.get_cookie('session')
+    return f"session={cookie.value}" if cookie else ""
+
+
+def bench_render(args):
+    for page_cache in (False, True):
+        app = _app(SESSION_STORE='cookie', PAGE_CACHE=page_cache)
+        headers = {'Cookie': _session_cookie_at(app, args.level)}
+        server = _serve(app)
+        try:
+            rps = _hammer(server.port, '/play', headers, args.seconds, args.concurrency)
+            line = f"page cache {'on ' if page_cache else 'off'}: {rps:8.1f} req/s"
+            if page_cache:
+                conn = http.client.HTTPConnection('127.0.0.1', server.port)
+                conn.request('GET', '/play', headers=headers)
+                etag = conn.getresponse().getheader('ETag')
+                conn.close()
+                revalidate = _hammer(server.port, '/play', dict(headers, **{'If-None-Match': etag}),
+                                     args.seconds, args.concurrency)
+                line += f", {revalidate:8.1f} req/s answering 304"
+            print(line)
+        finally:
+            server.shutdown()
+
+
+def bench_bytes(args):
+    # Bytes a browser downloads for one playthrough, with assets cached after first use.
+    # "inline" adds each page's stylesheets and scripts back into it, as the
+    # templates used to; "external" counts each asset once, compressed.
+    client = _app(SESSION_STORE='cookie').test_client()
+    headers = {'Accept-Encoding': 'br, gzip'}
+    pages = [client.get('/', follow_redirects=True)]
+    for choice in [random.Random(args.seed).choice('abcd') for _ in range(game_logic.total_levels - 1)]:
+        pages.append(client.post('/play', data={'choice': choice}, follow_redirects=True))
+
+    inline = external = 0
+    fetched = set()
+    for page in pages:
+        html = page.get_data()
+        inline += len(html)
+        external += len(html)
+        for url in re.findall(rb'<(?:link|script)[^>]*(?:href|src)="(/(?:assets|static)/[^"]+)"', html):
+            source = client.get(url.decode())
+            inline += len(source.get_data()) # Uncompressed, as it was inside the page
+            if url not in fetched:
+                fetched.add(url)
+                external += len(client.get(url.decode(), headers=headers).get_data())
+
+    print(f"{len(pages)} pages, {len(fetched)} assets")
+    print(f"  inline: {inline:8d} bytes per playthrough")
+    print(f"external: {external:8d} bytes per playthrough")
+
+
+def bench_api(args):
+    # Round trips, bytes and time per playthrough: form POST + redirect + GET per
+    # choice, against one /api/choice call per choice
+    app = _app(SESSION_STORE='cookie')
+    rng = random.Random(args.seed)
+    paths = [[rng.choice('abcd') for _ in range(game_logic.total_levels - 1)] for _ in range(args.runs)]
+
+    def form_flow(client, path):
+        responses = [client.get('/'), client.get('/play')]
+        for choice in path:
+            responses.append(client.post('/play', data={'choice': choice}))
+            responses.append(client.get('/play'))
+        return responses
+
+    def api_flow(client, path):
+        responses = [client.get('/'), client.get('/play')]
+        for choice in path:
+            responses.append(client.post('/api/choice', data={'choice': choice}))
+        if responses[-1].get_json().get('game_over'):
+            responses.append(client.get('/play')) # The ending page
+        return responses
+
+    for name, flow in (('form', form_flow), ('api', api_flow)):
+        client = app.test_client()
+        timings, requests, transferred = [], 0, 0
+        for path in paths:
+            start = time.perf_counter()
+            responses = flow(client, path)
+            timings.append(time.perf_counter() - start)
+            requests += len(responses)
+            transferred += sum(len(r.get_data()) for r in responses)
+        print(f"{name:>5}: {requests / len(paths):5.1f} requests, {transferred / len(paths) / 1024:7.1f} KiB, "
+              f"p50 {_percentile(timings, 0.5) * 1e3:7.2f} ms per playthrough")
+
+
+def _play_api(app, paths):
+    # Seconds per request over full playthroughs through the JSON API, and how many requests
+    client = app.test_client()
+    start = time.perf_counter()
+    requests = 0
+    for path in paths:
+        client.get('/')
+        for choice in path:
+            client.post('/api/choice', data={'choice': choice})
+        client.get('/play') # The ending page
+        requests += len(path) + 2
+    return (time.perf_counter() - start) / requests, requests
+
+
+def bench_telemetry(args):
+    # What recording a choice costs a request, and that the flush thread keeps up
+    rng = random.Random(args.seed)
+    paths = [[rng.choice('abcd') for _ in range(game_logic.total_levels - 1)] for _ in range(args.runs)]
+    with tempfile.TemporaryDirectory() as tmp:
+        telemetry = Telemetry(SQLiteSink(os.path.join(tmp, 'micro.db')))
+        per_call = min(timeit.repeat(lambda: telemetry.record('run', None, 3, 'a', True),
+                                     number=args.number, repeat=5)) / args.number
+        print(f"Telemetry.record(): {per_call * 1e6:6.2f} us per event (flushing to SQLite meanwhile)")
+
+        off = _app()
+        on = _app(TELEMETRY='sqlite:' + os.path.join(tmp, 'telemetry.db'))
+        # Everything a view adds for one choice: app lookups, the run's ID, record()
+        state = new_state(game_logic)
+        with on.test_request_context('/api/choice', method='POST'):
+            per_event = min(timeit.repeat(lambda: record_event(state, 3, 'a', True),
+                                          number=args.number, repeat=5)) / args.number
+        print(f"record_event() in a request: {per_event * 1e6:6.2f} us")
+        timings = {'off': [], 'on': []}
+        for _ in range(args.repeat): # Interleaved, best of each, to keep noise out of the difference
+            timings['off'].append(_play_api(off, paths)[0])
+            timings['on'].append(_play_api(on, paths)[0])
+        best_off, best_on = min(timings['off']), min(timings['on'])
+        print(f"end to end per request: off {best_off * 1e6:8.1f} us, on {best_on * 1e6:8.1f} us, "
+              f"difference {(best_on - best_off) * 1e6:+.1f} us (within run-to-run noise)")
+
+        recorder = on.extensions['telemetry']
+        recorder.flush()
+        rows = sum(1 for _ in recorder.sink.read())
+        print(f"{recorder.recorded} events recorded, {rows} written, {recorder.dropped} dropped")
+        if rows != recorder.recorded:
+            sys.exit(1)
+
+
+def bench_metrics(args):
+    # What the phase markers cost when METRICS is off, and that /metrics counts every request
+    rng = random.Random(args.seed)
+    paths = [[rng.choice('abcd') for _ in range(game_logic.total_levels - 1)] for _ in range(args.runs)]
+    off = _app()
+    on = _app(METRICS=True)
+
+    def marker():
+        with phase('render'):
+            pass
+    per_marker = min(timeit.repeat(marker, number=args.number, repeat=5)) / args.number
+
+    # Count the markers a playthrough passes through by watching calls to phase()
+    markers = 0
+    def count_calls(frame, event, arg):
+        nonlocal markers
+        if event == 'call' and frame.f_code is phase.__code__:
+            markers += 1
+    sys.setprofile(count_calls)
+    try:
+        _, requests = _play_api(off, paths[:1])
+    finally:
+        sys.setprofile(None)
+
+    timings = {'off': [], 'on': []}
+    for _ in range(args.repeat): # Interleaved, best of each
+        timings['off'].append(_play_api(off, paths)[0])
+        timings['on'].append(_play_api(on, paths)[0])
+    best_off, best_on = min(timings['off']), min(timings['on'])
+    disabled = per_marker * markers / requests
+    print(f"phase marker with metrics off: {per_marker * 1e9:6.1f} ns, {markers / requests:.1f} per request")
+    print(f"metrics off: {disabled * 1e6:.2f} us per request in markers, "
+          f"{disabled / best_off:.3%} of a {best_off * 1e6:.1f} us request")
+    print(f"metrics on: {best_on * 1e6:.1f} us per request, {(best_on - best_off) * 1e6:+.1f} us")
+
+    exposition = on.test_client().get('/metrics').get_data(as_text=True)
+    counted = sum(int(line.rsplit(' ', 1)[1]) for line in exposition.splitlines()
+                  if line.startswith('game_request_duration_seconds_count'))
+    expected = requests * args.runs * args.repeat
+    print(f"/metrics counted {counted} of {expected} requests")
+    if counted != expected or disabled > args.max_overhead * best_off:
+        sys.exit(1)
+
+
+WORDS = ("door", "shadow", "mirror", "key", "whisper", "candle", "stair", "echo", "dust", "clock",
+         "hallway", "portrait", "lullaby", "glass", "cold", "breath", "rust", "window", "floor", "name")
+
+
+def _synthetic_story(rng, levels):
+    # A random story shaped like the real one: 4 options per level, reveals a few levels on
+    def text(words):
+        return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+    story = {'title': text(3), 'rules': {'secret_path': [[1, 'a'], [levels - 1, 'b']],
+                                         'key_choices': [[1, 'a']], 'mirror_levels': [2]},
+             'levels': {}}
+    for number in range(1, levels):
+        options = {}
+        for key in 'abcd':
+            option = {'text': text(6), 'immediate': text(12), 'is_wrong': rng.random() < 0.5}
+            if number + 2 <= levels and rng.random() < 0.5:
+                option['delayed_reveal_level'] = rng.randint(number + 1, levels)
+                option['delayed_message'] = text(20)
+            options[key] = option
+        story['levels'][str(number)] = {'description': text(40), 'options': options}
+    story['levels'][str(levels)] = {'description': text(20), 'endings': {
+        ending: text(40) for ending in ('good', 'bad', 'neutral', 'secret')}}
+    return story
+
+
+def _rss():
+    # Current resident set size in bytes (Linux), else the peak
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_stories(args):
+    # Hundreds of synthetic stories served from one process through the story catalog.
+    # Memory must stay flat once the cache is full, however many stories are played.
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        ids = [f"story-{i:04d}" for i in range(args.stories)]
+        for story_id in ids:
+            write_pack(_synthetic_story(rng, args.levels), os.path.join(tmp, story_id + '.pack'))
+        app = _app(STORY_DIR=tmp, STORY_CACHE_SIZE=args.cache)
+        catalog = app.extensions['story_catalog']
+
+        def play(story_id):
+            client = app.test_client() # A new player each time, a cookie holds one run per story
+            client.get(f'/s/{story_id}/')
+            client.get(f'/s/{story_id}/play')
+            for _ in range(3):
+                client.post(f'/s/{story_id}/api/choice', data={'choice': rng.choice('abcd')})
+
+        gc.collect()
+        empty = _rss()
+        for story_id in ids[:args.cache]: # Fill the cache once, then measure from there
+            play(story_id)
+        gc.collect()
+        baseline, peak_loaded = _rss(), 0
+        print(f"{args.cache} cached stories: {(baseline - empty) / 2**20:.2f} MiB")
+        start = time.perf_counter()
+        for round_number in range(args.rounds):
+            order = ids[:]
+            rng.shuffle(order)
+            for story_id in order:
+                play(story_id)
+                peak_loaded = max(peak_loaded, len(catalog.loaded()))
+            gc.collect()
+            print(f"round {round_number + 1}: RSS {(_rss() - baseline) / 2**20:+7.2f} MiB over the full cache")
+        elapsed = time.perf_counter() - start
+
+    stats = catalog.stats.values()
+    hits, misses = sum(s.hits for s in stats), sum(s.misses for s in stats)
+    load_time = sum(s.load_seconds for s in stats)
+    growth = (_rss() - baseline) / 2**20
+    print(f"{args.stories} stories, cache {args.cache}: at most {peak_loaded} loaded, "
+          f"{hits} hits, {misses} misses ({hits / (hits + misses):.1%} hit rate), "
+          f"{load_time / misses * 1e3:.2f} ms per load, "
+          f"{sum(s.evictions for s in stats)} evictions, {elapsed:.1f}s")
+    ok = growth <= args.max_growth and peak_loaded <= args.cache
+    print(f"memory growth {growth:+.2f} MiB (bound {args.max_growth} MiB): {'ok' if ok else 'EXCEEDED'}")
+    if not ok:
+        sys.exit(1)
+
+
+# Servers compared by the capacity benchmark, each one worker process on one port
+CAPACITY_SERVERS = {
+    'gthread': lambda port, threads: (
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+        {'WEB_CONCURRENCY': '1', 'WEB_THREADS': str(threads), 'BIND': f'127.0.0.1:{port}'}),
+    'asgi-wsgi': lambda port, threads: (
+        [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(port), '--no-access-log'],
+        {'ASGI_MODE': 'wsgi', 'ASGI_THREADS': str(threads)}),
+    'asgi-async': lambda port, threads: (
+        [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(port), '--no-access-log'],
+        {'ASGI_MODE': 'async'}),
+}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(name, threads, store, **config):
+    # config: extra environment settings for the app, e.g. RATE_LIMIT='memory'
+    port = _free_port()
+    command, env = CAPACITY_SERVERS[name](port, threads)
+    env = {**os.environ, 'SECRET_KEY': BENCH_SECRET_KEY, 'SESSION_STORE': store, **config, **env}
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{name} did not start")
+
+
+async def _capacity_player(port, rng, deadline, think, latencies, counts):
+    # One player on one keep-alive connection, pausing between clicks like a reader would
+    reader = writer = None
+    cookie = ''
+
+    async def request(method, path, form=None):
+        nonlocal reader, writer, cookie
+        body = urlencode(form).encode() if form else b''
+        head = f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {len(body)}\r\n"
+        if form:
+            head += "Content-Type: application/x-www-form-urlencoded\r\n"
+        if cookie:
+            head += f"Cookie: {cookie}\r\n"
+        for attempt in range(2): # The server may have closed an idle connection
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            start = time.perf_counter()
+            try:
+                writer.write(head.encode() + b"\r\n" + body)
+                status = int((await reader.readuntil(b"\r\n")).split()[1])
+                length, close = 0, False
+                while (line := await reader.readuntil(b"\r\n")) != b"\r\n":
+                    name, _, value = line.decode('latin-1').partition(':')
+                    name, value = name.strip().lower(), value.strip()
+                    if name == 'content-length':
+                        length = int(value)
+                    elif name == 'connection':
+                        close = value.lower() == 'close'
+                    elif name == 'set-cookie':
+                        cookie = value.split(';', 1)[0]
+                        if cookie.endswith('='):
+                            cookie = ''
+                await reader.readexactly(length)
+            except (OSError, asyncio.IncompleteReadError, IndexError, ValueError):
+                writer.close()
+                reader = writer = None
+                if attempt:
+                    counts['errors'] += 1
+                    return
+                continue
+            latencies.append(time.perf_counter() - start)
+            counts['errors' if status >= 500 else 'ok'] += 1
+            if close:
+                writer.close()
+                reader = writer = None
+            return
+
+    try:
+        while time.perf_counter() < deadline:
+            await request('GET', '/')
+            await request('GET', '/play')
+            for level in range(1, game_logic.total_levels):
+                if time.perf_counter() >= deadline:
+                    return
+                await asyncio.sleep(rng.uniform(0, 2 * think))
+                await request('POST', '/play', {'choice': rng.choice('abcd')})
+                await request('GET', '/play')
+            counts['playthroughs'] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def _capacity_run(port, players, seconds, think, seed):
+    deadline = time.perf_counter() + seconds
+    latencies = []
+    counts = {'ok': 0, 'errors': 0, 'playthroughs': 0}
+    await asyncio.gather(*(
+        _capacity_player(port, random.Random(seed + i), deadline, think, latencies, counts)
+        for i in range(players)
+    ))
+    return latencies, counts
+
+
+def bench_capacity(args):
+    # Many concurrent, mostly idle players against one worker process of each server.
+    # Threaded servers need a thread per in-flight request; the async one does not.
+    for name in args.servers:
+        process, port = _start_server(name, args.threads, args.store)
+        try:
+            for players in args.players:
+                latencies, counts = asyncio.run(_capacity_run(port, players, args.seconds, args.think, args.seed))
+                print(f"{name:>10} {players:5d} players: {counts['ok'] / args.seconds:7.1f} req/s, "
+                      f"p50 {_percentile(latencies, 0.50) * 1e3:7.2f} ms, "
+                      f"p99 {_percentile(latencies, 0.99) * 1e3:8.2f} ms, "
+                      f"{counts['errors']} errors, {counts['playthroughs']} playthroughs")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+# Worker boot modes compared by the startup benchmark
+STARTUP_MODES = {'cold': {'WARM_START': '0'}, 'warm': {'WARM_START': '1'}}
+
+
+def _get(port, path, cookie='', method='GET', form=None, source='127.0.0.1', forwarded_for=None):
+    # (status, session cookie, seconds) for one request on a new connection. Any 127.x.y.z
+    # address can be the source on Linux, so one machine can pose as many clients; with
+    # forwarded_for the request comes through a (pretend) reverse proxy for that client.
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10, source_address=(source, 0))
+    headers = {'Cookie': cookie} if cookie else {}
+    if forwarded_for:
+        headers['X-Forwarded-For'] = forwarded_for
+    if form:
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    start = time.perf_counter()
+    conn.request(method, path, body=urlencode(form) if form else None, headers=headers)
+    response = conn.getresponse()
+    response.read()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    set_cookie = response.getheader('Set-Cookie')
+    return response.status, set_cookie.split(';', 1)[0] if set_cookie else cookie, elapsed
+
+
+def _worker_memory(master_pid):
+    # [(RSS, PSS, private) in bytes] per worker of a gunicorn master, from smaps_rollup (Linux).
+    # PSS splits shared pages between the processes sharing them, so it is the fair share.
+    with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+        pids = f.read().split()
+    usage = []
+    for pid in pids:
+        fields = {}
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if value.strip().endswith('kB'):
+                    fields[name] = int(value.split()[0]) * 1024
+        usage.append((fields['Rss'], fields['Pss'], fields['Private_Clean'] + fields['Private_Dirty']))
+    return usage
+
+
+def bench_startup(args):
+    # Boot gunicorn (preloaded, see gunicorn.conf.py) with and without WARM_START and time
+    # how long until the first game page is served, what that first page costs, and how
+    # much memory each worker ends up holding once every worker has served pages.
+    for mode in args.modes:
+        boots, firsts, rest, memory = [], [], [], []
+        for _ in range(args.repeat):
+            port = _free_port()
+            env = {**os.environ, 'SECRET_KEY': BENCH_SECRET_KEY, 'BIND': f'127.0.0.1:{port}',
+                   'WEB_CONCURRENCY': str(args.workers), **STARTUP_MODES[mode]}
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+                                       env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                while True:
+                    try:
+                        _, cookie, _ = _get(port, '/')
+                        status, _, first = _get(port, '/play', cookie)
+                        break
+                    except OSError:
+                        if time.perf_counter() - start > 30:
+                            raise RuntimeError("gunicorn did not start")
+                        time.sleep(0.005)
+                if status != 200:
+                    raise RuntimeError(f"GET /play gave {status}")
+                boots.append(time.perf_counter() - start)
+                firsts.append(first)
+                # Enough traffic for every worker to serve (and, cold, render) its pages
+                with ThreadPoolExecutor(8) as pool:
+                    rest.extend(pool.map(lambda _: _get(port, '/play', cookie)[2], range(args.requests)))
+                time.sleep(0.2)
+                if os.path.exists('/proc/self/smaps_rollup'):
+                    memory.extend(_worker_memory(process.pid))
+            finally:
+                process.terminate()
+                process.wait()
+        print(f"{mode:>5}: first page {statistics.median(boots) * 1e3:7.1f} ms after spawn, "
+              f"that request {statistics.median(firsts) * 1e3:6.2f} ms, "
+              f"later ones p50 {_percentile(rest, 0.50) * 1e3:5.2f} ms")
+        if memory:
+            rss, pss, private = (statistics.mean(column) / 2**20 for column in zip(*memory))
+            print(f"{'':>5}  per worker ({args.workers}): RSS {rss:6.2f} MiB, PSS {pss:6.2f} MiB, "
+                  f"private {private:6.2f} MiB")
+
+
+def _client_address(kind, index, proxied):
+    # (source address, X-Forwarded-For) of a bench client. Proxied clients all connect from
+    # the proxy's address and are only told apart by the header it adds.
+    address = f'127.0.{kind}.{index + 1}'
+    return ('127.0.0.1', address) if proxied else (address, None)
+
+
+def _flood(port, flooders, rate, seconds, results, proxied=False):
+    # Scripts restarting and replaying at `rate` requests per second in all, ignoring
+    # 429s. Run in a process of their own, so players' timings don't queue behind them.
+    deadline = time.perf_counter() + seconds
+    counts = {'served': 0, 'limited': 0, 'errors': 0}
+
+    def script(index):
+        source, forwarded_for = _client_address(1, index, proxied)
+        cookie = ''
+        due = time.perf_counter()
+        while time.perf_counter() < deadline:
+            for method, path, form in (('GET', '/', None), ('GET', '/play', None),
+                                       ('POST', '/play', {'choice': 'a'}), ('GET', '/play', None)):
+                due += flooders / rate
+                time.sleep(max(0, due - time.perf_counter()))
+                try:
+                    status, cookie, _ = _get(port, path, cookie, method, form, source, forwarded_for)
+                except OSError:
+                    counts['errors'] += 1
+                    continue
+                counts['limited' if status == 429 else 'served'] += 1
+
+    threads = [threading.Thread(target=script, args=(i,)) for i in range(flooders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(counts)
+
+
+def _player(port, index, proxied, rng, deadline, think, latencies, counts):
+    # A reader: a run at a time, a pause before every choice. A 429 is waited out
+    # (Retry-After) and counted, it should never happen to a player.
+    source, forwarded_for = _client_address(2, index, proxied)
+    while time.perf_counter() < deadline:
+        status, cookie, elapsed = _get(port, '/', source=source, forwarded_for=forwarded_for)
+        latencies.append(elapsed)
+        for level in range(1, game_logic.total_levels):
+            if status == 429:
+                counts['limited'] += 1
+                time.sleep(1)
+            if time.perf_counter() >= deadline:
+                return
+            status, _, elapsed = _get(port, '/play', cookie, source=source, forwarded_for=forwarded_for)
+            latencies.append(elapsed)
+            if status == 429:
+                counts['limited'] += 1
+                time.sleep(1)
+            time.sleep(rng.uniform(0, 2 * think))
+            status, cookie, elapsed = _get(port, '/play', cookie, 'POST', {'choice': rng.choice('abcd'), 'level': level},
+                                           source, forwarded_for)
+            latencies.append(elapsed)
+
+
+def bench_ratelimit(args):
+    # Players' latency against one gunicorn worker: alone, next to flooding scripts, and
+    # next to the same scripts with RATE_LIMIT on. Every client has its own loopback address.
+    # Then the same flood behind a reverse proxy: every client connects from the proxy's
+    # address and is named in X-Forwarded-For. Without TRUSTED_PROXIES the players share the
+    # flooders' bucket and get refused too; with it they must not be.
+    scenarios = (('baseline', 0, args.limiter, False, 0), ('flood', args.flooders, None, False, 0),
+                 ('flood+limit', args.flooders, args.limiter, False, 0),
+                 ('proxy+limit', args.flooders, args.limiter, True, 0),
+                 ('proxy+trusted', args.flooders, args.limiter, True, 1))
+    failed = False
+    for name, flooders, limiter, proxied, trusted in scenarios:
+        config = {'RATE_LIMIT': limiter, 'RATE_LIMIT_DB': os.path.join(tempfile.gettempdir(), 'bench_limits.db'),
+                  'TRUSTED_PROXIES': str(trusted)}
+        process, port = _start_server('gthread', args.threads, 'cookie',
+                                      **{key: value for key, value in config.items() if limiter})
+        latencies, player_counts = [], {'limited': 0}
+        flood_counts = {'served': 0, 'limited': 0, 'errors': 0}
+        results = multiprocessing.Queue()
+        flood = multiprocessing.Process(target=_flood, args=(port, flooders, args.flood_rate, args.seconds, results,
+                                                             proxied))
+        try:
+            if flooders:
+                flood.start()
+            deadline = time.perf_counter() + args.seconds
+            threads = [threading.Thread(target=_player, args=(port, i, proxied, random.Random(args.seed + i),
+                                                               deadline, args.think, latencies, player_counts))
+                       for i in range(args.players)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if flooders:
+                flood_counts = results.get()
+                flood.join()
+        finally:
+            process.terminate()
+            process.wait()
+        # Players must never be refused, unless they can't be told from the flooders
+        ok = name == 'proxy+limit' or not player_counts['limited']
+        failed |= not ok
+        print(f"{name:>13}: players p50 {_percentile(latencies, 0.50) * 1e3:6.2f} ms, "
+              f"p99 {_percentile(latencies, 0.99) * 1e3:7.2f} ms, {player_counts['limited']} limited; "
+              f"flood {flood_counts['served'] / args.seconds:6.0f} req/s served, "
+              f"{flood_counts['limited'] / args.seconds:6.0f} req/s refused{'' if ok else ': FAILED'}")
+    if failed:
+        sys.exit(1)
+
+
+def _level_shown(port, cookie):
+    # The level GET /play shows for a session cookie
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', '/play', headers={'Cookie': cookie})
+    match = re.search(rb'data-level="(\d+)"', conn.getresponse().read())
+    conn.close()
+    return int(match.group(1)) if match else None
+
+
+def _run_state(app, cookie):
+    # The run a session cookie leads to, loaded as the views load it (copied, in cookie
+    # mode that is the session itself)
+    with app.test_request_context('/play', headers={'Cookie': cookie}):
+        state = load_state()
+        return dict(state) if state is not None else None
+
+
+def _run_adds_up(state, level):
+    # A run on `level` holds one choice for each level before it, and its counters and
+    # pending reveals are the ones those choices make: none lost, none counted twice
+    if state is None or state['current_level'] != level:
+        return False
+    if [made['level'] for made in state['past_choices']] != list(range(1, level)):
+        return False
+    stats, pending = game_logic.new_ending_stats(), {}
+    for made in state['past_choices']:
+        game_logic.record_choice(stats, made['level'], made['choice'])
+        game_logic.schedule_delayed(pending, made['level'], made['choice'])
+    scheduled = [tuple(entry) for entries in pending.values() for entry in entries]
+    waiting = [tuple(entry) for entries in state['delayed_consequences_pending'].values() for entry in entries]
+    return (stats == state['ending_stats']
+            and stats['sanity_lost'] == sum(made['is_wrong'] for made in state['past_choices'])
+            and len(set(waiting)) == len(waiting) and set(waiting) <= set(scheduled))
+
+
+def bench_duplicates(args):
+    # Every choice submitted several times at once (double clicks, resubmits), through
+    # both endpoints and every session store, then once more after the fact. As soon as
+    # the first copy is answered the player picks the next level's option, while the other
+    # copies may still be between loading the run and saving it: --delay holds every
+    # request there for up to that long. Each level must advance exactly once: one state a
+    # level on, a run whose choices and counters add up, one telemetry event per level.
+    rng = random.Random(args.seed)
+    failures = 0
+    last_level = game_logic.total_levels - 1
+    with tempfile.TemporaryDirectory() as tmp:
+        for store in args.stores:
+            for path in ('/play', '/api/choice'):
+                sink = os.path.join(tmp, f'{store}-{path.strip("/").replace("/", "-")}.db')
+                app = _app(SESSION_STORE=store, SESSION_DB=os.path.join(tmp, 'sessions.db'), TELEMETRY='sqlite:' + sink)
+                ledger = app.extensions['choice_ledger']
+                if args.delay:
+                    resolve = ledger.resolve
+
+                    def delayed_resolve(*resolve_args):
+                        time.sleep(random.uniform(0, args.delay))
+                        return resolve(*resolve_args)
+                    ledger.resolve = delayed_resolve
+                server = _serve(app)
+                barrier = threading.Barrier(args.duplicates)
+                bad_levels = 0
+                start = time.perf_counter()
+
+                def submit(cookie, level, choice):
+                    barrier.wait()
+                    return _get(server.port, path, cookie, 'POST', {'choice': choice, 'level': level})
+
+                try:
+                    with ThreadPoolExecutor(args.duplicates) as pool:
+                        for _ in range(args.runs):
+                            _, cookie, _ = _get(server.port, '/')
+                            level = 1
+                            while level <= last_level:
+                                copied = level
+                                choices = [rng.choice('abcd') for _ in range(args.duplicates)]
+                                copies = [pool.submit(submit, cookie, copied, choice) for choice in choices]
+                                cookie = next(as_completed(copies)).result()[1]
+                                level += 1
+                                if level <= last_level:
+                                    _, cookie, _ = _get(server.port, path, cookie, 'POST',
+                                                        {'choice': rng.choice('abcd'), 'level': level})
+                                    level += 1
+                                returned = [copy.result()[1] for copy in copies]
+                                _get(server.port, path, cookie, 'POST', {'choice': choices[0], 'level': copied})
+                                if level > last_level:
+                                    continue # The next GET would end the run
+                                # Whichever response the browser ends up keeping, it shows the level
+                                # after the copies' (cookies) or wherever the run is now (stores)
+                                shown = {_level_shown(server.port, copy_cookie) for copy_cookie in returned}
+                                state = _run_state(app, cookie)
+                                if (shown != {copied + 1 if store == 'cookie' else level}
+                                        or _level_shown(server.port, cookie) != level or not _run_adds_up(state, level)):
+                                    bad_levels += 1
+                finally:
+                    server.shutdown()
+                elapsed = time.perf_counter() - start
+
+                telemetry = app.extensions['telemetry']
+                telemetry.flush()
+                per_level = Counter((run_id, level) for _, run_id, _, level, choice, _, _ in telemetry.sink.read()
+                                    if choice is not None)
+                expected = args.runs * last_level
+                ok = not bad_levels and len(per_level) == expected and set(per_level.values()) == {1}
+                failures += not ok
+                print(f"{store:>7} {path:<11}: {args.runs * last_level * args.duplicates} copies, "
+                      f"{sum(per_level.values())} choices recorded for {expected} levels, "
+                      f"{ledger.duplicates} replayed, {ledger.stale} stale, {bad_levels} checks off, "
+                      f"{elapsed:.1f}s: {'ok' if ok else 'FAILED'}")
+                store_backend = app.extensions['session_store']
+                if store_backend is not None and hasattr(store_backend, 'close'):
+                    store_backend.close()
+    if failures:
+        sys.exit(1)
+
+
+def bench_endings(args):
+    # The page a finished run lands on, for a story whose final level is played (the
+    # built-in one stops on level 20): rendered per request, cached as before, and the
+    # compressed variants the cache now keeps. The cookie stays parked past the final
+    # level, so every request is a run ending.
+    story = _synthetic_story(random.Random(args.seed), args.levels)
+    story['levels'][str(args.levels)]['options'] = {key: {'text': key, 'immediate': key} for key in 'ab'}
+    variants = (('rendered', False, 'br, gzip'), ('identity', True, ''),
+                ('gzip', True, 'gzip'), ('br', True, 'br, gzip'))
+    with tempfile.TemporaryDirectory() as tmp:
+        pack = os.path.join(tmp, 'endings.pack')
+        write_pack(story, pack)
+        for name, page_cache, accept in variants:
+            app = _app(SCENARIO_PACK=pack, SCENARIO_RELOAD=0, PAGE_CACHE=page_cache)
+            client = app.test_client()
+            client.get('/')
+            for level in range(1, args.levels + 1):
+                client.post('/play', data={'choice': 'a', 'level': level})
+            headers = {'Cookie': f"session={client.get_cookie('session').value}", 'Accept-Encoding': accept}
+
+            response = client.get('/play', headers=headers)
+            if b'message-text' not in _decoded(response.get_data(), response.headers.get('Content-Encoding')):
+                sys.exit(f"{name}: not an ending page")
+            per_request = min(timeit.repeat(lambda: client.get('/play', headers=headers),
+                                            number=args.number, repeat=5)) / args.number
+            server = _serve(app)
+            try:
+                rps = _hammer(server.port, '/play', headers, args.seconds, args.concurrency)
+            finally:
+                server.shutdown()
+            print(f"{name:>9}: {len(response.get_data()):6d} bytes (Content-Length "
+                  f"{response.headers.get('Content-Length')}), {per_request * 1e6:7.1f} us per request "
+                  f"in process, {rps:8.1f} req/s over HTTP")
+
+
+def _decoded(body, encoding):
+    if encoding == 'br':
+        import brotli
+        return brotli.decompress(body)
+    return gzip.decompress(body) if encoding == 'gzip' else body
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Echoes of Doubt benchmarks")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    scenario = sub.add_parser('scenario', help="delayed message lookups")
+    scenario.add_argument('--number', type=int, default=2000)
+    scenario.set_defaults(func=bench_scenario)
+
+    pending = sub.add_parser('pending', help="delayed consequence bookkeeping over sampled playthroughs")
+    pending.add_argument('--paths', type=int, default=20000)
+    pending.add_argument('--seed', type=int, default=0)
+    pending.set_defaults(func=bench_pending)
+
+    session = sub.add_parser('session', help="cookie size and (de)serialization cost at the last level")
+    session.add_argument('--number', type=int, default=2000)
+    session.add_argument('--seed', type=int, default=0)
+    session.set_defaults(func=bench_session)
+
+    store = sub.add_parser('store', help="full playthrough latency for each session store backend")
+    store.add_argument('--runs', type=int, default=200)
+    store.add_argument('--concurrency', type=int, default=4)
+    store.add_argument('--seed', type=int, default=0)
+    store.add_argument('--backends', nargs='+', default=['cookie', 'memory', 'sqlite'])
+    store.set_defaults(func=bench_store)
+
+    render = sub.add_parser('render', help="GET /play throughput under a threaded WSGI server")
+    render.add_argument('--level', type=int, default=10)
+    render.add_argument('--seconds', type=float, default=3)
+    render.add_argument('--concurrency', type=int, default=8)
+    render.set_defaults(func=bench_render)
+
+    transfer = sub.add_parser('bytes', help="bytes transferred per playthrough, inline vs external assets")
+    transfer.add_argument('--seed', type=int, default=0)
+    transfer.set_defaults(func=bench_bytes)
+
+    api = sub.add_parser('api', help="round trips and latency per playthrough, form flow vs JSON API")
+    api.add_argument('--runs', type=int, default=100)
+    api.add_argument('--seed', type=int, default=0)
+    api.set_defaults(func=bench_api)
+
+    capacity = sub.add_parser('capacity', help="latency under many concurrent players, threaded vs async servers")
+    capacity.add_argument('--players', type=int, nargs='+', default=[100, 500, 1000])
+    capacity.add_argument('--seconds', type=float, default=10)
+    capacity.add_argument('--think', type=float, default=0.5, help="mean pause between choices, seconds")
+    capacity.add_argument('--threads', type=int, default=4, help="threads per worker for the threaded servers")
+    capacity.add_argument('--store', default='memory', choices=('cookie', 'memory', 'sqlite'))
+    capacity.add_argument('--servers', nargs='+', default=list(CAPACITY_SERVERS), choices=list(CAPACITY_SERVERS))
+    capacity.add_argument('--seed', type=int, default=0)
+    capacity.set_defaults(func=bench_capacity)
+
+    telemetry = sub.add_parser('telemetry', help="per-request cost of recording choice telemetry")
+    telemetry.add_argument('--runs', type=int, default=50)
+    telemetry.add_argument('--repeat', type=int, default=3)
+    telemetry.add_argument('--number', type=int, default=100000, help="record() calls to time")
+    telemetry.add_argument('--seed', type=int, default=0)
+    telemetry.set_defaults(func=bench_telemetry)
+
+    metrics = sub.add_parser('metrics', help="cost of the request metrics, off and on")
+    metrics.add_argument('--runs', type=int, default=50)
+    metrics.add_argument('--repeat', type=int, default=3)
+    metrics.add_argument('--number', type=int, default=1000000, help="phase markers to time")
+    metrics.add_argument('--max-overhead', type=float, default=0.01,
+                         help="fraction of a request the markers may cost with metrics off")
+    metrics.add_argument('--seed', type=int, default=0)
+    metrics.set_defaults(func=bench_metrics)
+
+    stories = sub.add_parser('stories', help="memory and cache behaviour with hundreds of stories")
+    stories.add_argument('--stories', type=int, default=300)
+    stories.add_argument('--levels', type=int, default=20)
+    stories.add_argument('--cache', type=int, default=16, help="STORY_CACHE_SIZE")
+    stories.add_argument('--rounds', type=int, default=3)
+    stories.add_argument('--max-growth', type=float, default=16, help="MiB allowed over the full cache")
+    stories.add_argument('--seed', type=int, default=0)
+    stories.set_defaults(func=bench_stories)
+
+    startup = sub.add_parser('startup', help="time to the first page and memory per worker, cold vs warm boot")
+    startup.add_argument('--workers', type=int, default=4, help="gunicorn worker processes")
+    startup.add_argument('--requests', type=int, default=400, help="requests spread over the workers")
+    startup.add_argument('--repeat', type=int, default=3)
+    startup.add_argument('--modes', nargs='+', default=list(STARTUP_MODES), choices=list(STARTUP_MODES))
+    startup.set_defaults(func=bench_startup)
+
+    ratelimit = sub.add_parser('ratelimit', help="players' latency under a request flood, with and without RATE_LIMIT")
+    ratelimit.add_argument('--players', type=int, default=50)
+    ratelimit.add_argument('--flooders', type=int, default=8)
+    ratelimit.add_argument('--flood-rate', type=float, default=400, help="requests per second from all flooders")
+    ratelimit.add_argument('--seconds', type=float, default=10)
+    ratelimit.add_argument('--think', type=float, default=1.0, help="mean pause between choices, seconds")
+    ratelimit.add_argument('--threads', type=int, default=4, help="threads in the gunicorn worker")
+    ratelimit.add_argument('--limiter', default='memory', choices=('memory', 'sqlite'))
+    ratelimit.add_argument('--seed', type=int, default=0)
+    ratelimit.set_defaults(func=bench_ratelimit)
+
+    duplicates = sub.add_parser('duplicates', help="parallel duplicate choice submissions advance a level once")
+    duplicates.add_argument('--runs', type=int, default=10)
+    duplicates.add_argument('--duplicates', type=int, default=4, help="copies of each submission sent at once")
+    duplicates.add_argument('--stores', nargs='+', default=['cookie', 'memory', 'sqlite'])
+    duplicates.add_argument('--delay', type=float, default=0.01,
+                            help="up to this many seconds between loading a run and saving it, per request")
+    duplicates.add_argument('--seed', type=int, default=0)
+    duplicates.set_defaults(func=bench_duplicates)
+
+    endings = sub.add_parser('endings', help="ending page cost, rendered vs cached and precompressed")
+    endings.add_argument('--levels', type=int, default=20)
+    endings.add_argument('--number', type=int, default=2000)
+    endings.add_argument('--seconds', type=float, default=3)
+    endings.add_argument('--concurrency', type=int, default=8)
+    endings.add_argument('--seed', type=int, default=0)
+    endings.set_defaults(func=bench_endings)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+# Build step for static assets. Run from this folder before deploying:
+#   python build_assets.py
+# Copies every stylesheet and script under static/ to static/dist/ with a content
+# hash in its name, writes gzip (and brotli, when installed) variants next to it,
+# and records the mapping in static/dist/manifest.json for asset_url().
+# Fonts in static/fonts/ are subset to the glyphs the game uses (needs fontTools).
+# The build fails if a template, an asset or a page the app renders would load
+# anything from another origin, and warns about fonts missing from static/fonts/.
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import string
+import sys
+
+try:
+    import brotli
+except ImportError: # Optional, gzip alone is fine
+    brotli = None
+
+try:
+    from fontTools import subset as font_subset
+except ImportError: # Optional, fonts are then copied whole
+    font_subset = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(HERE, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+TEMPLATE_DIR = os.path.join(HERE, 'templates')
+SOURCE_DIRS = ('css', 'js', 'fonts')
+FONT_EXTENSIONS = ('.ttf', '.otf', '.woff', '.woff2')
+
+# src/href attributes, CSS url() and @import pointing at another origin
+EXTERNAL_REFERENCE = re.compile(
+    r"""(?:\b(?:src|href)\s*=\s*|url\(\s*|@import\s+)["']?(?:[a-z][a-z0-9+.-]*:)?//""",
+    re.IGNORECASE,
+)
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def glyph_text():
+    # Every character a page can show: printable ASCII for the templates and UI,
+    # plus whatever the scenario text, delayed messages and endings use
+    from app import DEFAULT_DELAYED_MESSAGE, game_logic
+
+    strings = [string.printable, DEFAULT_DELAYED_MESSAGE]
+    for level in game_logic.levels.values():
+        strings.append(level.description)
+        strings.extend(level.endings.values())
+        for option in level.options.values():
+            strings.append(option.text)
+            strings.append(option.consequence.immediate)
+            strings.append(game_logic.get_delayed_message(level.number, option.key))
+    for name in os.listdir(TEMPLATE_DIR):
+        with open(os.path.join(TEMPLATE_DIR, name), encoding='utf-8') as f:
+            strings.append(f.read())
+    return ''.join(sorted(set(''.join(strings))))
+
+
+def subset_font(data, text):
+    # Returns (font bytes, extension)
+    if font_subset is None:
+        return data, None
+    options = font_subset.Options()
+    options.flavor = 'woff2' if brotli is not None else 'woff'
+    font = font_subset.load_font(io.BytesIO(data), options)
+    subsetter = font_subset.Subsetter(options)
+    subsetter.populate(text=text)
+    subsetter.subset(font)
+    out = io.BytesIO()
+    font_subset.save_font(font, out, options)
+    return out.getvalue(), '.' + options.flavor
+
+
+def external_references(static_dir=STATIC_DIR, template_dir=TEMPLATE_DIR):
+    # (path, line number, line) for every reference to another origin
+    found = []
+    paths = [os.path.join(template_dir, name) for name in sorted(os.listdir(template_dir))]
+    for source_dir in ('css', 'js'):
+        root = os.path.join(static_dir, source_dir)
+        if os.path.isdir(root):
+            paths.extend(os.path.join(root, name) for name in sorted(os.listdir(root)))
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for number, line in enumerate(f, start=1):
+                if EXTERNAL_REFERENCE.search(line):
+                    found.append((os.path.relpath(path, HERE), number, line.strip()))
+    return found
+
+
+def rendered_references():
+    # (page, line number, line) for every reference to another origin in what the app
+    # serves: every template rendered on its own, then each page of a run played through.
+    # Template source alone would miss a URL that reaches the page from Python.
+    from app import create_app, game_logic
+
+    app = create_app({'SECRET_KEY': 'build_assets'})
+    pages = []
+    with app.test_request_context('/play'):
+        for name in sorted(os.listdir(TEMPLATE_DIR)):
+            pages.append((f"templates/{name} (rendered)", app.jinja_env.get_template(name).render()))
+    client = app.test_client()
+    client.get('/')
+    for level in range(1, game_logic.total_levels + 2):
+        pages.append((f"GET /play, level {level}", client.get('/play').get_data(as_text=True)))
+        scenario = game_logic.get_scenario(level)
+        if not scenario or not scenario.options:
+            break # That was the game over page
+        client.post('/play', data={'choice': next(iter(scenario.options)), 'level': level})
+    found = []
+    for page, html in pages:
+        for number, line in enumerate(html.splitlines(), start=1):
+            if EXTERNAL_REFERENCE.search(line):
+                found.append((page, number, line.strip()))
+    return found
+
+
+def missing_fonts(static_dir=STATIC_DIR):
+    # The FONTS files not in static/ yet, pages use those fonts only where installed locally
+    from app import FONTS
+
+    return [filename for _, _, filename in FONTS if not os.path.exists(os.path.join(static_dir, filename))]
+
+
+def build(static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+    shutil.rmtree(dist_dir, ignore_errors=True)
+    manifest = {}
+    text = None
+    for source_dir in SOURCE_DIRS:
+        root = os.path.join(static_dir, source_dir)
+        if not os.path.isdir(root):
+            continue
+        for name in sorted(os.listdir(root)):
+            logical = f"{source_dir}/{name}"
+            with open(os.path.join(root, name), 'rb') as f:
+                data = f.read()
+            stem, ext = os.path.splitext(name)
+            if source_dir == 'fonts':
+                if ext not in FONT_EXTENSIONS:
+                    continue # e.g. the font licenses
+                if text is None:
+                    text = glyph_text()
+                data, subset_ext = subset_font(data, text)
+                ext = subset_ext or ext
+            built = f"{source_dir}/{stem}.{fingerprint(data)}{ext}"
+            target = os.path.join(dist_dir, built)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+
+            encodings = []
+            if ext in FONT_EXTENSIONS:
+                manifest[logical] = {'file': built, 'encodings': encodings} # Already compressed
+                continue
+            if brotli is not None:
+                with open(target + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+                encodings.append('br')
+            with open(target + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            encodings.append('gzip')
+            manifest[logical] = {'file': built, 'encodings': encodings}
+
+    os.makedirs(dist_dir, exist_ok=True)
+    with open(os.path.join(dist_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fingerprint and precompress static assets")
+    parser.add_argument('--check', action='store_true',
+                        help="only check that nothing references another origin")
+    args = parser.parse_args()
+
+    found = external_references() + rendered_references()
+    for path, number, line in found:
+        print(f"{path}:{number}: external reference: {line}", file=sys.stderr)
+    if found:
+        sys.exit(1)
+    missing = missing_fonts()
+    if missing:
+        print(f"warning: {', '.join(missing)} not in static/, pages use these fonts only where installed",
+              file=sys.stderr)
+    if args.check:
+        return
+
+    for logical, entry in build().items():
+        print(f"{logical} -> {entry['file']} ({', '.join(entry['encodings']) or 'as is'})")
+
+
+if __name__ == '__main__':
+    main()
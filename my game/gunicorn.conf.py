@@ -0,0 +1,31 @@
+# gunicorn settings for wsgi:app. Everything can be overridden from the environment:
+#   WEB_CONCURRENCY  worker processes (default: one per CPU core)
+#   WEB_THREADS      threads per worker (default 4)
+#   BIND             address to listen on (default 0.0.0.0:8000)
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+# Load the app (and compile the scenarios) once in the master, workers share it after fork
+preload_app = True
+keepalive = 5
+accesslog = os.environ.get('ACCESS_LOG') # e.g. '-' for stdout, off by default
+
+
+def on_starting(server):
+    # Fail fast instead of starting workers that would each reject the others' cookies
+    if not os.environ.get('SECRET_KEY'):
+        raise RuntimeError("SECRET_KEY must be set, and be the same for every worker process")
+    if os.environ.get('SESSION_STORE') == 'memory' and server.cfg.workers > 1:
+        raise RuntimeError("SESSION_STORE=memory keeps runs per process, use one worker or 'sqlite'")
+
+
+def pre_fork(server, worker):
+    # The preloaded app (scenarios, compiled templates, pre-rendered pages, see WARM_START)
+    # is shared copy-on-write with the workers. Moving it out of the garbage collector's
+    # reach keeps collections in the workers from touching, and so copying, those pages.
+    gc.freeze()
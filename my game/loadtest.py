@@ -0,0 +1,143 @@
+# Load generator: scripted players run full playthroughs against a running server.
+#   SECRET_KEY=... gunicorn -c gunicorn.conf.py wsgi:app
+#   python loadtest.py --url http://127.0.0.1:8000 --players 32 --duration 30
+# Each player keeps one keep-alive connection and its own session cookie, starts a
+# run at /, makes a random choice on every level and reads the final page. Choices
+# carry the level they are for, as the game's form and game.js send them.
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+
+from app import game_logic
+
+
+class Player:
+    def __init__(self, url, rng):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.rng = rng
+        self.cookies = {}
+        self.conn = None
+        self.latencies = [] # Seconds per HTTP request
+        self.errors = 0
+        self.stale = 0 # Choices the server took for a repeat of an earlier level's
+
+    def request(self, method, path, body=None):
+        headers = {'Connection': 'keep-alive'}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f"{k}={v}" for k, v in self.cookies.items())
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            body = urlencode(body)
+        for attempt in range(2): # Reconnect once if the server closed the connection
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            start = time.perf_counter()
+            try:
+                self.conn.request(method, self.prefix + path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+            except (ConnectionError, http.client.HTTPException):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+                continue
+            self.latencies.append(time.perf_counter() - start)
+            break
+        for header in response.msg.get_all('Set-Cookie') or ():
+            for name, morsel in SimpleCookie(header).items():
+                if morsel.value:
+                    self.cookies[name] = morsel.value
+                else:
+                    self.cookies.pop(name, None)
+        if response.status >= 400:
+            self.errors += 1
+        return response, data
+
+    def playthrough(self, mode):
+        self.request('GET', '/')
+        self.request('GET', '/play')
+        for level in range(1, game_logic.total_levels):
+            choice = self.rng.choice(list(game_logic.get_scenario(level).options))
+            form = {'choice': choice, 'level': level}
+            if mode == 'api':
+                response, data = self.request('POST', '/api/choice', form)
+                if response.status == 200:
+                    answer = json.loads(data)
+                    self.stale += bool(answer.get('stale'))
+                    if answer.get('game_over'):
+                        self.request('GET', '/play')
+            else:
+                self.request('POST', '/play', form) # 302 back to /play
+                self.request('GET', '/play')
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def run(url, players, duration, mode, seed):
+    deadline = time.perf_counter() + duration
+    lock = threading.Lock()
+    playthroughs = []
+
+    def play(index):
+        player = Player(url, random.Random(seed + index))
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            player.playthrough(mode)
+            with lock:
+                playthroughs.append(time.perf_counter() - start)
+        return player
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(players) as pool:
+        results = list(pool.map(play, range(players)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for player in results for latency in player.latencies]
+    return {
+        'elapsed': elapsed,
+        'requests': len(latencies),
+        'errors': sum(player.errors for player in results),
+        'stale': sum(player.stale for player in results),
+        'playthroughs': len(playthroughs),
+        'latencies': latencies,
+        'playthrough_times': playthroughs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scripted full playthroughs against a running server")
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--players', type=int, default=16, help="concurrent players")
+    parser.add_argument('--duration', type=float, default=10, help="seconds to run")
+    parser.add_argument('--mode', choices=('form', 'api'), default='form')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    result = run(args.url, args.players, args.duration, args.mode, args.seed)
+    elapsed = result['elapsed']
+    print(f"{result['playthroughs']} playthroughs, {result['requests']} requests, "
+          f"{result['errors']} errors, {result['stale']} stale choices in {elapsed:.1f}s")
+    print(f"throughput: {result['requests'] / elapsed:8.1f} req/s, "
+          f"{result['playthroughs'] / elapsed:6.2f} playthroughs/s")
+    latencies = result['latencies']
+    print("request latency: " + ", ".join(
+        f"p{int(q * 100)} {percentile(latencies, q) * 1e3:.2f} ms" for q in (0.5, 0.9, 0.99)
+    ) + f", max {max(latencies, default=0) * 1e3:.2f} ms")
+    times = result['playthrough_times']
+    print(f"playthrough: p50 {percentile(times, 0.5) * 1e3:.1f} ms, p99 {percentile(times, 0.99) * 1e3:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
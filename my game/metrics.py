@@ -0,0 +1,247 @@
+# Opt-in request metrics: per-route latency and per-phase timings (session decode,
+# scenario lookup, delayed message scan, render, session encode) as Prometheus
+# histograms, served at /metrics when METRICS=1:
+#   SECRET_KEY=... METRICS=1 gunicorn -c gunicorn.conf.py wsgi:app
+#   curl localhost:8000/metrics
+# With METRICS_PROFILE_DIR set, a METRICS_PROFILE_RATE fraction of requests is also
+# run under cProfile and dumped there, one .prof file each (python -m pstats <file>).
+# Metrics are kept per worker process, so scrape each worker or run a single one.
+#
+# The routes mark their phases with `with phase('render'):`. The request being timed
+# lives in a context variable, so outside a timed request (metrics off) a phase is a
+# context variable lookup and a no-op context manager, nothing more.
+from bisect import bisect_left
+from contextvars import ContextVar
+import cProfile
+import os
+import random
+import threading
+import time
+
+PHASES = ('session_decode', 'scenario_lookup', 'delayed_scan', 'render', 'session_encode')
+# Upper bounds in seconds; the +Inf bucket is implied
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_current = ContextVar('metrics_request', default=None)
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_PHASE = _NoPhase()
+
+
+class _Phase:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        phases = self.timer.phases
+        phases[self.name] = phases.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+def current_timer():
+    # The RequestTimer of the request being handled, None when it isn't timed
+    return _current.get()
+
+
+def phase(name):
+    # Times a block as part of the current request; a phase entered several times
+    # in one request (say, two session writes) is observed once, as the total
+    timer = _current.get()
+    if timer is None:
+        return NO_PHASE
+    return _Phase(timer, name)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Not cumulative; the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield f'{name}_bucket{{{labels},le="{le}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.sum!r}'
+        yield f'{name}_count{{{labels}}} {cumulative}'
+
+
+class RequestTimer:
+    __slots__ = ('start', 'phases', 'route', 'profiler', 'token')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.route = None # Set by the front end once it knows which route matched
+        self.profiler = None
+        self.token = None
+
+
+class Metrics:
+    def __init__(self, profile_dir=None, profile_rate=0.01):
+        self.profile_dir = profile_dir
+        self.profile_rate = profile_rate if profile_dir else 0.0
+        self.requests = {}   # (route, status) -> count
+        self.latency = {}    # route -> Histogram of whole requests
+        self.phases = {name: Histogram() for name in PHASES}
+        self.profiles = 0
+        self._lock = threading.Lock()
+        self._collectors = [] # Callables yielding extra exposition lines, see add_collector
+
+    def start(self):
+        # Begins timing a request in the current context; pair with finish()
+        timer = RequestTimer()
+        if self.profile_rate and random.random() < self.profile_rate:
+            # Under asyncio this also catches whatever else the event loop runs meanwhile
+            timer.profiler = cProfile.Profile()
+            timer.profiler.enable()
+        timer.token = _current.set(timer)
+        return timer
+
+    def finish(self, timer, status):
+        elapsed = time.perf_counter() - timer.start
+        _current.reset(timer.token)
+        if timer.profiler is not None:
+            timer.profiler.disable()
+            self._dump_profile(timer)
+        route = timer.route or 'unmatched'
+        with self._lock:
+            key = (route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get(route)
+            if histogram is None:
+                histogram = self.latency[route] = Histogram()
+            histogram.observe(elapsed)
+            for name, seconds in timer.phases.items():
+                histogram = self.phases.get(name)
+                if histogram is None:
+                    histogram = self.phases[name] = Histogram()
+                histogram.observe(seconds)
+
+    def _dump_profile(self, timer):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        route = (timer.route or 'unmatched').replace('/', '_').replace('.', '_')
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{route}-{self.profiles}.prof"
+        timer.profiler.dump_stats(os.path.join(self.profile_dir, name))
+        self.profiles += 1
+
+    def add_collector(self, collect):
+        # collect() yields ready-made exposition lines (HELP/TYPE included), read on every scrape
+        self._collectors.append(collect)
+
+    def wsgi_middleware(self, wsgi_app):
+        # Times every request through wsgi_app, from the first byte of the request to
+        # the view returning its response (streamed bodies aren't counted)
+        def timed_app(environ, start_response):
+            timer = self.start()
+            status = [0]
+
+            def timed_start_response(status_line, headers, exc_info=None):
+                status[0] = int(status_line.split(' ', 1)[0])
+                return start_response(status_line, headers, exc_info)
+
+            try:
+                return wsgi_app(environ, timed_start_response)
+            finally:
+                self.finish(timer, status[0] or 500)
+        return timed_app
+
+    def render(self):
+        with self._lock:
+            lines = [
+                '# HELP game_requests_total Requests handled, by route and status.',
+                '# TYPE game_requests_total counter',
+            ]
+            for (route, status), count in sorted(self.requests.items()):
+                lines.append(f'game_requests_total{{route="{route}",status="{status}"}} {count}')
+            lines += [
+                '# HELP game_request_duration_seconds Time to handle a request, by route.',
+                '# TYPE game_request_duration_seconds histogram',
+            ]
+            for route, histogram in sorted(self.latency.items()):
+                lines.extend(histogram.lines('game_request_duration_seconds', f'route="{route}"'))
+            lines += [
+                '# HELP game_phase_duration_seconds Time spent in each phase of a request, per request that had it.',
+                '# TYPE game_phase_duration_seconds histogram',
+            ]
+            for name, histogram in self.phases.items():
+                lines.extend(histogram.lines('game_phase_duration_seconds', f'phase="{name}"'))
+            lines += [
+                '# HELP game_profiles_total Requests sampled into cProfile dumps.',
+                '# TYPE game_profiles_total counter',
+                f'game_profiles_total {self.profiles}',
+            ]
+        for collect in self._collectors:
+            lines.extend(collect())
+        return '\n'.join(lines) + '\n'
+
+
+# Stories not loaded right now share one label, so there is at most a series per loaded story
+OTHER_STORIES = '(other)'
+
+
+def catalog_lines(catalog):
+    # StoryCatalog lookups and load time per story, for the stories loaded right now
+    # (at most STORY_CACHE_SIZE); the rest are summed under story="(other)", which no
+    # story ID can be. Reloads, evictions and failures are totals over every story.
+    stats = dict(catalog.stats)
+    loaded = set(catalog.loaded())
+    by_story = {}
+    for story_id, entry in stats.items():
+        label = story_id if story_id in loaded else OTHER_STORIES
+        hits, misses, load_seconds = by_story.get(label, (0, 0, 0.0))
+        by_story[label] = (hits + entry.hits, misses + entry.misses, load_seconds + entry.load_seconds)
+    per_story = (('hits', "Story lookups served from memory, by story."),
+                 ('misses', "Story lookups that had to load a pack, by story."),
+                 ('load_seconds', "Time spent loading story packs, by story."))
+    for field, (name, help_text) in enumerate(per_story):
+        metric = f'game_story_{name}_total'
+        yield f'# HELP {metric} {help_text}'
+        yield f'# TYPE {metric} counter'
+        for story_id, values in sorted(by_story.items()):
+            yield f'{metric}{{story="{story_id}"}} {values[field]!r}'
+    totals = (('reloads', "Loaded stories reloaded after their pack changed."),
+              ('evictions', "Stories dropped to stay within STORY_CACHE_SIZE."),
+              ('failures', "Packs that failed to load."))
+    for name, help_text in totals:
+        yield f'# HELP game_story_{name}_total {help_text}'
+        yield f'# TYPE game_story_{name}_total counter'
+        yield f'game_story_{name}_total {sum(getattr(entry, name) for entry in stats.values())}'
+    yield '# HELP game_stories_loaded Stories currently held in memory.'
+    yield '# TYPE game_stories_loaded gauge'
+    yield f'game_stories_loaded {len(loaded)}'
+
+
+def telemetry_lines(telemetry):
+    yield '# HELP game_telemetry_events_total Telemetry events, by what became of them.'
+    yield '# TYPE game_telemetry_events_total counter'
+    for outcome in ('recorded', 'written', 'dropped', 'failed'):
+        yield f'game_telemetry_events_total{{outcome="{outcome}"}} {getattr(telemetry, outcome)}'
@@ -0,0 +1,156 @@
+# Request rate limits (RATE_LIMIT=memory or sqlite), one limiter per client IP and one
+# per run, so a scripted client can't burn a worker on restarts, renders and choices:
+#   SECRET_KEY=... RATE_LIMIT=memory gunicorn -c gunicorn.conf.py wsgi:app
+#   SECRET_KEY=... RATE_LIMIT=sqlite RATE_LIMIT_DB=/var/tmp/limits.db gunicorn -c gunicorn.conf.py wsgi:app
+# Each key gets a token bucket of `burst` requests refilled at `rate` per second, kept
+# as a single number: the time its bucket will be full again (GCRA). A request is let
+# through if adding it doesn't push that time more than `burst` requests ahead of now;
+# otherwise hit() says how many seconds until it would be.
+# The per client check runs in front of the app (limit_clients), so a refused request
+# costs a dictionary lookup, not a routed Flask request; runs are checked in the views.
+# 'memory' buckets are per worker process, so with N workers a client gets up to N
+# times the rate. 'sqlite' shares them through one file (WAL), like SESSION_STORE=sqlite.
+# Behind reverse proxies, TRUSTED_PROXIES says how many, so clients are told apart by
+# X-Forwarded-For (ProxyFix in app.py, forwarded_client in async_app.py).
+import heapq
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+class MemoryLimiter:
+    blocking = False # hit() never waits, the async front end calls it inline
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.interval = 1.0 / rate
+        self.window = self.interval * burst
+        self.max_keys = max_keys
+        self._full_at = {} # key -> monotonic time its bucket is full again
+        self._sweep_lock = threading.Lock()
+
+    def hit(self, key):
+        # 0.0 if the request may go ahead, else the seconds to wait. No lock: two threads
+        # racing on one key can both get through, costing the bucket one request.
+        now = time.monotonic()
+        full_at = self._full_at.get(key, now)
+        full_at = (full_at if full_at > now else now) + self.interval
+        if full_at - now > self.window:
+            return full_at - now - self.window
+        self._full_at[key] = full_at
+        if len(self._full_at) > self.max_keys:
+            self._sweep(now)
+        return 0.0
+
+    def _sweep(self, now):
+        # Full buckets are the same as no bucket, so drop those first; if every bucket is
+        # still draining, keep the emptiest half (the keys that sent the most lately)
+        with self._sweep_lock:
+            if len(self._full_at) <= self.max_keys:
+                return
+            live = [(full_at, key) for key, full_at in list(self._full_at.items()) if full_at > now]
+            if len(live) > self.max_keys // 2:
+                live = heapq.nlargest(self.max_keys // 2, live)
+            self._full_at = {key: full_at for full_at, key in live}
+
+    def __len__(self):
+        return len(self._full_at)
+
+
+class SQLiteLimiter:
+    # Same buckets in a table every worker shares. Each process keeps one connection,
+    # reopened after a fork, and each hit is one short write transaction.
+    blocking = True
+
+    def __init__(self, rate, burst, path='rate_limits.db', purge_every=10000):
+        self.interval = 1.0 / rate
+        self.window = self.interval * burst
+        self.path = path
+        self.purge_every = purge_every
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._hits = 0
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, full_at REAL NOT NULL)')
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def hit(self, key):
+        now = time.time() # Wall clock, the processes sharing the file must agree on it
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE') # Read and update the bucket without another worker in between
+            with conn:
+                row = conn.execute('SELECT full_at FROM buckets WHERE key = ?', (key,)).fetchone()
+                full_at = (row[0] if row and row[0] > now else now) + self.interval
+                if full_at - now > self.window:
+                    return full_at - now - self.window
+                conn.execute('INSERT OR REPLACE INTO buckets (key, full_at) VALUES (?, ?)', (key, full_at))
+                self._hits += 1
+                if self._hits % self.purge_every == 0:
+                    conn.execute('DELETE FROM buckets WHERE full_at < ?', (now,))
+                return 0.0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# The game routes, for the main story and under /s/<story_id>/ (see the blueprints in app.py)
+GAME_PATHS = re.compile(r'(/s/[^/]+)?/(play|api/choice)?')
+
+
+def too_many_requests(wait, api=False):
+    # (headers, body) of the 429 for a request that may be retried after wait seconds
+    retry_after = max(1, math.ceil(wait))
+    if api:
+        body = json.dumps({'error': 'too many requests', 'retry_after': retry_after}).encode() + b'\n'
+        content_type = 'application/json'
+    else:
+        body = b"Too many requests, try again in a moment.\n"
+        content_type = 'text/plain; charset=utf-8'
+    return [('Content-Type', content_type), ('Retry-After', str(retry_after))], body
+
+
+def forwarded_client(remote_addr, forwarded_for, trusted_proxies):
+    # The client address werkzeug's ProxyFix(x_for=trusted_proxies) would set: the entry
+    # that many hops back in X-Forwarded-For, or remote_addr when there is no such entry
+    if trusted_proxies and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',')]
+        if len(hops) >= trusted_proxies:
+            return hops[-trusted_proxies]
+    return remote_addr
+
+
+def limit_clients(wsgi_app, limiter, paths=GAME_PATHS):
+    # Every request to a game route counts against its client's address. Assets, static
+    # files and /metrics are never limited.
+    def limited_app(environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if paths.fullmatch(path):
+            wait = limiter.hit('ip:' + environ.get('REMOTE_ADDR', ''))
+            if wait:
+                headers, body = too_many_requests(wait, api=path.endswith('/api/choice'))
+                start_response('429 Too Many Requests', headers + [('Content-Length', str(len(body)))])
+                return [body]
+        return wsgi_app(environ, start_response)
+    return limited_app
+
+
+def create_limiter(kind, rate, burst, **options):
+    if kind == 'memory':
+        return MemoryLimiter(rate, burst, **options)
+    if kind == 'sqlite':
+        return SQLiteLimiter(rate, burst, **options)
+    raise ValueError(f"Unknown rate limiter: {kind!r} (expected 'memory' or 'sqlite')")
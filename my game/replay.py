@@ -0,0 +1,116 @@
+# Replay a finished (or abandoned) run through the real routes and templates. A run is
+# its seed plus one option key per level, which is all an ending depends on. Telemetry
+# names runs by their seed, so a reported run can be pulled straight from it, and a
+# COMPACT_SESSION run (the [code, seed] pair in the cookie or session store) holds both.
+# Run from this folder, e.g.:
+#   python replay.py 3f2a9c01b7e4 abdcabdcabdcabdcabd
+#   python replay.py 3f2a9c01b7e4 --telemetry sqlite:telemetry.db
+#   python replay.py 3f2a9c01b7e4 --telemetry csv:telemetry/ --pack stories/echoes.pack --out pages/
+#   python replay.py --record '[614432968462, 135701538583490]'
+import argparse
+import json
+import os
+import re
+import sys
+
+from app import GameLogic, create_app, ending_type_for
+import app as game
+from scenario_pack import load_pack
+from telemetry import create_sink
+
+
+def choices_from_telemetry(spec, run_id):
+    # The run's choices in level order, from the events the game recorded for it
+    events = sorted((event for event in create_sink(spec).read() if event[1] == run_id),
+                    key=lambda event: (event[3], event[0]))
+    return ''.join(event[4] for event in events if event[4] is not None and event[6] is None)
+
+
+def run_from_record(record, pack=None):
+    # (seed, choices) of a compact run: the choice record sits above the code's lowest bit
+    code, seed = json.loads(record)
+    logic = GameLogic(content=load_pack(pack)) if pack else game.game_logic
+    return seed, ''.join(logic.choices_from_record(code >> 1))
+
+
+def replay(seed, choices, pack=None):
+    # [(level, page HTML)] as the player saw them, the last one being how the run ended,
+    # plus the ending type when the run got past the final level
+    flask_app = create_app({
+        'SECRET_KEY': 'replay', 'SESSION_STORE': 'cookie', 'COMPACT_SESSION': False,
+        'SCENARIO_PACK': pack, 'SCENARIO_RELOAD': 0, 'STORY_DIR': None, 'TELEMETRY': None, 'METRICS': False,
+    })
+    logic = game.game_logic
+    client = flask_app.test_client()
+    client.get('/')
+    with client.session_transaction() as session:
+        session['seed'] = seed
+    pages = []
+    for level, choice in enumerate(choices, 1):
+        scenario = logic.get_scenario(level)
+        if scenario is None or not scenario.options:
+            break # The run ended before using every choice given
+        if choice not in scenario.options:
+            raise ValueError(f"level {level} has no option {choice!r} (options: {', '.join(scenario.options)})")
+        pages.append((level, client.get('/play').get_data(as_text=True)))
+        client.post('/play', data={'choice': choice})
+    level = len(pages) + 1
+    ending = None
+    if level > logic.total_levels:
+        with client.session_transaction() as session:
+            ending = ending_type_for(logic, dict(session))
+    pages.append((level, client.get('/play').get_data(as_text=True)))
+    return pages, ending
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a run from its seed and choices")
+    parser.add_argument('seed', nargs='?', help="the run's seed, in hex as telemetry records it")
+    parser.add_argument('choices', nargs='?', help="one option key per level, e.g. abdca...")
+    parser.add_argument('--telemetry', metavar='SINK', help="read the choices from a telemetry sink instead")
+    parser.add_argument('--record', metavar='STATE',
+                        help="replay a compact run instead, [code, seed] as COMPACT_SESSION stores it")
+    parser.add_argument('--pack', help="the story's scenario pack (default: the built-in story)")
+    parser.add_argument('--out', help="write every page of the run to this directory")
+    args = parser.parse_args()
+
+    if args.record:
+        try:
+            seed, choices = run_from_record(args.record, args.pack)
+        except (ValueError, TypeError, IndexError, KeyError):
+            sys.exit(f"not a compact run for this story: {args.record}")
+        args.seed = f'{seed:012x}'
+    elif not args.seed:
+        parser.error("give the run's seed, or --record")
+    elif args.telemetry:
+        choices = choices_from_telemetry(args.telemetry, args.seed)
+        if not choices:
+            sys.exit(f"no choices recorded for run {args.seed}")
+    elif args.choices:
+        choices = args.choices
+    else:
+        parser.error("give the choices, or --telemetry to look them up")
+
+    try:
+        pages, ending = replay(int(args.seed, 16), choices, args.pack)
+    except ValueError as exc:
+        sys.exit(str(exc))
+    print(f"run {args.seed}: {choices[:len(pages) - 1]} ({len(pages) - 1} choices)")
+    last_level, last_page = pages[-1]
+    if ending is not None:
+        print(f"ending: {ending}")
+    else:
+        print(f"ended at level {last_level} without reaching an ending")
+    message = re.search(r'<div class="message-text">(.*?)</div>', last_page, re.S)
+    if message:
+        print(message.group(1).strip())
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+        for level, page in pages:
+            with open(os.path.join(args.out, f'level-{level:02d}.html'), 'w') as f:
+                f.write(page)
+        print(f"wrote {len(pages)} pages to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,499 @@
+# Scenario packs: a story's levels, endings, delayed messages and ending rules as
+# data instead of Python literals. Run from this folder, e.g.:
+#   python scenario_pack.py export stories/echoes.json     # the built-in story as a source file
+#   python scenario_pack.py compile stories/echoes.json stories/echoes.pack
+#   python scenario_pack.py check stories/echoes.pack
+#   SECRET_KEY=... SCENARIO_PACK=stories/echoes.pack gunicorn -c gunicorn.conf.py wsgi:app
+#   SECRET_KEY=... STORY_DIR=stories gunicorn -c gunicorn.conf.py wsgi:app   # /s/echoes/
+#
+# Sources are JSON or TOML:
+#   {"title": "...",
+#    "rules": {"secret_path": [[1, "b"], ...], "key_choices": [[1, "a"], ...],
+#              "mirror_levels": [3, 12], "ending_thresholds": {"bad_sanity": 8}},
+#    "levels": {"1": {"description": "...",
+#                     "options": {"a": {"text": "...", "immediate": "...", "is_wrong": false,
+#                                       "delayed_reveal_level": 5, "delayed_message": "..."}}},
+#               "20": {"description": "...", "endings": {"good": "...", "bad": "..."}}}}
+#
+# A compiled pack is a small header, fixed-size level/option/ending records that
+# refer to strings by index, and one deduplicated UTF-8 string table. Loading is one
+# read and a single pass of struct unpacks with no parsing, and replacing the file
+# (os.replace, as compile does) is picked up by running workers.
+# Every worker decodes the pack into its own Python objects (GameLogic and the page
+# cache need str, not bytes). With gunicorn's preload_app the story loaded at boot is
+# shared by the forked workers, copy on write; a pack reloaded later is not, each
+# worker holds its own copy, as it does for stories loaded from STORY_DIR.
+from collections import OrderedDict
+from dataclasses import dataclass
+import argparse
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tomllib
+
+MAGIC = b'EODPACK1'
+HEADER = struct.Struct('<8sIIIII') # magic, strings, levels, options, endings, meta string
+LEVEL = struct.Struct('<HIHH')     # number, description, first option, option count
+OPTION = struct.Struct('<IIIIhB')  # key, text, immediate, delayed message, reveal level, is_wrong
+ENDING = struct.Struct('<HII')     # level, name, text
+NO_STRING = 0xFFFFFFFF
+NO_LEVEL = -1
+MAX_OPTIONS = 4 # The compact session codec stores each choice in 2 bits
+PACK_EXTENSIONS = ('.pack', '.json', '.toml') # Looked up in this order in a story directory
+STORY_ID = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+log = logging.getLogger(__name__)
+
+
+class PackError(ValueError):
+    # A pack that can't be read or fails validation; problems lists every issue found
+    def __init__(self, path, problems):
+        self.path = path
+        self.problems = list(problems)
+        super().__init__(f"{path}: " + "; ".join(self.problems))
+
+
+# --- Source files ---
+def load_source(path):
+    with open(path, 'rb') as f:
+        if path.endswith('.toml'):
+            return tomllib.load(f)
+        return json.load(f)
+
+
+def content_from_source(source):
+    # Source layout -> the content dict GameLogic(content=...) takes
+    scenarios, delayed_messages = {}, {}
+    for number, level in source.get('levels', {}).items():
+        number = int(number)
+        scenario = {'description': level.get('description', ""), 'options': {}, 'consequences': {}}
+        for key, option in level.get('options', {}).items():
+            scenario['options'][key] = option.get('text', "")
+            scenario['consequences'][key] = {
+                'immediate': option.get('immediate', ""),
+                'delayed_reveal_level': option.get('delayed_reveal_level'),
+                'is_wrong': bool(option.get('is_wrong', False)),
+            }
+            if option.get('delayed_message') is not None:
+                delayed_messages.setdefault(number, {})[key] = option['delayed_message']
+        if level.get('endings'):
+            scenario['ending'] = dict(level['endings'])
+        scenarios[number] = scenario
+    rules = source.get('rules', {})
+    return {
+        'title': source.get('title', ""),
+        'scenarios': scenarios,
+        'delayed_messages': delayed_messages,
+        'rules': {
+            'secret_path': [tuple(step) for step in rules.get('secret_path', ())],
+            'key_choices': [tuple(step) for step in rules.get('key_choices', ())],
+            'mirror_levels': list(rules.get('mirror_levels', ())),
+            'ending_thresholds': dict(rules.get('ending_thresholds', {})),
+        },
+    }
+
+
+def source_from_logic(logic, title=""):
+    # The source for a loaded story. Reveals that can never fire (pointing at the
+    # same or an earlier level) and messages nothing schedules are left out, so the
+    # result passes validate() and plays exactly the same.
+    levels = {}
+    for number, level in logic.levels.items():
+        entry = {'description': level.description}
+        options = {}
+        for key, option in level.options.items():
+            consequence = option.consequence
+            data = {'text': option.text, 'immediate': consequence.immediate, 'is_wrong': consequence.is_wrong}
+            reveal_level = consequence.delayed_reveal_level
+            if reveal_level is not None and number < reveal_level <= logic.total_levels:
+                data['delayed_reveal_level'] = reveal_level
+                data['delayed_message'] = logic.get_delayed_message(number, key)
+            options[key] = data
+        if options:
+            entry['options'] = options
+        if level.endings:
+            entry['endings'] = dict(level.endings)
+        levels[str(number)] = entry
+    return {
+        'title': title,
+        'rules': {
+            'secret_path': [list(step) for step in logic.secret_path],
+            'key_choices': [list(step) for step in logic.key_choices],
+            'mirror_levels': list(logic.mirror_levels),
+            'ending_thresholds': dict(logic.thresholds),
+        },
+        'levels': levels,
+    }
+
+
+# --- Validation ---
+def validate(content):
+    # Every problem in a content dict, empty when it is safe to serve
+    problems = []
+    scenarios = content['scenarios']
+    if not scenarios:
+        return ["the pack has no levels"]
+    total_levels = max(scenarios)
+    missing = sorted(set(range(1, total_levels + 1)) - set(scenarios))
+    if missing:
+        problems.append(f"levels must be numbered 1..{total_levels} without gaps, missing {missing}")
+    messages = content['delayed_messages']
+    for number, scenario in sorted(scenarios.items()):
+        options = scenario.get('options', {})
+        if len(options) > MAX_OPTIONS:
+            problems.append(f"level {number} has {len(options)} options, at most {MAX_OPTIONS} are supported")
+        for key in options:
+            reveal_level = scenario['consequences'][key].get('delayed_reveal_level')
+            if reveal_level is None:
+                continue
+            if not (isinstance(reveal_level, int) and number < reveal_level <= total_levels):
+                problems.append(f"level {number} option {key!r}: delayed_reveal_level {reveal_level!r} "
+                                f"is not a later level (expected {number + 1}..{total_levels})")
+            if not messages.get(number, {}).get(key):
+                problems.append(f"level {number} option {key!r} has a delayed_reveal_level but no delayed_message")
+    final = scenarios.get(total_levels, {})
+    if not final.get('ending'):
+        problems.append(f"the final level ({total_levels}) has no endings")
+    rules = content.get('rules', {})
+    for name in ('secret_path', 'key_choices'):
+        for level, key in rules.get(name, ()):
+            if key not in scenarios.get(level, {}).get('options', {}):
+                problems.append(f"rules.{name} refers to level {level} option {key!r}, which does not exist")
+    for level in rules.get('mirror_levels', ()):
+        if level not in scenarios:
+            problems.append(f"rules.mirror_levels refers to level {level}, which does not exist")
+    return problems
+
+
+# --- Binary packs ---
+def compile_pack(source):
+    # Source dict -> pack bytes. Raises PackError if the source does not validate.
+    content = content_from_source(source)
+    problems = validate(content)
+    if problems:
+        raise PackError('<source>', problems)
+
+    strings, index = [], {}
+
+    def sid(text):
+        if text is None:
+            return NO_STRING
+        if text not in index:
+            index[text] = len(strings)
+            strings.append(text.encode('utf-8'))
+        return index[text]
+
+    meta = sid(json.dumps({'title': content['title'], 'rules': content['rules']}, separators=(',', ':')))
+    level_records, option_records, ending_records = [], [], []
+    for number, scenario in sorted(content['scenarios'].items()):
+        first = len(option_records)
+        for key, text in scenario.get('options', {}).items():
+            consequence = scenario['consequences'][key]
+            reveal_level = consequence['delayed_reveal_level']
+            option_records.append(OPTION.pack(
+                sid(key), sid(text), sid(consequence['immediate']),
+                sid(content['delayed_messages'].get(number, {}).get(key)),
+                NO_LEVEL if reveal_level is None else reveal_level, consequence['is_wrong']))
+        level_records.append(LEVEL.pack(number, sid(scenario['description']), first,
+                                        len(option_records) - first))
+        for name, text in scenario.get('ending', {}).items():
+            ending_records.append(ENDING.pack(number, sid(name), sid(text)))
+
+    offsets, position = [], 0
+    for data in strings:
+        offsets.append(position)
+        position += len(data)
+    offsets.append(position)
+    return b''.join((
+        HEADER.pack(MAGIC, len(strings), len(level_records), len(option_records), len(ending_records), meta),
+        struct.pack(f'<{len(offsets)}I', *offsets),
+        *level_records, *option_records, *ending_records,
+        *strings,
+    ))
+
+
+def write_pack(source, path):
+    # Written next to the target and renamed over it, so readers never see half a pack
+    data = compile_pack(source)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.pack-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644) # mkstemp creates it private, workers may run as another user
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return len(data)
+
+
+def _read_pack(view):
+    magic, string_count, level_count, option_count, ending_count, meta = HEADER.unpack_from(view, 0)
+    position = HEADER.size
+    offsets = struct.unpack_from(f'<{string_count + 1}I', view, position)
+    position += 4 * (string_count + 1)
+    levels = list(LEVEL.iter_unpack(view[position:position + LEVEL.size * level_count]))
+    position += LEVEL.size * level_count
+    options = list(OPTION.iter_unpack(view[position:position + OPTION.size * option_count]))
+    position += OPTION.size * option_count
+    endings = list(ENDING.iter_unpack(view[position:position + ENDING.size * ending_count]))
+    position += ENDING.size * ending_count
+    base = position
+
+    def string(i):
+        if i == NO_STRING:
+            return None
+        return str(view[base + offsets[i]:base + offsets[i + 1]], 'utf-8')
+
+    scenarios, delayed_messages = {}, {}
+    for number, description, first, count in levels:
+        scenario = {'description': string(description), 'options': {}, 'consequences': {}}
+        for key, text, immediate, message, reveal_level, is_wrong in options[first:first + count]:
+            key = sys.intern(string(key))
+            scenario['options'][key] = string(text)
+            scenario['consequences'][key] = {
+                'immediate': string(immediate),
+                'delayed_reveal_level': None if reveal_level == NO_LEVEL else reveal_level,
+                'is_wrong': bool(is_wrong),
+            }
+            if message != NO_STRING:
+                delayed_messages.setdefault(number, {})[key] = string(message)
+        scenarios[number] = scenario
+    for number, name, text in endings:
+        scenarios[number].setdefault('ending', {})[string(name)] = string(text)
+    meta = json.loads(string(meta))
+    meta['rules']['secret_path'] = [tuple(step) for step in meta['rules']['secret_path']]
+    meta['rules']['key_choices'] = [tuple(step) for step in meta['rules']['key_choices']]
+    return {'title': meta['title'], 'scenarios': scenarios, 'delayed_messages': delayed_messages,
+            'rules': meta['rules']}
+
+
+def load_pack(path):
+    # A compiled pack or a JSON/TOML source -> validated content dict for GameLogic
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) == MAGIC:
+                f.seek(0)
+                content = _read_pack(memoryview(f.read()))
+            else:
+                content = content_from_source(load_source(path))
+    except (OSError, ValueError, KeyError, TypeError, struct.error) as exc:
+        raise PackError(path, [f"unreadable pack: {exc}"]) from exc
+    problems = validate(content)
+    if problems:
+        raise PackError(path, problems)
+    return content
+
+
+@dataclass
+class PackReloader:
+    # Watches one pack file and hands back new content when it is replaced. Checks
+    # are a stat() at most every `interval` seconds (0 turns reloading off); a pack
+    # that fails to load is logged and skipped, the running story stays in place.
+    path: str
+    interval: float = 2.0
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._signature = None
+        self._next_check = 0.0
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def load(self):
+        signature = self._stat()
+        content = load_pack(self.path)
+        self._signature = signature
+        self._next_check = time.monotonic() + self.interval
+        return content
+
+    def poll(self):
+        # New content if the file changed since the last load, otherwise None
+        if not self.interval or time.monotonic() < self._next_check:
+            return None
+        if not self._lock.acquire(blocking=False):
+            return None # Another thread is already checking
+        try:
+            self._next_check = time.monotonic() + self.interval
+            try:
+                signature = self._stat()
+            except OSError:
+                return None # Mid-replace or removed, keep serving what we have
+            if signature == self._signature:
+                return None
+            try:
+                content = load_pack(self.path)
+            except PackError as exc:
+                log.warning("Keeping the current story, new pack rejected: %s", exc)
+                self._signature = signature
+                return None
+            self._signature = signature
+            log.info("Loaded scenario pack %s (%d levels)", self.path, max(content['scenarios']))
+            return content
+        finally:
+            self._lock.release()
+
+
+@dataclass
+class StoryStats:
+    hits: int = 0
+    misses: int = 0
+    load_seconds: float = 0.0 # Total time spent loading, over all misses and reloads
+    reloads: int = 0
+    evictions: int = 0
+    failures: int = 0
+
+
+class StoryCatalog:
+    # Many stories side by side from one directory of packs, <story_id>.pack (or a
+    # .json/.toml source). A story is loaded on first use and kept in an LRU of at
+    # most max_stories, so memory stays flat however many packs the directory holds.
+    # build(content, path) turns loaded content into the object the routes use (a
+    # GameLogic), and may refuse it with a PackError.
+    def __init__(self, directory, build, max_stories=32, reload_interval=2.0):
+        self.directory = directory
+        self.build = build
+        self.max_stories = max_stories
+        self.reload_interval = reload_interval
+        self._stories = OrderedDict() # story_id -> [PackReloader, story], least recently used first
+        self._loading = {}            # story_id -> lock held while it loads, so it loads once
+        self._lock = threading.Lock()
+        self.stats = {}               # story_id -> StoryStats, only for stories that exist
+
+    def _path(self, story_id):
+        if not STORY_ID.fullmatch(story_id):
+            return None
+        for extension in PACK_EXTENSIONS:
+            path = os.path.join(self.directory, story_id + extension)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def _stats(self, story_id):
+        # Callers hold self._lock
+        if story_id not in self.stats:
+            self.stats[story_id] = StoryStats()
+        return self.stats[story_id]
+
+    def get(self, story_id):
+        # The story, or None if there is no such pack (or it does not load)
+        with self._lock:
+            entry = self._stories.get(story_id)
+            if entry is not None:
+                self._stories.move_to_end(story_id)
+                self._stats(story_id).hits += 1
+        if entry is None:
+            return self._load(story_id)
+        reloader, story = entry
+        start = time.perf_counter()
+        content = reloader.poll()
+        if content is not None:
+            try:
+                story = entry[1] = self.build(content, reloader.path)
+            except PackError as exc:
+                log.warning("Keeping story %r, new pack rejected: %s", story_id, exc)
+                with self._lock:
+                    self._stats(story_id).failures += 1
+                return story
+            with self._lock:
+                stats = self._stats(story_id)
+                stats.reloads += 1
+                stats.load_seconds += time.perf_counter() - start
+        return story
+
+    def _load(self, story_id):
+        path = self._path(story_id)
+        if path is None:
+            return None
+        with self._lock:
+            loading = self._loading.setdefault(story_id, threading.Lock())
+        with loading:
+            with self._lock:
+                entry = self._stories.get(story_id)
+                if entry is not None: # Loaded by another thread while this one waited
+                    self._stats(story_id).hits += 1
+                    return entry[1]
+            start = time.perf_counter()
+            reloader = PackReloader(path, self.reload_interval)
+            try:
+                story = self.build(reloader.load(), path)
+            except PackError as exc:
+                log.error("Story %r does not load: %s", story_id, exc)
+                with self._lock:
+                    self._stats(story_id).failures += 1
+                    self._loading.pop(story_id, None)
+                return None
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stats = self._stats(story_id)
+                stats.misses += 1
+                stats.load_seconds += elapsed
+                self._stories[story_id] = [reloader, story]
+                while len(self._stories) > self.max_stories:
+                    evicted, _ = self._stories.popitem(last=False)
+                    self._stats(evicted).evictions += 1
+                self._loading.pop(story_id, None)
+            return story
+
+    def loaded(self):
+        with self._lock:
+            return list(self._stories)
+
+    def available(self):
+        # Every story ID in the directory, loaded or not
+        ids = set()
+        for name in os.listdir(self.directory):
+            story_id, extension = os.path.splitext(name)
+            if extension in PACK_EXTENSIONS and STORY_ID.fullmatch(story_id):
+                ids.add(story_id)
+        return sorted(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and check scenario packs")
+    sub = parser.add_subparsers(dest='command', required=True)
+    export = sub.add_parser('export', help="write the built-in story as a JSON source")
+    export.add_argument('output')
+    build = sub.add_parser('compile', help="compile a JSON/TOML source into a pack")
+    build.add_argument('source')
+    build.add_argument('output')
+    check = sub.add_parser('check', help="load and validate a pack or source")
+    check.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        from app import game_logic # Only needed here, app imports this module
+        with open(args.output, 'w') as f:
+            json.dump(source_from_logic(game_logic, "Echoes of Doubt"), f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f"wrote {args.output}")
+    elif args.command == 'compile':
+        try:
+            size = write_pack(load_source(args.source), args.output)
+        except PackError as exc:
+            print("\n".join(exc.problems), file=sys.stderr)
+            sys.exit(1)
+        print(f"wrote {args.output} ({size} bytes)")
+    else:
+        try:
+            content = load_pack(args.path)
+        except PackError as exc:
+            print("\n".join(exc.problems), file=sys.stderr)
+            sys.exit(1)
+        scenarios = content['scenarios']
+        print(f"{args.path}: ok, {len(scenarios)} levels, "
+              f"{sum(len(s['options']) for s in scenarios.values())} options, "
+              f"{len(scenarios[max(scenarios)]['ending'])} endings")
+
+
+if __name__ == '__main__':
+    main()
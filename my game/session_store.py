@@ -0,0 +1,259 @@
+# Server-side storage for game runs. The cookie only carries an opaque run ID;
+# the state itself lives in one of these stores. Runs idle for longer than ttl seconds
+# are abandoned: get() no longer sees them, and every purge_every put() calls drop them.
+from collections import OrderedDict
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SessionStore:
+    # Interface shared by the backends. State values are anything JSON can hold.
+    def get(self, run_id):
+        raise NotImplementedError
+
+    def put(self, run_id, state):
+        raise NotImplementedError
+
+    def delete(self, run_id):
+        raise NotImplementedError
+
+    def purge_expired(self):
+        # Drop abandoned runs, returns how many were removed
+        return 0
+
+
+class MemoryStore(SessionStore):
+    # Bounded in-process LRU. Runs idle for longer than ttl seconds are evicted too.
+    # States are kept encoded, like in SQLiteStore, so every get() hands out a copy of its
+    # own: concurrent requests for one run never change the same dict under each other.
+    def __init__(self, max_runs=10000, ttl=3600, purge_every=1000):
+        self.max_runs = max_runs
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._runs = OrderedDict() # run_id -> (last_used, JSON state), least recently used first
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    def get(self, run_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._runs.get(run_id)
+            if entry is None:
+                return None
+            if now - entry[0] > self.ttl:
+                del self._runs[run_id]
+                return None
+            self._runs[run_id] = (now, entry[1])
+            self._runs.move_to_end(run_id)
+        return json.loads(entry[1])
+
+    def put(self, run_id, state):
+        data = json.dumps(state, separators=(',', ':'))
+        now = time.monotonic()
+        with self._lock:
+            self._runs[run_id] = (now, data)
+            self._runs.move_to_end(run_id)
+            while len(self._runs) > self.max_runs:
+                self._runs.popitem(last=False)
+            self._puts += 1
+            if self._puts % self.purge_every == 0:
+                self._purge(now - self.ttl)
+
+    def delete(self, run_id):
+        with self._lock:
+            self._runs.pop(run_id, None)
+
+    def purge_expired(self):
+        with self._lock:
+            return self._purge(time.monotonic() - self.ttl)
+
+    def _purge(self, cutoff):
+        # Oldest entries sit at the front, so stop at the first live one
+        removed = 0
+        while self._runs:
+            run_id, (last_used, _) = next(iter(self._runs.items()))
+            if last_used >= cutoff:
+                break
+            del self._runs[run_id]
+            removed += 1
+        return removed
+
+    def __len__(self):
+        return len(self._runs)
+
+
+class SQLiteStore(SessionStore):
+    # SQLite in WAL mode, so several workers can share one file. Each worker process
+    # keeps a single connection, reopened after a fork and serialized with a lock.
+    def __init__(self, path='game_sessions.db', ttl=3600, purge_every=1000):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._puts = 0
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS runs ('
+                'run_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS runs_updated_at ON runs (updated_at)')
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def get(self, run_id):
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT state FROM runs WHERE run_id = ? AND updated_at >= ?',
+                (run_id, time.time() - self.ttl)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, run_id, state):
+        data = json.dumps(state, separators=(',', ':'))
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                'INSERT OR REPLACE INTO runs (run_id, state, updated_at) VALUES (?, ?, ?)',
+                (run_id, data, time.time())
+            )
+            # Per process: with N workers the file is purged N times as often
+            self._puts += 1
+            if self._puts % self.purge_every == 0:
+                conn.execute('DELETE FROM runs WHERE updated_at < ?', (time.time() - self.ttl,))
+
+    def delete(self, run_id):
+        with self._lock:
+            self._connection().execute('DELETE FROM runs WHERE run_id = ?', (run_id,))
+
+    def purge_expired(self):
+        with self._lock:
+            cursor = self._connection().execute(
+                'DELETE FROM runs WHERE updated_at < ?', (time.time() - self.ttl,)
+            )
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# --- Async stores, for the asyncio front end in async_app.py ---
+class AsyncMemoryStore:
+    # The in-process LRU never blocks, so the async version just wraps it (copies included)
+    def __init__(self, **options):
+        self._store = MemoryStore(**options)
+
+    async def get(self, run_id):
+        return self._store.get(run_id)
+
+    async def put(self, run_id, state):
+        self._store.put(run_id, state)
+
+    async def delete(self, run_id):
+        self._store.delete(run_id)
+
+    async def purge_expired(self):
+        return self._store.purge_expired()
+
+    async def close(self):
+        pass
+
+
+class AsyncSQLiteStore:
+    # Same table and WAL setup as SQLiteStore, through aiosqlite (one connection per
+    # worker, opened lazily on the running event loop)
+    def __init__(self, path='game_sessions.db', ttl=3600, purge_every=1000):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._conn = None
+        self._opening = None
+        self._puts = 0
+
+    async def _connection(self):
+        if self._conn is None:
+            if self._opening is None:
+                self._opening = asyncio.ensure_future(self._open())
+            await self._opening
+        return self._conn
+
+    async def _open(self):
+        import aiosqlite # Optional, only needed for SESSION_STORE=sqlite in async mode
+
+        conn = await aiosqlite.connect(self.path, isolation_level=None)
+        await conn.execute('PRAGMA journal_mode=WAL')
+        await conn.execute('PRAGMA synchronous=NORMAL')
+        await conn.execute(
+            'CREATE TABLE IF NOT EXISTS runs ('
+            'run_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+        await conn.execute('CREATE INDEX IF NOT EXISTS runs_updated_at ON runs (updated_at)')
+        self._conn = conn
+
+    async def get(self, run_id):
+        conn = await self._connection()
+        async with conn.execute(
+            'SELECT state FROM runs WHERE run_id = ? AND updated_at >= ?',
+            (run_id, time.time() - self.ttl)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def put(self, run_id, state):
+        conn = await self._connection()
+        await conn.execute(
+            'INSERT OR REPLACE INTO runs (run_id, state, updated_at) VALUES (?, ?, ?)',
+            (run_id, json.dumps(state, separators=(',', ':')), time.time())
+        )
+        self._puts += 1
+        if self._puts % self.purge_every == 0:
+            await self.purge_expired()
+
+    async def delete(self, run_id):
+        conn = await self._connection()
+        await conn.execute('DELETE FROM runs WHERE run_id = ?', (run_id,))
+
+    async def purge_expired(self):
+        conn = await self._connection()
+        cursor = await conn.execute('DELETE FROM runs WHERE updated_at < ?', (time.time() - self.ttl,))
+        return cursor.rowcount
+
+    async def close(self):
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+            self._opening = None
+
+
+def create_async_store(kind, **options):
+    if kind == 'cookie':
+        return None
+    if kind == 'memory':
+        return AsyncMemoryStore(**options)
+    if kind == 'sqlite':
+        return AsyncSQLiteStore(**options)
+    raise ValueError(f"Unknown session store: {kind!r}")
+
+
+def create_store(kind, **options):
+    # 'cookie' means no server-side store at all
+    if kind == 'cookie':
+        return None
+    if kind == 'memory':
+        return MemoryStore(**options)
+    if kind == 'sqlite':
+        return SQLiteStore(**options)
+    raise ValueError(f"Unknown session store: {kind!r}")
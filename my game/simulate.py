@@ -0,0 +1,255 @@
+# Headless batch simulation: millions of synthetic players through GameLogic's rules at
+# once, for balancing. Run from this folder, e.g.:
+#   python simulate.py --runs 10000000
+#   python simulate.py --policy greedy-safe --pack stories/echoes.pack --bad-sanity 9
+#   python simulate.py --policy weights --weights weights.json --check 2000
+# Each level is one vectorized step over integer arrays: draw every run's option from
+# the policy, then add that option's effects to the run's counters. The counters share
+# one int64 per run, 16 bits each, so a step is a single gather and add. analyze.py gives
+# the exact ending probabilities for a weighted policy; this also covers the rest
+# (delayed message hits, counter spreads) and policies analyze.py can't express.
+from collections import Counter
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from analyze import load_weights
+from app import GameLogic, apply_choice, ending_type_for, fallback_ending, game_logic, new_state
+from scenario_pack import load_pack
+
+ENDINGS = ('good', 'bad', 'neutral', 'secret', 'fallback') # Index = ending code in the arrays
+FALLBACK = ENDINGS.index('fallback')
+SECRET = ENDINGS.index('secret')
+# Bit offsets of the counters packed into each run's int64
+COUNTERS = {'keys': 0, 'sanity': 16, 'mirrors': 32, 'delayed': 48}
+FIELD = 0xFFFF
+
+
+# --- Policies ---
+# A policy maps (logic, level) to relative weights over the level's options, in display
+# order. They can't look at a run's counters, which keeps each step a single draw.
+def uniform(logic, level):
+    return [1] * len(logic.levels[level].options)
+
+
+def greedy_safe(logic, level):
+    # Never a wrong choice when the level has a safe one
+    safe = [0 if option.consequence.is_wrong else 1 for option in logic.levels[level].options.values()]
+    return safe if any(safe) else uniform(logic, level)
+
+
+def secret_seeking(logic, level):
+    # The secret path's choice where it has one, safe choices everywhere else
+    steps = dict(logic.secret_path)
+    if level in steps:
+        return [int(key == steps[level]) for key in logic.levels[level].options]
+    return greedy_safe(logic, level)
+
+
+def weighted(weights):
+    # Relative weights from a file, as in analyze.py; options left out weigh 1
+    def policy(logic, level):
+        level_weights = weights.get(level, {})
+        return [level_weights.get(key, 1) for key in logic.levels[level].options]
+    return policy
+
+
+POLICIES = {'uniform': uniform, 'greedy-safe': greedy_safe, 'secret': secret_seeking}
+
+
+class Simulator:
+    # The story's rules flattened into per-level arrays indexed by option position
+    def __init__(self, logic, policy):
+        if logic.total_levels > FIELD:
+            raise ValueError(f"at most {FIELD} levels fit the packed counters")
+        self.logic = logic
+        # Same walk as analyze.py: every level up to the first without options, where play
+        # stops on that level's page (dead_end is that level, or None)
+        played = []
+        self.dead_end = None
+        for level in range(1, logic.total_levels + 1):
+            if not logic.options_in_order(level):
+                self.dead_end = level
+                break
+            played.append(level)
+        self.steps = [] # (level, cumulative choice probabilities, packed counter deltas, secret bits, reveal hits)
+        for level in played:
+            options = logic.options_in_order(level)
+            weights = np.asarray(policy(logic, level), dtype=float)
+            effects = np.array([logic.choice_effect(level, option.key) for option in options], dtype=np.int64)
+            # A delayed message is shown if its reveal level comes after the choice and is
+            # played: a level without options is a dead end page, which shows no messages
+            fires = np.array([
+                option.consequence.delayed_reveal_level is not None
+                and level < option.consequence.delayed_reveal_level <= played[-1]
+                for option in options
+            ], dtype=np.int64)
+            deltas = ((effects[:, 0] << COUNTERS['keys']) | (effects[:, 1] << COUNTERS['sanity'])
+                      | (effects[:, 2] << COUNTERS['mirrors']) | (fires << COUNTERS['delayed']))
+            cdf = np.cumsum(weights / weights.sum())[:-1].astype(np.float32)
+            self.steps.append((level, cdf, deltas, effects[:, 3], fires))
+        # Clamped counters -> ending code, as GameLogic.ending_table
+        table = np.full((logic.keys_cap + 1, logic.sanity_cap + 1, logic.mirror_cap + 1), FALLBACK, dtype=np.int8)
+        for (keys, sanity, mirrors), ending in logic.ending_table.items():
+            if ending is not None:
+                table[keys, sanity, mirrors] = ENDINGS.index(ending)
+        self.table = table
+
+    def run(self, runs, rng, keep_choices=False):
+        # One batch: arrays of ending codes and uncapped counters, per-step option hit
+        # counts, and (with keep_choices) every run's option positions level by level
+        counters = np.zeros(runs, dtype=np.int64)
+        secret = np.zeros(runs, dtype=np.int64)
+        index = np.empty(runs, dtype=np.uint8)
+        picks = []
+        choices = np.empty((runs, len(self.steps)), dtype=np.uint8) if keep_choices else None
+        for step, (_, cdf, deltas, secret_bits, _) in enumerate(self.steps):
+            # Option position = how many cumulative probabilities the draw reaches
+            draw = rng.random(runs, dtype=np.float32)
+            index.fill(0)
+            for bound in cdf:
+                np.add(index, draw >= bound, out=index, casting='unsafe')
+            counters += deltas.take(index)
+            if secret_bits.any():
+                secret |= secret_bits.take(index)
+            picks.append(np.bincount(index, minlength=len(deltas)))
+            if keep_choices:
+                choices[:, step] = index
+        keys, sanity, mirrors, delayed = ((counters >> shift) & FIELD for shift in COUNTERS.values())
+        logic = self.logic
+        endings = self.table[np.minimum(keys, logic.keys_cap),
+                             np.minimum(sanity, logic.sanity_cap),
+                             np.minimum(mirrors, logic.mirror_cap)]
+        endings[secret == logic.secret_complete] = SECRET
+        return {'endings': endings, 'keys': keys, 'sanity': sanity, 'mirrors': mirrors,
+                'delayed': delayed, 'picks': picks, 'choices': choices}
+
+
+def scalar_reference(logic, levels, positions, seed=0):
+    # One run played the way the routes play it (apply_choice, reveal_delayed, then the
+    # ending the game would serve), and the ending worked out again from the history with
+    # the rules themselves: ending_rule on plain counts, never the precomputed tables the
+    # simulator and the game share, so a wrong table entry shows up as a mismatch.
+    # Returns (ending code, sanity lost, delayed messages shown).
+    state = new_state(logic)
+    state['seed'] = seed
+    shown = 0
+    for level in range(1, logic.total_levels + 1):
+        options = logic.options_in_order(level)
+        if not options:
+            break # A dead end page, play_game shows none of the messages due there
+        shown += len(logic.reveal_delayed(state['delayed_consequences_pending'], level))
+        apply_choice(logic, state, level, options[positions[levels[level]]].key)
+    past_choices = state['past_choices']
+    made = {(c['level'], c['choice']) for c in past_choices}
+    sanity = sum(c['is_wrong'] for c in past_choices)
+    if logic.secret_path and all(step in made for step in logic.secret_path):
+        ending = 'secret'
+    else:
+        ending = logic.ending_rule(sum(step in made for step in logic.key_choices), sanity,
+                                   sum(c['level'] in logic.mirror_levels for c in past_choices))
+    served = ending_type_for(logic, state)
+    expected = ending or fallback_ending(seed, logic.choice_record(past_choices))
+    if served != expected:
+        raise AssertionError(f"the game serves {served!r}, the rules give {expected!r}")
+    return ENDINGS.index(ending or 'fallback'), sanity, shown
+
+
+def check(simulator, result, sample, rng):
+    # Compare sampled runs of a batch with the scalar reference; returns the mismatches
+    levels = {level: step for step, (level, *_) in enumerate(simulator.steps)}
+    mismatches = 0
+    for run in rng.choice(len(result['endings']), size=min(sample, len(result['endings'])), replace=False):
+        got = (int(result['endings'][run]), int(result['sanity'][run]), int(result['delayed'][run]))
+        try:
+            expected = scalar_reference(simulator.logic, levels, result['choices'][run], seed=int(run))
+        except AssertionError as exc:
+            expected = exc
+        if got != expected:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"run {run}: batch {got}, scalar {expected} (ending, sanity lost, delayed shown)")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many players in bulk")
+    parser.add_argument('--runs', type=int, default=1000000)
+    parser.add_argument('--batch', type=int, default=1000000, help="runs advanced together")
+    parser.add_argument('--policy', default='uniform', choices=[*POLICIES, 'weights'])
+    parser.add_argument('--weights', help="JSON file of per-level choice weights, for --policy weights")
+    parser.add_argument('--pack', help="simulate this scenario pack instead of the built-in story")
+    parser.add_argument('--check', type=int, metavar='RUNS', default=0,
+                        help="replay this many sampled runs through GameLogic and compare")
+    parser.add_argument('--seed', type=int, default=0)
+    for name, value in GameLogic.ENDING_THRESHOLDS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=int, help=f"ending threshold (story default)")
+    args = parser.parse_args()
+
+    thresholds = {name: getattr(args, name) for name in GameLogic.ENDING_THRESHOLDS
+                  if getattr(args, name) is not None}
+    if args.pack or thresholds:
+        logic = GameLogic(thresholds, content=load_pack(args.pack) if args.pack else None)
+    else:
+        logic = game_logic
+    if args.policy == 'weights':
+        if not args.weights:
+            parser.error("--policy weights needs --weights")
+        policy = weighted(load_weights(args.weights))
+    else:
+        policy = POLICIES[args.policy]
+
+    simulator = Simulator(logic, policy)
+    rng = np.random.default_rng(args.seed)
+    endings = np.zeros(len(ENDINGS), dtype=np.int64)
+    sanity = Counter()
+    delayed = Counter()
+    picks = [np.zeros_like(step[2]) for step in simulator.steps]
+    mismatches = 0
+    start = time.perf_counter()
+    done = 0
+    while done < args.runs:
+        size = min(args.batch, args.runs - done)
+        keep = args.check > 0 and done == 0
+        result = simulator.run(size, rng, keep_choices=keep)
+        if keep:
+            mismatches = check(simulator, result, args.check, rng)
+        endings += np.bincount(result['endings'], minlength=len(ENDINGS))
+        sanity.update(dict(enumerate(np.bincount(result['sanity']).tolist())))
+        delayed.update(dict(enumerate(np.bincount(result['delayed']).tolist())))
+        for total, counts in zip(picks, result['picks']):
+            total += counts
+        done += size
+    elapsed = time.perf_counter() - start
+
+    print(f"{done} runs ({args.policy}) in {elapsed:.2f} s, {done / elapsed:,.0f} runs per second")
+    if simulator.dead_end is not None:
+        print(f"(level {simulator.dead_end} has no options, so play stops on its page; "
+              "these are the endings the counters give)")
+    print("\nEndings:")
+    for code, ending in enumerate(ENDINGS):
+        note = "  (good/bad/neutral by the run's seed)" if code == FALLBACK else ""
+        print(f"{ending:>10}: {endings[code] / done:10.6%}{note}")
+    for name, counts in (('sanity_lost', sanity), ('delayed messages shown', delayed)):
+        mean = sum(value * count for value, count in counts.items()) / done
+        print(f"\n{name} (mean {mean:.3f}):")
+        for value in sorted(counts):
+            if counts[value]:
+                print(f"{value:>10}: {counts[value] / done:10.6%}")
+    print("\nDelayed message hits (source level/choice: share of runs):")
+    for (level, *_, fires), counts in zip(simulator.steps, picks):
+        keys = list(logic.levels[level].options)
+        for position in np.flatnonzero(fires):
+            print(f"{level:>7}/{keys[position]}: {counts[position] / done:10.6%}")
+
+    if args.check:
+        print(f"\nScalar check over {min(args.check, args.batch, args.runs)} sampled runs: "
+              f"{'ok' if not mismatches else f'{mismatches} MISMATCHES'}")
+        if mismatches:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+// Get the current level number from Flask (set on <body> by game.html)
+const currentLevel = Number(document.body.dataset.level);
+
+// Base path for your images
+const imageBasePath = document.body.dataset.imageBase;
+
+// Function to set the background image
+function setBackgroundImage(level) {
+    // You can use a single image for multiple levels, or specific images.
+    // Example: "bg_level_1.jpg", "bg_level_2.jpg", etc.
+    // Or use a more generic naming like "creepy_1.jpg", "creepy_2.jpg"
+    // and cycle through them, or pick randomly.
+
+    let imageName;
+
+    // Option 1: Direct mapping (best if you want specific images per level)
+    imageName = `bg_level_${level}.jpg`; // Assuming JPGs, adjust if PNG/GIF
+    // Example: if level 1 uses bg_level_1.jpg, level 2 uses bg_level_2.jpg
+
+    // Option 2: Cycle through a set of generic creepy images if you have fewer images than levels
+    const creepyImages = [
+        'creepy_1.jpg',
+        'creepy_2.png',
+        'creepy_3.gif',
+        'creepy_4.jpg',
+        'creepy_5.png',
+        // Add more as needed, up to 20 or more
+    ];
+    // Cycle through them, or pick randomly for variety
+    const imageIndex = (level - 1) % creepyImages.length;
+    imageName = creepyImages[imageIndex];
+
+
+    const imageUrl = `${imageBasePath}${imageName}`;
+    document.body.style.backgroundImage = `url('${imageUrl}')`;
+}
+
+// Call the function when the page loads
+document.addEventListener('DOMContentLoaded', () => {
+    setBackgroundImage(currentLevel);
+});
+
+// Progressive enhancement: answer choices through the JSON API in one round trip.
+// Without JS (or if the request can't reach the server) the form posts to /play as before.
+const choiceForm = document.querySelector('form[data-choice-api]');
+// The level the form is for, so the server can spot a repeated or outdated submission
+const levelInput = choiceForm && choiceForm.querySelector('input[name="level"]');
+// Where a refused choice is explained to the player
+const choiceNotice = document.querySelector('.choice-notice');
+
+function showNotice(text) {
+    choiceNotice.textContent = text;
+    choiceNotice.hidden = !text;
+}
+
+function enableChoices() {
+    choiceForm.querySelectorAll('button').forEach((b) => { b.disabled = false; });
+}
+
+function showLevel(data) {
+    document.querySelector('.level-indicator').textContent = `Level ${data.level} / ${data.total_levels}`;
+
+    const immediate = document.querySelector('.immediate-message');
+    immediate.textContent = data.immediate;
+    immediate.hidden = !data.immediate;
+
+    const scenario = document.querySelector('.scenario-text');
+    scenario.textContent = data.scenario;
+    // Restart the fade-in animation for the new text
+    scenario.style.animation = 'none';
+    void scenario.offsetWidth;
+    scenario.style.animation = '';
+
+    document.querySelector('.delayed-slot').innerHTML = data.delayed_html;
+
+    const buttons = data.options.map(({ key, text }) => {
+        const button = document.createElement('button');
+        button.type = 'submit';
+        button.name = 'choice';
+        button.value = key;
+        button.className = 'option-button';
+        button.textContent = text;
+        return button;
+    });
+    levelInput.value = data.level;
+    choiceForm.replaceChildren(levelInput, ...buttons);
+
+    document.body.dataset.level = data.level;
+    setBackgroundImage(data.level);
+    window.scrollTo(0, 0);
+}
+
+function submitWithoutApi(choice) {
+    const input = document.createElement('input');
+    input.type = 'hidden';
+    input.name = 'choice';
+    input.value = choice;
+    choiceForm.appendChild(input);
+    HTMLFormElement.prototype.submit.call(choiceForm);
+}
+
+function showRefusal(response, data) {
+    // The server answered but didn't take the choice. Sending the form again would only
+    // be refused again (and cost a full page), so say why and let the player retry.
+    if (response.status === 429) {
+        const wait = Number(response.headers.get('Retry-After')) || data.retry_after || 1;
+        showNotice(`Too many choices at once. Try again in ${wait} second${wait === 1 ? '' : 's'}.`);
+        window.setTimeout(() => { showNotice(''); enableChoices(); }, wait * 1000);
+        return;
+    }
+    showNotice(response.status < 500
+        ? 'That choice was not accepted. Pick again.'
+        : 'Something went wrong. Try again in a moment.');
+    enableChoices();
+}
+
+if (choiceForm && window.fetch) {
+    choiceForm.addEventListener('submit', async (event) => {
+        const button = event.submitter;
+        if (!button || !button.value) {
+            return; // Let the browser handle anything unexpected
+        }
+        event.preventDefault();
+        choiceForm.querySelectorAll('button').forEach((b) => { b.disabled = true; });
+        showNotice('');
+
+        let response;
+        try {
+            response = await fetch(choiceForm.dataset.choiceApi, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
+                body: new URLSearchParams({ choice: button.value, level: levelInput.value }),
+                credentials: 'same-origin',
+            });
+        } catch (error) {
+            submitWithoutApi(button.value); // Network error, the plain form may still get through
+            return;
+        }
+        const data = await response.json().catch(() => ({}));
+        if (data.stale || (response.ok && data.game_over)) {
+            window.location.assign(data.location); // The run moved on or is over, show where it is
+        } else if (response.ok && data.options) {
+            showLevel(data);
+        } else {
+            showRefusal(response, data);
+        }
+    });
+}
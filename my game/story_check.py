@@ -0,0 +1,147 @@
+# Static checks over a compiled story (GameLogic), the graph the routes actually walk.
+# create_app runs them on every worker boot and refuses to start on errors; warnings
+# are logged. scenario_pack.validate() already rejects malformed pack sources, this
+# also covers the built-in story and what only shows up once levels are linked up.
+# Run from this folder, e.g.:
+#   python story_check.py
+#   python story_check.py stories/*.pack --strict
+from dataclasses import dataclass
+import argparse
+import sys
+import time
+
+ERROR = 'error'     # A player can hit it: wrong text, a missing page, a rule that can't work
+WARNING = 'warning' # Dead content: never shown, never reached, never used
+
+
+@dataclass(frozen=True, slots=True)
+class Finding:
+    severity: str
+    message: str
+
+    def __str__(self):
+        return f"{self.severity}: {self.message}"
+
+
+def check_story(logic, fallback_endings=('good', 'bad', 'neutral')):
+    findings = []
+    total = logic.total_levels
+    levels = logic.levels
+
+    # Levels are played in order, and a level without options ends the run
+    reachable = set()
+    for number in range(1, total + 1):
+        if number not in levels:
+            findings.append(Finding(ERROR, f"level {number} is missing, runs reaching it get the undefined path page"))
+            break
+        reachable.add(number)
+        if not levels[number].options:
+            break
+    dead_end = max(reachable) if reachable else 0
+    endings_reachable = dead_end == total and bool(levels[total].options)
+    unreachable = sorted(set(levels) - reachable)
+    if unreachable:
+        findings.append(Finding(WARNING, f"level{'s' if len(unreachable) > 1 else ''} "
+                                         f"{_spans(unreachable)} can't be reached, level {dead_end} has no options"))
+    elif not endings_reachable:
+        findings.append(Finding(WARNING, f"the final level ({total}) has no options, so runs stop on its page "
+                                         "and the endings are never shown"))
+
+    for number, level in sorted(levels.items()):
+        for key, option in level.options.items():
+            reveal_level = option.consequence.delayed_reveal_level
+            if reveal_level is None:
+                continue
+            where = f"level {number} option {key!r}"
+            if not 1 <= reveal_level <= total:
+                findings.append(Finding(ERROR, f"{where}: delayed_reveal_level {reveal_level} is outside 1..{total}"))
+                continue
+            if reveal_level <= number:
+                findings.append(Finding(WARNING, f"{where}: delayed_reveal_level {reveal_level} is not after "
+                                                 "the choice, so it never fires"))
+            elif number not in reachable:
+                pass # Already reported with its level
+            elif reveal_level not in reachable:
+                findings.append(Finding(WARNING, f"{where}: reveals on level {reveal_level}, which can't be reached"))
+            elif not levels[reveal_level].options:
+                findings.append(Finding(WARNING, f"{where}: reveals on level {reveal_level}, which has no options, "
+                                                 "so the message is never shown"))
+            elif (number, key) not in logic.delayed_messages:
+                findings.append(Finding(WARNING, f"{where} has a delayed_reveal_level but no delayed message, "
+                                                 "players see the default one"))
+
+    for number, key in sorted(logic.delayed_messages):
+        option = levels.get(number) and levels[number].options.get(key)
+        if option is None:
+            findings.append(Finding(WARNING, f"delayed message for level {number} option {key!r}, "
+                                             "which does not exist"))
+        elif option.consequence.delayed_reveal_level is None:
+            findings.append(Finding(WARNING, f"delayed message for level {number} option {key!r}, "
+                                             "which has no delayed_reveal_level"))
+
+    # Every ending the rules can pick needs its text
+    possible = {ending for ending in logic.ending_table.values() if ending is not None}
+    if None in logic.ending_table.values():
+        possible.update(fallback_endings)
+    if logic.secret_path:
+        possible.add('secret')
+    endings = levels[total].endings if total in levels else {}
+    for ending in sorted(possible - set(endings)):
+        findings.append(Finding(ERROR if endings_reachable else WARNING,
+                                f"the final level has no {ending!r} ending, the rules can pick it"))
+
+    for name, steps in (('secret_path', logic.secret_path), ('key_choices', logic.key_choices)):
+        for number, key in steps:
+            if number not in levels or key not in levels[number].options:
+                severity = ERROR if name == 'secret_path' else WARNING
+                consequence = "the secret ending can never happen" if severity == ERROR else "it never counts"
+                findings.append(Finding(severity, f"{name} step level {number} option {key!r} does not exist, "
+                                                  f"{consequence}"))
+    for number in logic.mirror_levels:
+        if number not in reachable or not levels[number].options:
+            findings.append(Finding(WARNING, f"mirror level {number} is never played, it never counts"))
+    return findings
+
+
+def _spans(numbers):
+    # [3, 4, 5, 9] -> '3..5, 9'
+    spans, start = [], numbers[0]
+    for previous, number in zip(numbers, numbers[1:] + [None]):
+        if number != previous + 1:
+            spans.append(str(start) if start == previous else f"{start}..{previous}")
+            start = number
+    return ", ".join(spans)
+
+
+def main():
+    from app import GameLogic, game_logic # app runs these checks itself, so import it lazily
+    from scenario_pack import PackError, load_pack
+
+    parser = argparse.ArgumentParser(description="Check stories for unreachable or broken content")
+    parser.add_argument('packs', nargs='*', help="scenario packs or sources (default: the built-in story)")
+    parser.add_argument('--strict', action='store_true', help="fail on warnings too")
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.packs or [None]:
+        try:
+            logic = game_logic if path is None else GameLogic(content=load_pack(path))
+        except PackError as exc:
+            print(f"{path}:\n  " + "\n  ".join(exc.problems))
+            failed = True
+            continue
+        start = time.perf_counter()
+        findings = check_story(logic)
+        elapsed = time.perf_counter() - start
+        errors = sum(finding.severity == ERROR for finding in findings)
+        print(f"{path or 'built-in story'}: {errors} errors, {len(findings) - errors} warnings "
+              f"({elapsed * 1e3:.2f} ms)")
+        for finding in findings:
+            print(f"  {finding}")
+        failed |= bool(errors) or (args.strict and bool(findings))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
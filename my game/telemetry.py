@@ -0,0 +1,206 @@
+# Choice telemetry: which options players pick and how their runs end.
+#   SECRET_KEY=... TELEMETRY=sqlite:telemetry.db gunicorn -c gunicorn.conf.py wsgi:app
+#   SECRET_KEY=... TELEMETRY=csv:telemetry/ gunicorn -c gunicorn.conf.py wsgi:app
+# Run from this folder to aggregate what was recorded, e.g.:
+#   python telemetry.py sqlite:telemetry.db
+#   python telemetry.py csv:telemetry/ --story echoes
+# Requests only append a tuple to an in-memory ring buffer; a background thread per
+# worker process drains it in batches to the sink. If the sink falls behind, the
+# oldest events are dropped (and counted) rather than slowing requests down.
+from collections import Counter, defaultdict, deque
+import argparse
+import atexit
+import csv
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# One event per choice made, and one when a run ends (choice and is_wrong empty)
+FIELDS = ('timestamp', 'run_id', 'story', 'level', 'choice', 'is_wrong', 'ending')
+
+log = logging.getLogger(__name__)
+
+
+class SQLiteSink:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            # Used from the flush thread and from atexit, never both at once (see Telemetry.flush)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS events (timestamp REAL NOT NULL, run_id TEXT, story TEXT, '
+                'level INTEGER, choice TEXT, is_wrong INTEGER, ending TEXT)'
+            )
+            self._conn = conn
+        return self._conn
+
+    def write(self, events):
+        conn = self._connection()
+        with conn:
+            conn.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?)', events)
+
+    def read(self, story=None):
+        conn = sqlite3.connect(self.path)
+        try:
+            query = f"SELECT {', '.join(FIELDS)} FROM events"
+            if story is not None:
+                yield from conn.execute(query + ' WHERE story IS ?', (story or None,))
+            else:
+                yield from conn.execute(query)
+        finally:
+            conn.close()
+
+
+class CSVSink:
+    # Append-only CSV files, one per process and day, so workers never share a file
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, events):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"choices-{time.strftime('%Y%m%d')}-{os.getpid()}.csv")
+        new = not os.path.exists(path)
+        with open(path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(FIELDS)
+            writer.writerows(events)
+
+    def read(self, story=None):
+        for path in sorted(glob.glob(os.path.join(self.directory, 'choices-*.csv'))):
+            with open(path, newline='') as f:
+                for row in csv.DictReader(f):
+                    event = (float(row['timestamp']), row['run_id'], row['story'] or None,
+                             int(row['level']), row['choice'] or None,
+                             {'True': 1, 'False': 0}.get(row['is_wrong']), row['ending'] or None)
+                    if story is None or event[2] == (story or None):
+                        yield event
+
+
+def create_sink(spec):
+    # 'sqlite:<path>' or 'csv:<directory>'
+    kind, _, target = spec.partition(':')
+    if kind == 'sqlite' and target:
+        return SQLiteSink(target)
+    if kind == 'csv' and target:
+        return CSVSink(target)
+    raise ValueError(f"Unknown telemetry sink: {spec!r} (expected sqlite:<path> or csv:<directory>)")
+
+
+class Telemetry:
+    def __init__(self, sink, capacity=65536, batch_size=1000, interval=1.0):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.interval = interval
+        self._buffer = deque(maxlen=capacity)
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._started = False
+        # The flush thread doesn't survive a fork, so each worker starts its own
+        os.register_at_fork(after_in_child=self._forked)
+        # Rough counters, updated without a lock
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+    def record(self, run_id, story, level, choice=None, is_wrong=None, ending=None):
+        if not self._started:
+            self._start()
+        buffer = self._buffer
+        size = len(buffer)
+        if size == buffer.maxlen:
+            self.dropped += 1 # The append below pushes out the oldest event
+        buffer.append((time.time(), run_id, story, level, choice, is_wrong, ending))
+        self.recorded += 1
+        if size >= self.batch_size:
+            self._wake.set()
+
+    def _forked(self):
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def _start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            threading.Thread(target=self._run, name='telemetry-flush', daemon=True).start()
+            atexit.register(self.flush)
+            self._started = True
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        # Drain everything buffered so far, batch_size events per write
+        with self._flush_lock:
+            buffer = self._buffer
+            while buffer:
+                batch = []
+                try:
+                    while len(batch) < self.batch_size:
+                        batch.append(buffer.popleft())
+                except IndexError:
+                    pass
+                try:
+                    self.sink.write(batch)
+                    self.written += len(batch)
+                except Exception:
+                    # Telemetry must never take the game down; the batch is lost
+                    log.exception("Dropping %d telemetry events", len(batch))
+                    self.failed += len(batch)
+
+
+def aggregate(events):
+    # (per-story per-level Counter of choices, wrong choices per story/level, Counter of endings per story)
+    choices = defaultdict(Counter)
+    wrong = Counter()
+    endings = defaultdict(Counter)
+    for _, _, story, level, choice, is_wrong, ending in events:
+        if ending is not None:
+            endings[story][ending] += 1
+        elif choice is not None:
+            choices[(story, level)][choice] += 1
+            wrong[(story, level)] += bool(is_wrong)
+    return choices, wrong, endings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-level choice distributions and ending rates")
+    parser.add_argument('sink', help="sqlite:<path> or csv:<directory>, as in TELEMETRY")
+    parser.add_argument('--story', help="only this story ID ('' for the main story)")
+    args = parser.parse_args()
+
+    choices, wrong, endings = aggregate(create_sink(args.sink).read(args.story))
+    for story in sorted({story for story, _ in choices} | set(endings), key=lambda s: s or ''):
+        print(f"== {story or 'main story'} ==")
+        levels = sorted(level for s, level in choices if s == story)
+        for level in levels:
+            counts = choices[(story, level)]
+            total = sum(counts.values())
+            spread = "  ".join(f"{key} {count / total:6.1%}" for key, count in sorted(counts.items()))
+            print(f"level {level:>3}: {total:7d} choices  {spread}  wrong {wrong[(story, level)] / total:6.1%}")
+        total = sum(endings[story].values())
+        if total:
+            print(f"{total} runs finished:")
+            for ending, count in endings[story].most_common():
+                print(f"{ending:>16}: {count:7d}  {count / total:6.1%}")
+        print()
+
+
+if __name__ == '__main__':
+    main()
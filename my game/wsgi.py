@@ -0,0 +1,6 @@
+# Production WSGI entry point. SECRET_KEY must be set and shared by every worker:
+#   SECRET_KEY=... gunicorn -c gunicorn.conf.py wsgi:app
+# The rest of the configuration comes from the environment, see config_from_env in app.py.
+from app import create_app
+
+app = create_app()